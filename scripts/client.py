@@ -1,14 +1,33 @@
+import json
 import logging
+import atexit
+import pickle
+import hashlib
+import concurrent.futures
 
 from .ebsockets.connections import ebsocket_client, ebsocket_event
 from .passwords import get_password_hash
 from scripts import e2e_handshakes, utilities
 from scripts import database
 from scripts import unique_pc_identifier
-from scripts.crypto import Symmetric, Asymmetric, Hybrid, DataPacket
+from scripts import key_pool
+from scripts import lru_cache
+from scripts.crypto import Symmetric, Asymmetric, Hybrid, DataPacket, SealedPacket
 
 class Client(object):
-    def __init__(self, backend):
+    # batches with fewer packets than this are decrypted
+    # in place, as handing them out costs more than it saves
+    PARALLEL_DECRYPT_MIN = 8
+    # seconds without new messages before the message
+    # index is saved
+    INDEX_SAVE_IDLE = 5.0
+
+    def __init__(
+            self,
+            backend,
+            key_pool_depth:int=4,
+            decrypt_workers:int=4,
+            plaintext_cache_budget:int=4*2**20):
         # keep a reference to the backend object
         # so that this class instance can call functions
         self.backend = backend
@@ -17,9 +36,61 @@ class Client(object):
         self.key_database = database.EncryptedDatabase(
             filename="./resources/data/stored_keys.db",
             key=self.unique_sym_key)
-        self.handshake_manager = e2e_handshakes.ClientsideHandshakeManager(self.key_database)
+        # RSA key pairs for new chats and handshakes are generated
+        # in the background, so taking one doesn't freeze the client.
+        # New chats use X25519, so the pool only starts filling once
+        # an RSA chat needs a pair, and a depth of 0 turns it off
+        self.key_pool = key_pool.KeyPairPool(key_pool_depth)
+        self.handshake_manager = e2e_handshakes.ClientsideHandshakeManager(
+            self.key_database, self.key_pool)
         self.handshake_manager.loadEncryptionKeys()
+        # searchable index of the messages decrypted so far,
+        # encrypted with the same key as the stored keys
+        self.message_index = database.MessageIndexDatabase(
+            filename="./resources/data/message_index.db",
+            key=self.unique_sym_key)
+        atexit.register(self.saveMessageIndex)
         self.uuid = None
+        # chat uuid: [lowest, highest] sequence ids of the
+        # unbroken range of messages received for the chat
+        self.loaded_seqs = {}
+        # chat uuid: file each chat is being exported to
+        self.exports = {}
+        # chat uuid: chat data, for the chats received so
+        # far, and the version of the list they're from,
+        # so later requests only fetch the chats that changed
+        self.chats = {}
+        self.chats_version = None
+        # chat uuid: the chat's epoch keys as wrapped by the
+        # server, and the epoch new messages are sealed with
+        # (-1 when the chat needs a new epoch key)
+        self.epoch_keys = {}
+        self.chat_epochs = {}
+        # chat uuid: (epoch, key) offered to the server as the
+        # chat's next epoch key, and the messages waiting to
+        # be sealed with it once it's accepted
+        self.pending_epoch_keys = {}
+        self.pending_sends = {}
+        # packets are decrypted in parallel (the cryptography
+        # library releases the GIL), and their text is kept
+        # by packet digest, so reopening a chat doesn't
+        # decrypt the same packets again
+        self.decrypt_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=decrypt_workers, thread_name_prefix='decrypt')
+        self.plaintext_cache = lru_cache.LRUCache(plaintext_cache_budget, len)
+    
+    def resetAccountState(self):
+        """
+        Forget what was received for the account logged
+        in before, so it isn't mixed into the next one's
+        """
+        self.loaded_seqs = {}
+        self.chats = {}
+        self.chats_version = None
+        self.epoch_keys = {}
+        self.chat_epochs = {}
+        self.pending_epoch_keys = {}
+        self.pending_sends = {}
     
     def connectToServer(self, address):
         self.eb_client.connect_to(address)
@@ -58,13 +129,140 @@ class Client(object):
             return None
         return packet.payload.decode()
     
+    def sealTextToPacket(self, text, chat_uuid:str, epoch:int):
+        encryption_key_id = 'c_'+chat_uuid
+        key = self.handshake_manager.getEpochKey(
+            encryption_key_id, epoch, self.epoch_keys.get(chat_uuid, None))
+        if key == None:
+            return None
+        packet = SealedPacket(text.encode(), encryption_key_id, epoch)
+        packet.encrypt(key)
+        return packet
+    
+    def openPacketToText(self, packet:SealedPacket, chat_uuid:str):
+        key = self.handshake_manager.getEpochKey(
+            'c_'+chat_uuid, packet.epoch, self.epoch_keys.get(chat_uuid, None))
+        if key == None:
+            return None
+        try:
+            packet.decrypt(key)
+        except:
+            return None
+        return packet.payload.decode()
+    
+    def getPacketDigest(self, packet, chat_uuid:str):
+        """
+        Get the digest a packet's text is cached under.
+        It covers the chat and key ids too, so the same
+        packet given for another chat isn't trusted
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(chat_uuid.encode())
+        if type(packet) == SealedPacket:
+            digest.update(packet.getAssociatedData())
+        elif packet.sym_key != None:
+            digest.update(packet.sym_key)
+        digest.update(packet.payload)
+        return digest.digest()
+    
+    def decryptPackets(self, packets:list, chat_uuid:str):
+        """
+        Decrypt a batch of a chat's packets, returning their
+        text, None for those that couldn't be decrypted.
+        Packets decrypted before come from the cache, and
+        the rest are decrypted in parallel
+        """
+        texts = [None]*len(packets)
+        # (index, digest, packet) of the packets to decrypt
+        uncached = []
+        for i, packet in enumerate(packets):
+            digest = self.getPacketDigest(packet, chat_uuid)
+            text = self.plaintext_cache.get(digest)
+            if text != None:
+                texts[i] = text
+            else:
+                uncached.append((i, digest, packet))
+        if len(uncached) == 0:
+            return texts
+        
+        # unwrapping an epoch key saves the key database, and
+        # the chat's key pair is parsed when first used, so
+        # that's done here rather than by the workers
+        encryption_key_id = 'c_'+chat_uuid
+        self.handshake_manager.encryption_keys.get(encryption_key_id, None)
+        epochs = set(packet.epoch for _, _, packet in uncached
+            if type(packet) == SealedPacket)
+        for epoch in epochs:
+            self.handshake_manager.getEpochKey(
+                encryption_key_id, epoch, self.epoch_keys.get(chat_uuid, None))
+        
+        def decrypt(packet):
+            if type(packet) == SealedPacket:
+                return self.openPacketToText(packet, chat_uuid)
+            # sent before the chat had epoch keys
+            return self.decryptPacketToText(packet, encryption_key_id)
+        
+        uncached_packets = [packet for _, _, packet in uncached]
+        if len(uncached) < self.PARALLEL_DECRYPT_MIN:
+            results = map(decrypt, uncached_packets)
+        else:
+            results = self.decrypt_pool.map(decrypt, uncached_packets)
+        for (i, digest, packet), text in zip(uncached, results):
+            texts[i] = text
+            if text != None:
+                self.plaintext_cache.put(digest, text)
+        return texts
+    
+    def updateEpochKeys(self, chat_uuid:str, epoch_keys:list, epoch:int=None):
+        """
+        Keep the newest wrapped epoch keys sent for a chat,
+        and the epoch to seal new messages with
+        """
+        if epoch_keys != None and \
+                len(epoch_keys) >= len(self.epoch_keys.get(chat_uuid, [])):
+            self.epoch_keys[chat_uuid] = epoch_keys
+        if epoch != None:
+            self.chat_epochs[chat_uuid] = epoch
+    
+    def requestRotateEpochKey(self, chat_uuid:str):
+        """
+        Offer the server a new epoch key for a chat, when
+        it has none yet or its participants changed.
+        Returns False if the chat's key pair is missing
+        """
+        result = self.handshake_manager.createEpochKey('c_'+chat_uuid)
+        if result == None:
+            return False
+        key, wrapped_key = result
+        epoch = len(self.epoch_keys.get(chat_uuid, []))
+        self.pending_epoch_keys[chat_uuid] = (epoch, key)
+        n_event = ebsocket_event("REQUEST_ADD_EPOCH_KEY",
+            chat_uuid=chat_uuid, epoch=epoch, wrapped_key=wrapped_key)
+        self.eb_client.send_event(n_event)
+        return True
+    
     def requestLoadChatsList(self):
         """
         Initiate a request with the server to get
         all of the chat uuids (and names) that
         this user participates in
         """
-        n_event = ebsocket_event("REQUEST_CHATS_LIST")
+        n_event = ebsocket_event("REQUEST_CHATS_LIST",
+            since_version=self.chats_version)
+        self.eb_client.send_event(n_event)
+    
+    def requestCatchUp(self):
+        """
+        Initiate a request with the server to get the
+        chats that changed and every message missed
+        since the last ones received, e.g. after
+        reconnecting
+        """
+        positions = {chat_uuid: loaded_seqs[1]
+            for chat_uuid, loaded_seqs in self.loaded_seqs.items()}
+        n_event = ebsocket_event("REQUEST_CATCH_UP",
+            since_version=self.chats_version,
+            positions=positions)
         self.eb_client.send_event(n_event)
     
     def requestGetInitialMessages(self, chat_uuid:str):
@@ -86,13 +284,54 @@ class Client(object):
             chat_uuid=chat_uuid, messages_page=messages_page)
         self.eb_client.send_event(n_event)
     
-    def requestSendMessage(self, chat_uuid:str, content:str):
+    def requestGetMessagesBySeq(
+            self,
+            chat_uuid:str,
+            before_seq:int=None,
+            after_seq:int=None,
+            limit:int=None):
+        """
+        Initiate a request with the server to get up
+        to limit messages of a chat, just before
+        before_seq or just after after_seq
+        """
+        n_event = ebsocket_event("REQUEST_GET_MESSAGES",
+            chat_uuid=chat_uuid,
+            before_seq=before_seq,
+            after_seq=after_seq,
+            limit=limit)
+        self.eb_client.send_event(n_event)
+    
+    def requestOlderMessages(self, chat_uuid:str, limit:int=None):
+        """
+        Request the messages just before the
+        oldest one received for a chat
+        """
+        loaded_seqs = self.loaded_seqs.get(chat_uuid, None)
+        if loaded_seqs == None:
+            self.requestGetInitialMessages(chat_uuid)
+        elif loaded_seqs[0] > 0:
+            self.requestGetMessagesBySeq(
+                chat_uuid, before_seq=loaded_seqs[0], limit=limit)
+    
+    def requestSendMessage(self, chat_uuid:str, content:str, can_rotate:bool=True):
         """
         Initiate a request with the server to send
-        a message from one client to others
+        a message from one client to others.
+        Messages are sealed with the chat's current
+        epoch key, and if the chat needs a new one,
+        wait for it to be accepted by the server
         """
-        encryption_key_id = 'c_'+chat_uuid
-        packet = self.encryptTextToPacket(content, encryption_key_id)
+        if chat_uuid in self.pending_sends:
+            self.pending_sends[chat_uuid].append(content)
+            return
+        packet = None
+        epoch = self.chat_epochs.get(chat_uuid, -1)
+        if epoch != -1:
+            packet = self.sealTextToPacket(content, chat_uuid, epoch)
+        if packet == None and can_rotate and self.requestRotateEpochKey(chat_uuid):
+            self.pending_sends[chat_uuid] = [content]
+            return
         if packet == None:
             # encryption of text failed, possibly missing enc key?
             logging.warn(f'encrypting message to send failed. Maybe missing encryption key?')
@@ -101,6 +340,38 @@ class Client(object):
             chat_uuid=chat_uuid, message_content=packet)
         self.eb_client.send_event(n_event)
     
+    def searchMessages(self, query:str, get_max:int=50):
+        """
+        Search the messages decrypted on this device.
+        Returns (chat uuid, seq) of each message found,
+        which can be fetched with requestGetMessagesBySeq
+        """
+        return self.message_index.search(query, get_max)
+    
+    def saveMessageIndex(self):
+        self.message_index.saveIfModified()
+    
+    def onIdle(self):
+        """
+        Called regularly while no events are arriving,
+        for work that's put off until things are quiet
+        """
+        self.message_index.saveIfIdle(self.INDEX_SAVE_IDLE)
+    
+    def requestExportChat(self, chat_uuid:str, filepath:str):
+        """
+        Initiate a request with the server to stream every
+        message of a chat, which are decrypted and written
+        to filepath (one json object per line) as they arrive
+        """
+        if chat_uuid in self.exports:
+            return False
+        self.exports[chat_uuid] = open(filepath, 'w', encoding='utf-8')
+        n_event = ebsocket_event("REQUEST_EXPORT_CHAT",
+            chat_uuid=chat_uuid)
+        self.eb_client.send_event(n_event)
+        return True
+    
     def requestSearchForUsers(self, query:str, get_max:int, result_action:str):
         """
         Initiate a request with the server to search
@@ -110,9 +381,14 @@ class Client(object):
             query=query, get_max=get_max, result_action=result_action)
         self.eb_client.send_event(n_event)
     
-    def requestCreateChat(self, chat_name:str, participants:list):
+    def requestCreateChat(self, chat_name:str, participants:list, key_suite:str='x25519'):
+        """
+        Initiate a request with the server to create a
+        chat, whose keys use key_suite (see crypto.KEY_SUITES)
+        """
         n_event = ebsocket_event("REQUEST_CREATE_CHAT",
-            chat_name=chat_name, participants=participants)
+            chat_name=chat_name, participants=participants,
+            key_suite=key_suite)
         self.eb_client.send_event(n_event)
 
     def processServerEvent(self, event):
@@ -124,34 +400,53 @@ class Client(object):
         if event.event == 'LOGIN_RESULT':
             success = event.success
             if success:
-                self.backend.eventLoginSuccess()
+                self.resetAccountState()
                 self.uuid = event.uuid
+                self.backend.eventLoginSuccess()
             else:
                 self.backend.eventLoginFail()
         elif event.event == 'SIGN_UP_RESULT':
             success = event.success
             if success:
-                self.backend.eventSignUpSuccess()
+                self.resetAccountState()
                 self.uuid = event.uuid
+                self.backend.eventSignUpSuccess()
             else:
                 self.backend.eventSignUpFail()
         
         elif event.event == 'REQUEST_CHATS_LIST_FILLED':
-            chats = event.chats
+            changed_chats = event.chats
+            for chat_data in changed_chats:
+                self.updateEpochKeys(
+                    chat_data['uuid'],
+                    chat_data.get('epoch_keys', None),
+                    chat_data.get('epoch', None))
+            chats = self.mergeChatsList(
+                changed_chats,
+                event.get_attribute('version'),
+                event.get_attribute('is_delta'))
             self.backend.requestLoadChatsListFilled(chats)
-            for chat_data in chats:
+            # chats that haven't changed were checked already
+            for chat_data in changed_chats:
                 process_extra_events.append({
                     "action": "check_chat_e2e_keys",
                     "chat_data": chat_data})
         elif event.event == 'NEW_CHAT_CREATED':
             chat_data = event.chat_data
+            self.chats[chat_data['uuid']] = chat_data
+            self.updateEpochKeys(
+                chat_data['uuid'],
+                chat_data.get('epoch_keys', None),
+                chat_data.get('epoch', None))
             self.backend.newChatCreated(chat_data)
             process_extra_events.append({
                 "action": "check_chat_e2e_keys",
                 "chat_data": chat_data})
         
         elif event.event == 'REQUEST_INITIAL_MESSAGES_FILLED':
-            messages = event.messages
+            messages = self.getEventMessages(event)
+            self.updateEpochKeys(event.chat_uuid, event.get_attribute('epoch_keys'))
+            self.trackMessageSeqs(event.chat_uuid, messages, initial=True)
             self.preprocessMessages(messages, event.chat_uuid)
             self.backend.requestGetInitialMessagesFilled({
                 "initial": True,
@@ -159,26 +454,102 @@ class Client(object):
                 'loaded_to_page': event.loaded_to_page,
                 "messages": messages})
         elif event.event == 'REQUEST_GET_MESSAGES_FILLED':
-            messages = event.messages
+            messages, is_new = self.trackMessageSeqs(
+                event.chat_uuid, self.getEventMessages(event))
+            self.updateEpochKeys(event.chat_uuid, event.get_attribute('epoch_keys'))
             self.preprocessMessages(messages, event.chat_uuid)
             self.backend.requestGetMessagesFilled({
                 "initial": False,
+                "is_new": is_new,
                 "chat_uuid": event.chat_uuid,
                 'loaded_to_page': event.loaded_to_page,
                 "messages": messages})
+            process_extra_events.append({
+                "action": "check_missing_messages",
+                "chat_uuid": event.chat_uuid,
+                "last_seq": event.get_attribute('last_seq')})
         
         elif event.event == 'REQUEST_SEND_MESSAGE_FILLED':
             print("Client detected event forwarded from server by other client.")
-            messages = [event.message]
+            messages, is_new = self.trackMessageSeqs(event.chat_uuid, [event.message])
             self.preprocessMessages(messages, event.chat_uuid)
-            self.backend.requestGetMessagesFilled({
-                "initial": False,
-                "requested": False,
-                "is_new": True,
+            if len(messages) > 0:
+                self.backend.requestGetMessagesFilled({
+                    "initial": False,
+                    "requested": False,
+                    "is_new": True,
+                    "chat_uuid": event.chat_uuid,
+                    'loaded_to_page': event.loaded_to_page,
+                    "messages": messages})
+            process_extra_events.append({
+                "action": "check_missing_messages",
                 "chat_uuid": event.chat_uuid,
-                'loaded_to_page': event.loaded_to_page,
-                "messages": messages})
+                "last_seq": event.get_attribute('last_seq')})
             
+        elif event.event == 'CATCH_UP_BATCH':
+            for chat_batch in event.chats:
+                chat_uuid = chat_batch['chat_uuid']
+                messages = []
+                for data in chat_batch['messages_data']:
+                    messages.extend(pickle.loads(data))
+                self.updateEpochKeys(chat_uuid, chat_batch.get('epoch_keys', None))
+                messages, is_new = self.trackMessageSeqs(chat_uuid, messages)
+                self.preprocessMessages(messages, chat_uuid)
+                if len(messages) > 0:
+                    self.backend.requestGetMessagesFilled({
+                        "initial": False,
+                        "requested": False,
+                        "is_new": is_new,
+                        "chat_uuid": chat_uuid,
+                        'loaded_to_page': None,
+                        "messages": messages})
+                process_extra_events.append({
+                    "action": "check_missing_messages",
+                    "chat_uuid": chat_uuid,
+                    "last_seq": chat_batch['last_seq']})
+            # let the server send the next batch
+            self.eb_client.send_event(ebsocket_event("CATCH_UP_ACK"))
+        elif event.event == 'CATCH_UP_DONE':
+            self.saveMessageIndex()
+        
+        elif event.event == 'EXPORT_CHAT_CHUNK':
+            # one chunk of a streamed export, written out
+            # as soon as it arrives
+            chat_uuid = event.chat_uuid
+            export_file = self.exports.get(chat_uuid, None)
+            if export_file != None:
+                if event.stream_end:
+                    export_file.close()
+                    del self.exports[chat_uuid]
+                    logging.debug(f'finished exporting chat {chat_uuid}')
+                else:
+                    messages = pickle.loads(event.data)
+                    self.updateEpochKeys(chat_uuid, event.get_attribute('epoch_keys'))
+                    self.preprocessMessages(messages, chat_uuid)
+                    for message in messages:
+                        export_file.write(json.dumps({
+                            'seq': message['seq'],
+                            'time': message['time_str'],
+                            'sender': message['sender_name'],
+                            'content': message['content']})+'\n')
+        
+        elif event.event == 'REQUEST_ADD_EPOCH_KEY_FILLED':
+            # the server took the epoch key offered, or another
+            # participant's, which is used instead
+            chat_uuid = event.chat_uuid
+            offered = self.pending_epoch_keys.pop(chat_uuid, None)
+            if event.success and offered != None:
+                epoch, key = offered
+                self.handshake_manager.addEpochKey('c_'+chat_uuid, epoch, key)
+            self.updateEpochKeys(chat_uuid, event.epoch_keys, event.epoch)
+            # only offer a key again if the chat still needs
+            # one, rather than retrying one that can't be used
+            for content in self.pending_sends.pop(chat_uuid, []):
+                self.requestSendMessage(
+                    chat_uuid, content, can_rotate=event.epoch == -1)
+        elif event.event == 'EPOCH_KEY_ADDED':
+            self.updateEpochKeys(event.chat_uuid, event.epoch_keys, event.epoch)
+        
         elif event.event == 'REQUEST_SEARCH_FOR_USERS_FILLED':
             self.backend.requestSearchForUsersFilled({
                 'results': event.results,
@@ -186,7 +557,8 @@ class Client(object):
         
         elif event.event == 'CREATE_NEW_KEYS':
             encryption_key_id = event.encryption_key_id
-            self.handshake_manager.createKeyPair(encryption_key_id)
+            self.handshake_manager.createKeyPair(
+                encryption_key_id, event.get_attribute('key_suite') or 'rsa')
 
         elif event.event == 'E2E_HANDSHAKE':
             result = self.handshake_manager.process(event)
@@ -199,6 +571,21 @@ class Client(object):
                 self.eb_client.send_event(event['event'])
             elif action == 'save_encryption_keys':
                 self.handshake_manager.saveEncryptionKeys()
+            elif action == 'check_missing_messages':
+                # fetch any messages between the newest one
+                # received and the newest one on the server
+                chat_uuid = event['chat_uuid']
+                loaded_seqs = self.loaded_seqs.get(chat_uuid, None)
+                last_seq = event['last_seq']
+                if loaded_seqs != None and last_seq != None and \
+                        loaded_seqs[1] < last_seq:
+                    logging.debug(
+                        f'messages {loaded_seqs[1]+1} to {last_seq} '\
+                        f'of chat {chat_uuid} are missing, requesting them')
+                    self.requestGetMessagesBySeq(
+                        chat_uuid,
+                        after_seq=loaded_seqs[1],
+                        limit=last_seq-loaded_seqs[1])
             elif action == 'check_chat_e2e_keys':
                 chat_data = event['chat_data']
                 chat_uuid = chat_data['uuid']
@@ -215,24 +602,103 @@ class Client(object):
                 else:
                     logging.debug('keys found')
 
+    def getEventMessages(self, event):
+        """
+        Get the messages sent with a messages event,
+        which come as pickled lists of messages
+        """
+        messages_data = event.get_attribute('messages_data')
+        if messages_data == None:
+            return event.messages
+        messages = []
+        for data in messages_data:
+            messages.extend(pickle.loads(data))
+        return messages
+    
+    def mergeChatsList(self, changed_chats:list, version:int, is_delta:bool):
+        """
+        Merge the chats sent by the server into those
+        received before, returning the whole list,
+        most recently active first
+        """
+        if not is_delta:
+            self.chats = {}
+        for chat_data in changed_chats:
+            self.chats[chat_data['uuid']] = chat_data
+        self.chats_version = version
+        if not is_delta:
+            # already in order
+            return list(changed_chats)
+        return sorted(
+            self.chats.values(),
+            key=lambda chat_data: chat_data.get('last_message_ts', 0),
+            reverse=True)
+    
+    def trackMessageSeqs(self, chat_uuid:str, messages:list, initial:bool=False):
+        """
+        Keep track of the range of sequence ids received
+        for a chat. Removes messages already received from
+        the list, and any past a gap, which are requested
+        again once the gap is filled. Returns the messages
+        and whether they're newer than those received before
+        """
+        seqs = [message.get('seq', None) for message in messages]
+        if len(messages) == 0 or None in seqs:
+            # from a server without sequence ids
+            return messages, False
+        if initial or not chat_uuid in self.loaded_seqs:
+            self.loaded_seqs[chat_uuid] = [min(seqs), max(seqs)]
+            return messages, False
+        loaded_seqs = self.loaded_seqs[chat_uuid]
+        highest_seq = loaded_seqs[1]
+        kept = []
+        for message in sorted(messages, key=lambda message: message['seq']):
+            seq = message['seq']
+            if seq == loaded_seqs[1]+1:
+                loaded_seqs[1] = seq
+            elif seq > loaded_seqs[1]:
+                # there's a gap before this message
+                break
+            elif seq >= loaded_seqs[0]:
+                # already received
+                continue
+            kept.append(message)
+        # older messages are only kept if they reach the range
+        lowest_seq = loaded_seqs[0]
+        older = [message for message in kept if message['seq'] < lowest_seq]
+        for message in reversed(older):
+            if message['seq'] != loaded_seqs[0]-1:
+                kept.remove(message)
+                continue
+            loaded_seqs[0] = message['seq']
+        messages[:] = kept
+        is_new = len(kept) > 0 and kept[-1]['seq'] > highest_seq
+        return messages, is_new
+
     def preprocessMessages(self, messages:list, chat_uuid:str):
+        # the offset is the same for the whole batch
+        utc_offset = utilities.Time.getUTCOffset()
+        # messages with encrypted content
+        encrypted = []
         # convert timestamps into text
         for message in messages:
+            message['is_own'] = message['sender_uuid'] == self.uuid
             # get local message time
             timestamp = message['timestamp']
-            datetime = utilities.Time.UTCToLocal(timestamp)
+            datetime = utilities.Time.UTCToLocal(timestamp, utc_offset)
             message['time_str'] = str(datetime)
-
-            # decrypt message content here too!
-            # only decrypt if not from server?
-            content_type = type(message['content'])
-            print("preprocessMessages -> type(message['content']) =", content_type)
-            if content_type == DataPacket:
-                encryption_key_id = 'c_'+chat_uuid
-                print('processing DataPacket message content')
-                packet = message['content']
-                content_text = self.decryptPacketToText(packet, encryption_key_id)
-                if content_text == None:
-                    message['content'] = '???'
-                else:
-                    message['content'] = content_text
+            # messages from the server aren't encrypted
+            if type(message['content']) in (DataPacket, SealedPacket):
+                encrypted.append(message)
+        
+        # decrypt message content, as one batch
+        content_texts = self.decryptPackets(
+            [message['content'] for message in encrypted], chat_uuid)
+        for message, content_text in zip(encrypted, content_texts):
+            if content_text == None:
+                message['content'] = '???'
+            else:
+                message['content'] = content_text
+                seq = message.get('seq', None)
+                if seq != None:
+                    self.message_index.addMessage(chat_uuid, seq, content_text)
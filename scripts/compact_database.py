@@ -0,0 +1,542 @@
+import array
+import collections.abc
+import json
+import logging
+import os
+import random
+import time
+import tracemalloc
+import uuid
+
+from scripts import database
+from scripts import search_index
+
+def encodeUUID(value:str):
+    # much faster than going through uuid.UUID, and
+    # FixedWidthColumn checks the value round trips
+    return bytes.fromhex(value.replace('-', ''))
+
+def decodeUUID(value:bytes):
+    h = value.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+def encodeHexDigest(value:str):
+    return bytes.fromhex(value)
+
+def decodeHexDigest(value:bytes):
+    return value.hex()
+
+class StringColumn(object):
+    """
+    Variable length strings packed one after
+    another into a single utf-8 buffer, with an
+    offset and length per row rather than a str
+    object per row
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array.array('Q')
+        self.lengths = array.array('I')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, value:str):
+        encoded = value.encode()
+        self.offsets.append(len(self.data))
+        self.lengths.append(len(encoded))
+        self.data += encoded
+
+    def get(self, row:int):
+        offset = self.offsets[row]
+        return self.data[offset:offset+self.lengths[row]].decode()
+
+    def set(self, row:int, value:str):
+        # the old value stays in the buffer until
+        # the column is next loaded from a file
+        encoded = value.encode()
+        self.offsets[row] = len(self.data)
+        self.lengths[row] = len(encoded)
+        self.data += encoded
+
+class FixedWidthColumn(object):
+    """
+    Values stored as fixed width binary (e.g. a
+    uuid as 16 bytes) packed into a single buffer.
+
+    Values that wouldn't survive the round trip,
+    like uppercase hex, are kept as they are in a
+    side dict instead, so nothing is ever changed
+    """
+    def __init__(self, width:int, encode, decode):
+        self.width = width
+        self.encode = encode
+        self.decode = decode
+        self.data = bytearray()
+        # row: value, for values that can't be encoded
+        self.irregular = {}
+
+    def __len__(self):
+        return len(self.data)//self.width
+
+    def _encode(self, value):
+        try:
+            encoded = self.encode(value)
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if len(encoded) != self.width or self.decode(encoded) != value:
+            return None
+        return encoded
+
+    def _store(self, row:int, value):
+        encoded = self._encode(value)
+        if encoded == None:
+            self.irregular[row] = value
+            encoded = bytes(self.width)
+        else:
+            self.irregular.pop(row, None)
+        start = row*self.width
+        self.data[start:start+self.width] = encoded
+
+    def append(self, value):
+        self._store(len(self), value)
+
+    def get(self, row:int):
+        if len(self.irregular) > 0 and row in self.irregular:
+            return self.irregular[row]
+        start = row*self.width
+        return self.decode(bytes(self.data[start:start+self.width]))
+
+    def set(self, row:int, value):
+        self._store(row, value)
+
+class HashIndex(object):
+    """
+    Open addressing hash table of row numbers,
+    held in arrays rather than a dict.
+
+    Keys aren't stored, get_key(row) fetches a
+    row's key from the columns while probing,
+    so each row only costs a few bytes. A byte
+    of each key's hash is kept per slot, so that
+    get_key is rarely called for the wrong row
+    """
+    EMPTY = -1
+    REMOVED = -2
+    # grow once two thirds of the slots are taken
+    MAX_LOAD = 2/3
+
+    def __init__(self, get_key, capacity:int=8):
+        self.get_key = get_key
+        self.slots = array.array('i', [self.EMPTY])*capacity
+        self.tags = bytearray(capacity)
+        # rows plus removed markers
+        self.n_used = 0
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, key):
+        return self.find(key) != None
+
+    @staticmethod
+    def _getTag(key_hash:int):
+        return (key_hash >> 32) & 0xff
+
+    def find(self, key):
+        """
+        Get the row stored under key, or None
+        """
+        slots = self.slots
+        tags = self.tags
+        mask = len(slots)-1
+        key_hash = hash(key)
+        tag = self._getTag(key_hash)
+        slot = key_hash & mask
+        while True:
+            row = slots[slot]
+            if row == self.EMPTY:
+                return None
+            if row >= 0 and tags[slot] == tag and self.get_key(row) == key:
+                return row
+            slot = (slot+1) & mask
+
+    def _insert(self, slots, tags, key_hash:int, row:int):
+        mask = len(slots)-1
+        slot = key_hash & mask
+        while slots[slot] >= 0:
+            slot = (slot+1) & mask
+        reused = slots[slot] == self.REMOVED
+        slots[slot] = row
+        tags[slot] = self._getTag(key_hash)
+        return reused
+
+    def add(self, key, row:int):
+        """
+        Store row under key. The key must
+        not already be in the index
+        """
+        if self.n_used+1 > len(self.slots)*self.MAX_LOAD:
+            self.reserve(self.n_rows+1)
+        if not self._insert(self.slots, self.tags, hash(key), row):
+            self.n_used += 1
+        self.n_rows += 1
+
+    def remove(self, key, row:int):
+        slots = self.slots
+        mask = len(slots)-1
+        slot = hash(key) & mask
+        while slots[slot] != self.EMPTY:
+            if slots[slot] == row:
+                slots[slot] = self.REMOVED
+                self.n_rows -= 1
+                return True
+            slot = (slot+1) & mask
+        return False
+
+    def reserve(self, n_rows:int):
+        """
+        Make room for n_rows without growing
+        again, rehashing every row now
+        """
+        capacity = len(self.slots)
+        while n_rows >= capacity*self.MAX_LOAD:
+            capacity *= 2
+        if capacity == len(self.slots) and self.n_used < capacity*self.MAX_LOAD:
+            return
+        slots = array.array('i', [self.EMPTY])*capacity
+        tags = bytearray(capacity)
+        for row in self.slots:
+            if row >= 0:
+                self._insert(slots, tags, hash(self.get_key(row)), row)
+        self.slots = slots
+        self.tags = tags
+        self.n_used = self.n_rows
+
+class UserStore(object):
+    """
+    Column-oriented storage of user accounts.
+
+    Rather than a dict and three str objects per
+    user, usernames are packed into one utf-8
+    buffer, and uuids and password hashes are
+    stored as 16 and 32 raw bytes. Unique fields
+    are looked up through HashIndex arrays.
+    Entries are rebuilt as dicts when requested
+    """
+    def __init__(self, indexed_fields:dict):
+        self.columns = {
+            'username': StringColumn(),
+            'password_hash': FixedWidthColumn(32, encodeHexDigest, decodeHexDigest),
+            'uuid': FixedWidthColumn(16, encodeUUID, decodeUUID)
+        }
+        self.indexed_fields = indexed_fields
+        # field: HashIndex, for each unique indexed field
+        self.indexes = {}
+        for field, s_value in indexed_fields.items():
+            if s_value.unique and not s_value.multi_valued:
+                self.indexes[field] = HashIndex(self._getKeyGetter(field))
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _getKeyGetter(self, field:str):
+        column = self.columns[field]
+        s_value = self.indexed_fields[field]
+        if s_value.match_case:
+            return column.get
+        return lambda row: s_value.getKey(column.get(row))
+
+    def reserve(self, n_rows:int):
+        for index in self.indexes.values():
+            index.reserve(n_rows)
+
+    def getValue(self, row:int, field:str):
+        return self.columns[field].get(row)
+
+    def getEntry(self, row:int):
+        return {field: column.get(row) for field, column in self.columns.items()}
+
+    def hasEveryField(self, entry):
+        for field in self.columns:
+            if not field in entry:
+                return False
+        return True
+
+    def append(self, entry):
+        """
+        Store an entry, returning its row
+        """
+        row = self.n_rows
+        for field, column in self.columns.items():
+            column.append(entry[field])
+        self.n_rows += 1
+        for field, index in self.indexes.items():
+            key = self.indexed_fields[field].getKey(entry[field])
+            if key in index:
+                logging.warning(
+                    f'duplicate value for unique field "{field}": {key}')
+                continue
+            index.add(key, row)
+        return row
+
+    def setValue(self, row:int, field:str, value):
+        index = self.indexes.get(field, None)
+        if index != None:
+            s_value = self.indexed_fields[field]
+            index.remove(s_value.getKey(self.columns[field].get(row)), row)
+            self.columns[field].set(row, value)
+            index.add(s_value.getKey(value), row)
+        else:
+            self.columns[field].set(row, value)
+
+    def findRow(self, field:str, key):
+        return self.indexes[field].find(key)
+
+class EntriesView(collections.abc.Sequence):
+    """
+    Read-only list of the entries in a
+    UserStore, each built when accessed
+    """
+    def __init__(self, store:UserStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self.store.getEntry(i) for i in range(len(self))[row]]
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError(row)
+        return self.store.getEntry(row)
+
+class CompactUserDatabase(database.UserDatabase):
+    """
+    UserDatabase keeping its users in a UserStore
+    instead of a list of dicts, taking a fraction
+    of the memory with millions of accounts
+    (see mainBenchmark).
+
+    Uses the same file format as UserDatabase,
+    so either can open the other's files.
+    Entries returned are copies, so like journal
+    mode, all changes must go through the
+    mutation functions to be stored.
+    """
+    def __init__(self, *args, **kwargs):
+        self.store = None
+        super().__init__(*args, **kwargs)
+
+    def __repr__(self):
+        return f'CompactUserDatabase<{self.filename},{len(self)}>'
+
+    def __len__(self):
+        return len(self.store)
+
+    def _createStore(self):
+        self.store = UserStore(self.indexed_fields)
+        self.indexes = self.store.indexes
+        # the fuzzy search index holds rows rather than entries
+        self.username_index = search_index.UsernameIndex()
+        self.loaded_data = {'entries': EntriesView(self.store)}
+
+    def loadData(self):
+        self._createStore()
+        if self.filename == None:
+            return None
+        with open(self.filename, 'r') as f:
+            data = json.load(f)
+        entries = data.pop('entries')
+        self.store.reserve(len(entries))
+        for entry in entries:
+            self.store.append(entry)
+        del entries
+        self.username_index.addMany(
+            (self.store.getValue(row, 'username'), row)
+            for row in range(len(self.store)))
+        # keep the journal position of the snapshot
+        self.loaded_data.update(data)
+        if self.journal != None:
+            self._replayJournal()
+        self.valid_fields = []
+        if len(self.store) > 0:
+            self.valid_fields = list(self.store.columns)
+        return True
+
+    # ------------------------- saving
+    def _iterateSnapshotText(self, journal_seq:int=None):
+        yield '{"entries": ['
+        for row in range(len(self.store)):
+            if row > 0:
+                yield ', '
+            yield json.dumps(self.store.getEntry(row))
+        yield ']'
+        if journal_seq != None:
+            yield f', "journal_seq": {journal_seq}'
+        yield '}'
+
+    def saveData(self):
+        if self.journal != None:
+            return super().saveData()
+        temp_filename = self.filename+'.tmp'
+        with open(temp_filename, 'w') as f:
+            f.writelines(self._iterateSnapshotText())
+        os.replace(temp_filename, self.filename)
+        self.modified = False
+        return True
+
+    def compactJournal(self, background:bool=True):
+        snapshot_text = ''.join(self._iterateSnapshotText(self.journal.seq))
+        self.journal.compact(self.filename, snapshot_text, background)
+
+    # ------------------------- entries
+    def append(self, entry):
+        is_valid = database.DatabaseUtil.matchEntryToStructure(
+            entry, self.entry_structure)
+        if not is_valid or not self.store.hasEveryField(entry):
+            return False
+        if self._isUniqueValueTaken(entry):
+            return False
+        row = self.store.append(entry)
+        self.username_index.add(entry['username'], row)
+        self._logMutation({'op': 'append', 'entry': entry})
+        self.markModified()
+        return True
+
+    def iterateEntries(self):
+        for row in range(len(self.store)):
+            yield self.store.getEntry(row)
+
+    def _getRow(self, entry):
+        row = self.store.findRow(self.primary_key, entry[self.primary_key])
+        if row == None:
+            raise KeyError(f'entry {entry[self.primary_key]} is not in {self}')
+        return row
+
+    def setEntryField(self, entry, field, value):
+        row = self._getRow(entry)
+        self._logMutation({'op': 'set', 'key': self._getJournalKey(entry),
+            'field': field, 'value': value})
+        if field == 'username':
+            self.username_index.remove(self.store.getValue(row, field))
+            self.username_index.add(value, row)
+        self.store.setValue(row, field, value)
+        entry[field] = value
+        self.markModified()
+
+    def appendToEntryField(self, entry, field, item):
+        raise TypeError('user entries have no list fields')
+
+    def removeFromEntryField(self, entry, field, item):
+        raise TypeError('user entries have no list fields')
+
+    # ------------------------- searching
+    def _findRows(self, field, value, match_case, limit=None):
+        if self._canUseIndex(field, match_case) and field in self.store.indexes:
+            row = self.store.findRow(field, self.indexed_fields[field].getKey(value))
+            if row == None:
+                return []
+            if match_case and self.store.getValue(row, field) != value:
+                return []
+            return [row]
+        rows = []
+        if not field in self.store.columns:
+            return rows
+        if not match_case:
+            value = value.lower()
+        column = self.store.columns[field]
+        for row in range(len(self.store)):
+            row_value = column.get(row)
+            if not match_case:
+                row_value = row_value.lower()
+            if row_value == value:
+                rows.append(row)
+                if limit != None and len(rows) >= limit:
+                    break
+        return rows
+
+    def findEntriesByField(self, field, value, validate_field=False, match_case=True):
+        if validate_field and (not field in self.valid_fields):
+            return []
+        return [self.store.getEntry(row)
+            for row in self._findRows(field, value, match_case)]
+
+    def findEntryByField(self, field, value, validate_field=False, match_case=True):
+        if validate_field and (not field in self.valid_fields):
+            return None
+        rows = self._findRows(field, value, match_case, limit=1)
+        if len(rows) == 0:
+            return None
+        return self.store.getEntry(rows[0])
+
+    def searchByUsername(self, query:str, get_max:int):
+        return [self.store.getEntry(row)
+            for row in self.username_index.search(query, get_max)]
+
+
+def mainBenchmark(sizes=(1000000, 10000000), compare_legacy:bool=True):
+    """
+    Measure the memory used to hold n users
+    (and their lookup indexes) as a list of
+    dicts, like UserDatabase, and in a UserStore.
+    The fuzzy search index is the same for both,
+    so it isn't included
+    """
+    random.seed(0)
+    syllables = [a+b for a in 'bcdfghjklmnprstvwz' for b in 'aeiou']
+    def iterateEntries(n_users):
+        for i in range(n_users):
+            name = ''.join(random.choice(syllables) for _ in range(random.randint(2, 4)))
+            yield {
+                'username': f'{name}{i}',
+                'password_hash': random.getrandbits(256).to_bytes(32, 'big').hex(),
+                'uuid': str(uuid.UUID(int=random.getrandbits(128), version=4))
+            }
+    structure = database.UserDatabase().entry_structure
+
+    def measure(name, build, n_users):
+        tracemalloc.start()
+        t = time.perf_counter()
+        store = build(n_users)
+        t = time.perf_counter()-t
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'{name:>8}: {size/2**20:9.1f}MiB, '\
+            f'{size/n_users:6.1f} bytes per user, built in {t:.1f}s')
+        return store
+
+    def buildLegacy(n_users):
+        legacy = database.Database(entry_structure=structure)
+        for entry in iterateEntries(n_users):
+            legacy.append(entry)
+        return legacy
+
+    def buildCompact(n_users):
+        store = UserStore(database.Database(entry_structure=structure).indexed_fields)
+        store.reserve(n_users)
+        for entry in iterateEntries(n_users):
+            store.append(entry)
+        return store
+
+    for n_users in sizes:
+        print(f'{n_users} users')
+        if compare_legacy:
+            legacy = measure('dicts', buildLegacy, n_users)
+            del legacy
+        store = measure('columns', buildCompact, n_users)
+        # make sure lookups still work
+        entry = store.getEntry(n_users//2)
+        assert store.findRow('username', entry['username'].lower()) == n_users//2
+        assert store.findRow('uuid', entry['uuid']) == n_users//2
+        del store
+
+
+if __name__ == '__main__':
+    import sys
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    mainBenchmark(sizes or (1000000, 10000000), not '-no-legacy' in sys.argv)
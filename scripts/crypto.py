@@ -27,20 +27,24 @@ class Asymmetric:
 
     # ------------------------- keys to bytes / bytes to keys
     @staticmethod
-    def keyToBytes(key, key_type:int=0):
+    def keyToBytes(key, key_type:int=0, der:bool=False):
         """
-        Convert a key to bytes
+        Convert a key to bytes, PEM or
+        the more compact DER if der is True
         key_type = 0 for public key
         key_type = 1 for private key
         """
+        encoding = serialization.Encoding.PEM
+        if der:
+            encoding = serialization.Encoding.DER
         pem = None
         if key_type == 0:
             pem = key.public_bytes(
-                encoding=serialization.Encoding.PEM,
+                encoding=encoding,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo)
         elif key_type == 1:
             pem = key.private_bytes(
-                encoding=serialization.Encoding.PEM,
+                encoding=encoding,
                 format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption())
         return pem
@@ -48,17 +52,22 @@ class Asymmetric:
     @staticmethod
     def keyFromBytes(bytes, key_type:int=0):
         """
-        Load a key from bytes
+        Load a key from PEM or DER bytes
         key_type = 0 for public key
         key_type = 1 for private key
         """
         key = None
+        is_pem = bytes.startswith(b'-----')
         if key_type == 0:
-            key = serialization.load_pem_public_key(
+            load = serialization.load_pem_public_key if is_pem \
+                else serialization.load_der_public_key
+            key = load(
                 bytes,
                 backend=default_backend())
         elif key_type == 1:
-            key = serialization.load_pem_private_key(
+            load = serialization.load_pem_private_key if is_pem \
+                else serialization.load_der_private_key
+            key = load(
                 bytes,
                 password=None,
                 backend=default_backend())
@@ -136,6 +145,9 @@ import os
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 class Symmetric:
     """
@@ -176,6 +188,135 @@ class Symmetric:
         decrypted = fernet.decrypt(bytes)
         return decrypted
 
+class AEAD:
+    """
+    Authenticated symmetric encryption
+    (ChaCha20-Poly1305), cheap enough to
+    use for every message under one key
+    """
+    NONCE_SIZE = 12
+
+    # ------------------------- key generation
+    @staticmethod
+    def createKey():
+        """
+        Generate a random 32 byte key
+        """
+        return ChaCha20Poly1305.generate_key()
+    
+    # ------------------------- encrypt / decrypt bytes
+    @staticmethod
+    def encryptBytes(bytes, key, associated_data:bytes=None):
+        """
+        Encrypt bytes using a key, returning the
+        random nonce followed by the ciphertext.
+        associated_data isn't encrypted, but
+        decrypting fails if it doesn't match
+        """
+        nonce = os.urandom(AEAD.NONCE_SIZE)
+        return nonce+ChaCha20Poly1305(key).encrypt(nonce, bytes, associated_data)
+    
+    @staticmethod
+    def decryptBytes(bytes, key, associated_data:bytes=None):
+        """
+        Decrypt bytes using a key. Raises
+        cryptography.exceptions.InvalidTag if
+        they were tampered with or the key is wrong
+        """
+        return ChaCha20Poly1305(key).decrypt(
+            bytes[:AEAD.NONCE_SIZE], bytes[AEAD.NONCE_SIZE:], associated_data)
+
+class X25519:
+    """
+    Asymmetric encryption functions using X25519
+    key agreement, with the same interface as
+    Asymmetric. Keys are raw 32 byte strings, and
+    generating them is about a thousand times
+    faster than RSA. Encrypting (ECIES) agrees a
+    key with a new ephemeral key pair, and seals
+    the bytes under it with AEAD
+    """
+    KEY_SIZE = 32
+
+    # ------------------------- key generation
+    @staticmethod
+    def createKeyPair():
+        """
+        Generate a public and private
+        key
+        """
+        private_key = x25519.X25519PrivateKey.generate()
+        return private_key.public_key(), private_key
+
+    # ------------------------- keys to bytes / bytes to keys
+    @staticmethod
+    def keyToBytes(key, key_type:int=0):
+        """
+        Convert a key to its raw 32 bytes
+        key_type = 0 for public key
+        key_type = 1 for private key
+        """
+        if key_type == 0:
+            return key.public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw)
+        elif key_type == 1:
+            return key.private_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PrivateFormat.Raw,
+                encryption_algorithm=serialization.NoEncryption())
+        return None
+    
+    @staticmethod
+    def keyFromBytes(bytes, key_type:int=0):
+        """
+        Load a key from its raw 32 bytes
+        key_type = 0 for public key
+        key_type = 1 for private key
+        """
+        if key_type == 0:
+            return x25519.X25519PublicKey.from_public_bytes(bytes)
+        elif key_type == 1:
+            return x25519.X25519PrivateKey.from_private_bytes(bytes)
+        return None
+
+    # ------------------------- encrypt / decrypt bytes
+    @staticmethod
+    def _deriveKey(shared_secret, ephemeral_public_bytes, public_bytes):
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'x25519-ecies'+ephemeral_public_bytes+public_bytes
+        ).derive(shared_secret)
+
+    @staticmethod
+    def encryptBytes(bytes, public_key):
+        """
+        Encrypt bytes using key, returning the
+        ephemeral public key and the sealed bytes
+        """
+        ephemeral_public, ephemeral_private = X25519.createKeyPair()
+        ephemeral_public_bytes = X25519.keyToBytes(ephemeral_public, 0)
+        key = X25519._deriveKey(
+            ephemeral_private.exchange(public_key),
+            ephemeral_public_bytes,
+            X25519.keyToBytes(public_key, 0))
+        return ephemeral_public_bytes+AEAD.encryptBytes(bytes, key)
+    
+    @staticmethod
+    def decryptBytes(bytes, private_key):
+        """
+        Decrypt bytes using key
+        """
+        ephemeral_public_bytes = bytes[:X25519.KEY_SIZE]
+        ephemeral_public = X25519.keyFromBytes(ephemeral_public_bytes, 0)
+        key = X25519._deriveKey(
+            private_key.exchange(ephemeral_public),
+            ephemeral_public_bytes,
+            X25519.keyToBytes(private_key.public_key(), 0))
+        return AEAD.decryptBytes(bytes[X25519.KEY_SIZE:], key)
+
 class Hybrid:
     """
     Hybrid encryption functions
@@ -248,6 +389,59 @@ class DataPacket(object):
         self.sym_key = sym_key
         self.encrypted = False               
 
+class SealedPacket(object):
+    """
+    A payload encrypted with a chat's epoch key
+    (see AEAD), rather than with RSA like DataPacket.
+    key_id and epoch say which key it was sealed
+    with, and are authenticated along with it
+    """
+    def __init__(self, payload, key_id:str, epoch:int):
+        self.payload = payload
+        self.key_id = key_id
+        self.epoch = epoch
+        self.encrypted = False
+    
+    def getAssociatedData(self):
+        return f'{self.key_id}/{self.epoch}'.encode()
+    
+    def encrypt(self, key, can_raise_error=False):
+        """
+        Encrypt this packet using an epoch key.
+        *IN-PLACE*
+        """
+        if can_raise_error:
+            assert not self.encrypted, "packet is already encrypted"
+        self.payload = AEAD.encryptBytes(
+            self.payload, key, self.getAssociatedData())
+        self.encrypted = True
+    
+    def decrypt(self, key, can_raise_error=False):
+        """
+        Decrypt this packet using an epoch key.
+        *IN-PLACE*
+        """
+        if can_raise_error:
+            assert self.encrypted, "packet is already decrypted"
+        self.payload = AEAD.decryptBytes(
+            self.payload, key, self.getAssociatedData())
+        self.encrypted = False
+
+
+# key suite name: the class with its key functions.
+# Each chat uses one, chosen when it's created
+KEY_SUITES = {
+    'rsa': Asymmetric,
+    'x25519': X25519
+}
+
+def getKeySuite(key):
+    """
+    Get the name of the key suite a key belongs to
+    """
+    if isinstance(key, (x25519.X25519PublicKey, x25519.X25519PrivateKey)):
+        return 'x25519'
+    return 'rsa'
 
 def mainTest():
 
@@ -1,11 +1,136 @@
 import json
+import os
 import pickle
+import time
 
 from scripts import crypto
+from scripts import journal as journal_module
+from scripts import search_index
 from scripts import utilities
 
+import logging
 import uuid
 
+class IndexedField(object):
+    """
+    Used in place of a type in a database's
+    entry_structure, to have the database keep
+    an index of entries by that field, so that
+    findEntryByField doesn't scan every entry.
+
+    unique: only one entry may have each value
+    match_case: when False, the index ignores
+        case, so it also serves match_case=False
+        lookups
+    list fields index each item in the list,
+    so lookups find entries containing the value
+    """
+    def __init__(
+            self,
+            value_type:type,
+            unique:bool=False,
+            match_case:bool=True):
+        self.value_type = value_type
+        self.unique = unique
+        self.match_case = match_case
+        self.multi_valued = value_type == list
+    
+    def getKey(self, value):
+        """
+        Get the key a value is stored under
+        """
+        if not self.match_case and isinstance(value, str):
+            return value.lower()
+        return value
+    
+    def getKeys(self, entry_value):
+        """
+        Get every key an entry's value
+        for this field is stored under
+        """
+        if self.multi_valued:
+            return {self.getKey(item) for item in entry_value}
+        return (self.getKey(entry_value),)
+    
+    def __repr__(self):
+        return f'IndexedField<{self.value_type.__name__},{self.unique},{self.match_case}>'
+
+class FlushScheduler(object):
+    """
+    Coalesces database saves (group commit).
+
+    Databases using a scheduler don't save as soon
+    as they're changed, they're marked dirty instead.
+    Once the window has passed since the oldest
+    unsaved change, every dirty database is saved
+    once, however many changes were made to it.
+
+    pump() should be called regularly (e.g. from
+    the server's main loop). flush() is a durability
+    barrier, saving everything that's pending now.
+    """
+    def __init__(self, window:float=0.05):
+        self.window = window
+        # databases waiting to be saved, in order
+        self.dirty = {}
+        self.oldest_change = None
+        self.n_saves = 0
+        self.n_requests = 0
+    
+    def __repr__(self):
+        return f'FlushScheduler<{self.window},{len(self.dirty)}>'
+    
+    def markDirty(self, database):
+        self.n_requests += 1
+        if len(self.dirty) == 0:
+            self.oldest_change = time.monotonic()
+        self.dirty[database] = True
+    
+    def isDirty(self, database):
+        return database in self.dirty
+    
+    def getTimeout(self, default:float):
+        """
+        How long until pump() next has to
+        save something, at most default
+        """
+        if len(self.dirty) == 0:
+            return default
+        remaining = self.oldest_change+self.window-time.monotonic()
+        return min(default, max(0, remaining))
+    
+    def pump(self):
+        """
+        Save the dirty databases if the
+        window has passed. Returns True
+        if anything was saved
+        """
+        if len(self.dirty) == 0:
+            return False
+        if time.monotonic()-self.oldest_change < self.window:
+            return False
+        self.flush()
+        return True
+    
+    def flush(self, database=None):
+        """
+        Save every dirty database now, or
+        only the one provided
+        """
+        if database != None:
+            if self.dirty.pop(database, None) != None:
+                database.saveData()
+                self.n_saves += 1
+            if len(self.dirty) == 0:
+                self.oldest_change = None
+            return
+        dirty = self.dirty
+        self.dirty = {}
+        self.oldest_change = None
+        for database in dirty:
+            database.saveData()
+            self.n_saves += 1
+
 class DatabaseUtil:
     @staticmethod
     def matchEntryToStructure(entry, structure):
@@ -14,6 +139,8 @@ class DatabaseUtil:
             value = entry[key]
             value_type = type(value)
             s_value = structure.get(key, -1)
+            if isinstance(s_value, IndexedField):
+                s_value = s_value.value_type
             s_value_type = type(s_value)
             # print('vt', value_type, s_value_type)
             if s_value == -1:
@@ -35,25 +162,113 @@ class Database:
 
     Supports searching for entries based on
     provided field.
+
+    With a flush_scheduler, saves requested through
+    requestSave() are grouped into one write per
+    scheduler window (see FlushScheduler).
+
+    With journal=True, mutations are appended to a
+    journal file instead of the whole file being
+    rewritten on every save (see scripts/journal.py).
+    Journal mode needs a unique, case sensitive
+    indexed field to identify entries by, and all
+    changes must go through the mutation functions.
     """
     def __init__(
             self,
             filename:str=None,
             entry_structure:dict=None,
-            load_immediately:bool=True
+            load_immediately:bool=True,
+            journal:bool=False,
+            fsync_policy:str=journal_module.Journal.FSYNC_ALWAYS,
+            compact_after:int=10000,
+            flush_scheduler:FlushScheduler=None
         ):
         self.filename = filename
         self.entry_structure = entry_structure
         self.valid_fields = []
+        self.modified = False
+        self.flush_scheduler = flush_scheduler
+        # field: IndexedField, for each field
+        # declared as indexed in entry_structure
+        self.indexed_fields = {}
+        if self.entry_structure != None:
+            for field, s_value in self.entry_structure.items():
+                if isinstance(s_value, IndexedField):
+                    self.indexed_fields[field] = s_value
+        # field: {key: entry} for unique fields, or
+        # field: {key: {id(entry): entry}} otherwise
+        self.indexes = {}
+        # field used to identify entries in the journal
+        self.primary_key = None
+        for field, s_value in self.indexed_fields.items():
+            if s_value.unique and s_value.match_case:
+                self.primary_key = field
+                break
+        self.journal = None
+        self.replaying_journal = False
+        if journal:
+            assert self.filename != None, "journal mode requires a filename"
+            assert self.primary_key != None, \
+                "journal mode requires a unique, case sensitive indexed field"
+            self.journal = journal_module.Journal(
+                self.filename+'.journal',
+                fsync_policy=fsync_policy,
+                compact_after=compact_after)
 
         if load_immediately:
             self.loadData()
     
     def saveData(self):
-        with open(self.filename, 'w') as f:
+        if self.journal != None:
+            # the mutations are already in the journal,
+            # they just need to reach the disk
+            self.journal.sync()
+            if self.journal.shouldCompact():
+                self.compactJournal()
+            self.modified = False
+            return True
+        # write to a temporary file first, so a crash
+        # mid-write can't leave a half-written database
+        temp_filename = self.filename+'.tmp'
+        with open(temp_filename, 'w') as f:
             json.dump(self.loaded_data, f)
+        os.replace(temp_filename, self.filename)
+        self.modified = False
         return True
     
+    def markModified(self):
+        """
+        Mark the database as changed. With a flush
+        scheduler, it will be saved with the next
+        group commit
+        """
+        self.modified = True
+        if self.flush_scheduler != None:
+            self.flush_scheduler.markDirty(self)
+    
+    def requestSave(self):
+        """
+        Save the database. With a flush scheduler the
+        save is deferred and grouped with any others
+        made within the scheduler's window
+        """
+        if self.flush_scheduler == None:
+            return self.saveData()
+        self.markModified()
+        return True
+    
+    def saveNow(self):
+        """
+        Durability barrier: save the database now,
+        including any changes waiting to be flushed
+        """
+        if self.flush_scheduler != None:
+            self.flush_scheduler.flush(self)
+            if not self.modified:
+                return True
+        return self.saveData()
+    
     def _loadDataGetFile(self):
         with open(self.filename, 'r') as f:
             self.loaded_data = json.load(f)
@@ -61,8 +276,12 @@ class Database:
     def loadData(self):
         if self.filename == None:
             self.loaded_data = {'entries': []}
+            self.rebuildIndexes()
             return None
         self._loadDataGetFile()
+        self.rebuildIndexes()
+        if self.journal != None:
+            self._replayJournal()
         self.valid_fields = []
         for entry in self.loaded_data['entries']:
             for field in entry:
@@ -70,18 +289,236 @@ class Database:
                     self.valid_fields.append(field)
         return True
     
+    # ------------------------- journal
+    def _replayJournal(self):
+        """
+        Apply every journal record newer than the
+        loaded snapshot on top of it
+        """
+        snapshot_seq = self.loaded_data.pop('journal_seq', 0)
+        records = self.journal.readRecords(snapshot_seq)
+        self.replaying_journal = True
+        try:
+            for record in records:
+                self._applyJournalRecord(record)
+        finally:
+            self.replaying_journal = False
+        logging.debug(
+            f'replayed {len(records)} journal records '\
+            f'on top of {self.filename}')
+        if self.journal.needsRecovery():
+            # the last compaction was interrupted
+            self.compactJournal(background=False)
+    
+    def _applyJournalRecord(self, record):
+        op = record['op']
+        if op == 'append':
+            self.append(record['entry'])
+            return
+        entry = self.findEntryByField(self.primary_key, record['key'])
+        if entry == None:
+            logging.warning(
+                f'journal record {record["seq"]} refers to a missing '\
+                f'entry {record["key"]} in {self.filename}')
+            return
+        if op == 'set':
+            self.setEntryField(entry, record['field'], record['value'])
+        elif op == 'add':
+            self.appendToEntryField(entry, record['field'], record['item'])
+        elif op == 'remove':
+            self.removeFromEntryField(entry, record['field'], record['item'])
+    
+    def _logMutation(self, record:dict):
+        if self.journal == None or self.replaying_journal:
+            return
+        self.journal.write(record)
+    
+    def _getJournalKey(self, entry):
+        if self.journal == None:
+            return None
+        return entry[self.primary_key]
+    
+    def compactJournal(self, background:bool=True):
+        """
+        Write a new snapshot including everything in
+        the journal, then empty the journal. The file
+        is written in a background thread by default
+        """
+        snapshot = dict(self.loaded_data)
+        snapshot['journal_seq'] = self.journal.seq
+        snapshot_text = json.dumps(snapshot)
+        self.journal.compact(self.filename, snapshot_text, background)
+    
+    # ------------------------- indexes
+    def rebuildIndexes(self):
+        """
+        Rebuild every index from scratch.
+        Called whenever the data is loaded
+        """
+        self.indexes = {field: {} for field in self.indexed_fields}
+        for entry in self.loaded_data['entries']:
+            self._addToIndexes(entry)
+    
+    def _addToIndex(self, field, entry):
+        if not field in entry:
+            return
+        s_value = self.indexed_fields[field]
+        index = self.indexes[field]
+        for key in s_value.getKeys(entry[field]):
+            if s_value.unique:
+                if key in index and not index[key] is entry:
+                    logging.warning(
+                        f'duplicate value for unique field '\
+                        f'"{field}" in {self.filename}: {key}')
+                index.setdefault(key, entry)
+            else:
+                index.setdefault(key, {})[id(entry)] = entry
+    
+    def _removeFromIndex(self, field, entry):
+        if not field in entry:
+            return
+        s_value = self.indexed_fields[field]
+        index = self.indexes[field]
+        for key in s_value.getKeys(entry[field]):
+            if s_value.unique:
+                if index.get(key, None) is entry:
+                    del index[key]
+            else:
+                entries = index.get(key, None)
+                if entries == None:
+                    continue
+                entries.pop(id(entry), None)
+                if len(entries) == 0:
+                    del index[key]
+    
+    def _addToIndexes(self, entry):
+        for field in self.indexed_fields:
+            self._addToIndex(field, entry)
+    
+    def _isUniqueValueTaken(self, entry):
+        for field, s_value in self.indexed_fields.items():
+            if not s_value.unique or not field in entry:
+                continue
+            index = self.indexes[field]
+            for key in s_value.getKeys(entry[field]):
+                if key in index:
+                    return True
+        return False
+    
     def append(self, entry):
         """appends a new entry to the database"""
         is_valid = DatabaseUtil.matchEntryToStructure(
             entry, self.entry_structure)
         if not is_valid:
             return False
+        if self._isUniqueValueTaken(entry):
+            return False
         self.loaded_data['entries'].append(entry)
+        self._addToIndexes(entry)
+        self._logMutation({'op': 'append', 'entry': entry})
+        self.markModified()
         return True
     
+    # ------------------------- entry mutation
+    # entries must be changed through these functions
+    # (rather than directly) to keep the indexes correct
+    def setEntryField(self, entry, field, value):
+        """
+        Set the value of one of an entry's fields
+        """
+        self._logMutation({'op': 'set', 'key': self._getJournalKey(entry),
+            'field': field, 'value': value})
+        if field in self.indexed_fields:
+            self._removeFromIndex(field, entry)
+            entry[field] = value
+            self._addToIndex(field, entry)
+        else:
+            entry[field] = value
+        self.markModified()
+    
+    def appendToEntryField(self, entry, field, item):
+        """
+        Append an item to one of an entry's list fields
+        """
+        self._logMutation({'op': 'add', 'key': self._getJournalKey(entry),
+            'field': field, 'item': item})
+        entry[field].append(item)
+        if field in self.indexed_fields:
+            self._addToIndex(field, entry)
+        self.markModified()
+    
+    def removeFromEntryField(self, entry, field, item):
+        """
+        Remove an item from one of an entry's list fields
+        """
+        self._logMutation({'op': 'remove', 'key': self._getJournalKey(entry),
+            'field': field, 'item': item})
+        if field in self.indexed_fields:
+            self._removeFromIndex(field, entry)
+            entry[field].remove(item)
+            self._addToIndex(field, entry)
+        else:
+            entry[field].remove(item)
+        self.markModified()
+    
+    # ------------------------- searching
+    def _canUseIndex(self, field, match_case):
+        s_value = self.indexed_fields.get(field, None)
+        if s_value == None:
+            return False
+        # a case sensitive index can't serve
+        # a case insensitive lookup
+        return match_case or not s_value.match_case
+    
+    def _findEntriesInIndex(self, field, value, match_case):
+        s_value = self.indexed_fields[field]
+        found = self.indexes[field].get(s_value.getKey(value), None)
+        if found == None:
+            return []
+        if s_value.unique:
+            found = [found]
+        else:
+            found = list(found.values())
+        if match_case and not s_value.match_case:
+            # the index ignores case, so only keep exact matches
+            if s_value.multi_valued:
+                found = [entry for entry in found if value in entry[field]]
+            else:
+                found = [entry for entry in found if entry[field] == value]
+        return found
+    
+    def findEntriesByField(self, field, value, validate_field=False, match_case=True):
+        """
+        Find every entry with a field matching value.
+        For list fields, finds every entry whose
+        list contains value
+        """
+        if validate_field and (not field in self.valid_fields):
+            return []
+        if self._canUseIndex(field, match_case):
+            return self._findEntriesInIndex(field, value, match_case)
+        if match_case:
+            return [entry for entry in self.loaded_data['entries']
+                if entry.get(field, None) == value]
+        value_lower = value.lower()
+        return [entry for entry in self.loaded_data['entries']
+            if entry.get(field, None) != None and\
+                entry[field].lower() == value_lower]
+    
+    def iterateEntries(self):
+        """
+        Iterate over every entry
+        """
+        yield from self.loaded_data['entries']
+    
     def findEntryByField(self, field, value, validate_field=False, match_case=True):
         if validate_field and (not field in self.valid_fields):
             return None
+        if self._canUseIndex(field, match_case):
+            found = self._findEntriesInIndex(field, value, match_case)
+            if len(found) == 0:
+                return None
+            return found[0]
         if match_case:
             for entry in self.loaded_data['entries']:
                 if entry.get(field, None) == value:
@@ -128,29 +565,175 @@ class EncryptedDatabase(Database):
         f_data = crypto.Symmetric.decryptBytes(f_data_encrypted, self.key)
         self.loaded_data = pickle.loads(f_data)
         return True
+
+
+class MessageIndexDatabase(EncryptedDatabase):
+    """
+    Full-text index of decrypted chat messages
+    (see search_index.MessageIndex), kept on disk
+    encrypted like any EncryptedDatabase.
+    Rather than saving as messages are added, it's
+    saved once they stop (saveIfIdle) and on shutdown
+    (saveIfModified). Those saves only append the new
+    messages' words to filename.segments, as one
+    encrypted line. The whole index is rewritten once
+    the segments hold more than half of its messages,
+    so saving costs about the same per message however
+    big the index gets
+    """
+    def __init__(self, *args, **kwargs):
+        self.index = search_index.MessageIndex()
+        # (chat uuid, seq, words) of each message not saved yet
+        self.unsaved = []
+        # messages saved in segments, not in the whole index
+        self.n_segment_messages = 0
+        # when a message was last added
+        self.modified_time = 0
+        super().__init__(*args, **kwargs)
+    
+    def _getSegmentsFilename(self):
+        return self.filename+'.segments'
+    
+    def loadData(self):
+        result = super().loadData()
+        self.index = search_index.MessageIndex.fromState(
+            self.loaded_data.get('message_index', None))
+        self.unsaved = []
+        self.n_segment_messages = 0
+        if self.filename != None and os.path.exists(self._getSegmentsFilename()):
+            self._loadSegments()
+        return result
+    
+    def _loadSegments(self):
+        with open(self._getSegmentsFilename(), 'r+b') as f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('segment is incomplete')
+                    messages = pickle.loads(
+                        crypto.Symmetric.decryptBytes(line[:-1], self.key))
+                except Exception as e:
+                    # torn by a crash while it was appended,
+                    # so segments appended later stay readable
+                    logging.warning(
+                        f'truncating unreadable segment of {self.filename}: {e}')
+                    f.truncate(offset)
+                    break
+                # messages can also be in the whole index, if there
+                # was a crash before the segments were removed
+                for chat_uuid, seq, words in messages:
+                    self.index.addWords(chat_uuid, seq, words)
+                self.n_segment_messages += len(messages)
+                offset += len(line)
+    
+    def saveData(self):
+        self.loaded_data['message_index'] = self.index.getState()
+        result = super().saveData()
+        # the index only needs to be plain data while saving
+        del self.loaded_data['message_index']
+        if os.path.exists(self._getSegmentsFilename()):
+            os.remove(self._getSegmentsFilename())
+        self.unsaved = []
+        self.n_segment_messages = 0
+        return result
+    
+    def _saveUnsaved(self):
+        n_segment_messages = self.n_segment_messages+len(self.unsaved)
+        if n_segment_messages > len(self.index)//2:
+            self.saveData()
+            return
+        segment = crypto.Symmetric.encryptBytes(pickle.dumps(self.unsaved), self.key)
+        with open(self._getSegmentsFilename(), 'ab') as f:
+            f.write(segment+b'\n')
+        self.unsaved = []
+        self.n_segment_messages = n_segment_messages
+    
+    def addMessage(self, chat_uuid:str, seq:int, text:str):
+        words = search_index.MessageIndex.getWords(text)
+        if not self.index.addWords(chat_uuid, seq, words):
+            return False
+        self.unsaved.append((chat_uuid, seq, list(words)))
+        self.modified_time = time.time()
+        return True
+    
+    def saveIfModified(self):
+        if len(self.unsaved) > 0:
+            self._saveUnsaved()
+    
+    def saveIfIdle(self, idle_after:float):
+        """
+        Save if messages were added, but none
+        in the last idle_after seconds
+        """
+        if len(self.unsaved) > 0 and time.time()-self.modified_time >= idle_after:
+            self._saveUnsaved()
+    
+    def search(self, query:str, get_max:int=50):
+        return self.index.search(query, get_max)
         
 
 class UserDatabase(Database):
     def __init__(self, *args, **kwargs):
         kwargs["entry_structure"] = {
-            "username": str,
+            # usernames are unique regardless of case
+            "username": IndexedField(str, unique=True, match_case=False),
             "password_hash": str,
-            "uuid": str
+            "uuid": IndexedField(str, unique=True)
         }
+        # fuzzy search index over every username,
+        # (re)built whenever the data is loaded
+        self.username_index = search_index.UsernameIndex()
         super().__init__(*args, **kwargs)
         self.findUserByUUID = self.findEntryByUUID
     
+    def loadData(self):
+        result = super().loadData()
+        self.username_index = search_index.UsernameIndex()
+        self.username_index.addMany(
+            (entry['username'], entry) for entry in self.loaded_data['entries'])
+        return result
+    
+    def append(self, entry):
+        if not super().append(entry):
+            return False
+        self.username_index.add(entry['username'], entry)
+        return True
+    
+    def setEntryField(self, entry, field, value):
+        if field == 'username':
+            # so the user is found under their new name only
+            self.username_index.remove(entry['username'])
+        super().setEntryField(entry, field, value)
+        if field == 'username':
+            self.username_index.add(value, entry)
+    
     def addUser(self, username:str, password_hash:str):
+        """
+        Add a new user, returning the new entry,
+        or None if the username is already taken
+        """
         entry = {
             'username': username,
             'password_hash': password_hash,
             'uuid': str(uuid.uuid4())
         }
-        self.append(entry)
-        self.saveData()
+        if not self.append(entry):
+            return None
+        self.requestSave()
+        return entry
+        
+    def searchByUsername(self, query:str, get_max:int):
+        """
+        Get (up to) get_max entries with usernames
+        similar to the query, best match first
+        """
+        return self.username_index.search(query, get_max)
         
     def findEntryByUsername(self, username):
-        print(self.loaded_data['entries'])
+        """
+        Find a user by username (not case sensitive)
+        """
         return self.findEntryByField('username', username, match_case=False)
         
     def findEntryByUUID(self, uuid):
@@ -161,17 +744,31 @@ class ChatDatabase(Database):
         kwargs["entry_structure"] = {
             "creator_uuid": str,
             # the chat's unique identifier
-            "uuid": str,
+            "uuid": IndexedField(str, unique=True),
             # the chat's name, shown to users
             "name": str,
             # the list of user uuids of each
             # participant
-            "participants": list,
+            "participants": IndexedField(list),
             "participants_e2e": list,
             # the timestamp of the last message
             # sent, so that chats can be ordered
             # by date for users
-            "last_message_ts": int
+            "last_message_ts": int,
+            # when the chat was last added, renamed or
+            # reordered for its participants, so clients
+            # can ask for only the chats changed since
+            # the version they last saw
+            "version": int,
+            # the chat's epoch keys, oldest first, each
+            # wrapped (encrypted) with the chat's public
+            # key by the client that made it, along with
+            # a hash of the participants it was made for
+            "epoch_keys": list,
+            # the key suite (see crypto.KEY_SUITES) of
+            # the chat's key pair, chosen by its creator.
+            # Chats from before there was a choice are "rsa"
+            "key_suite": str
         }
         # the messages in a chat are stored
         # within the chat's individual data file
@@ -183,7 +780,14 @@ class ChatDatabase(Database):
     def getChatByUUID(self, uuid):
         return self.findEntryByField('uuid', uuid)
     
+    def getHighestVersion(self):
+        """
+        Get the newest version of any chat, 0 if there are none
+        """
+        return max(
+            (entry.get('version', None) or 0 for entry in self.iterateEntries()),
+            default=0)
+    
     def saveIfModified(self):
         if self.modified:
-            self.saveData()
-        self.modified = False
\ No newline at end of file
+            self.requestSave()
\ No newline at end of file
@@ -1,9 +1,12 @@
 from scripts.ebsockets import connections
-from scripts.crypto import Asymmetric, DataPacket
+from scripts.crypto import Asymmetric, AEAD, DataPacket
+from scripts import crypto
 from scripts.constants import CONSTANTS
 from scripts import database
 import logging
 import uuid
+import base64
+import collections.abc
 
 # ~~~ Client-Side ~~~ #
 
@@ -12,10 +15,19 @@ class ClientsideHandshake(object):
             self,
             handshake_id:str,
             side:int=CONSTANTS.RECEIVER,
-            given_key_pair=None):
+            given_key_pair=None,
+            key_pool=None,
+            key_suite:str='rsa'):
         
         self.handshake_id = handshake_id
         self.side = side
+        # KeyPairPool to take new RSA key pairs from,
+        # instead of generating them on the spot
+        self.key_pool = key_pool
+        # the name of the chat's key suite, and its
+        # key functions (see crypto.KEY_SUITES)
+        self.key_suite = key_suite
+        self.suite = crypto.KEY_SUITES[key_suite]
         self.step = 0
         self.finished = False
         
@@ -27,6 +39,11 @@ class ClientsideHandshake(object):
 
         self.executeNextStep()
     
+    def createKeyPair(self):
+        if self.key_suite == 'rsa' and self.key_pool != None:
+            return self.key_pool.take()
+        return self.suite.createKeyPair()
+    
     def executeStep(self, step, **kwargs):
         self.step = step
         return self.executeNextStep(**kwargs)
@@ -37,7 +54,7 @@ class ClientsideHandshake(object):
         if self.side == CONSTANTS.SENDER:
             if self.step == 0:
                 if self.Spu == None:
-                    self.Spu, self.Spr = Asymmetric.createKeyPair()
+                    self.Spu, self.Spr = self.createKeyPair()
                 self.shared_key_public = self.Spu
                 self.shared_key_private = self.Spr
                 self.step = 1
@@ -45,24 +62,30 @@ class ClientsideHandshake(object):
             elif self.step == 1:
                 assert "Rpu" in kwargs
                 bRpu = kwargs['Rpu']
-                Rpu = Asymmetric.keyFromBytes(
+                Rpu = self.suite.keyFromBytes(
                     bRpu, CONSTANTS.PUBLIC)
-                bSpu = Asymmetric.keyToBytes(
-                    self.Spu, CONSTANTS.PUBLIC)
-                bSpr = Asymmetric.keyToBytes(
+                bSpr = self.suite.keyToBytes(
                     self.Spr, CONSTANTS.PRIVATE)
-                ebSpu_packet = DataPacket(bSpu)
-                ebSpr_packet = DataPacket(bSpr)
-                ebSpu_packet.encrypt(Rpu)
-                ebSpr_packet.encrypt(Rpu)
+                if self.key_suite == 'rsa':
+                    bSpu = Asymmetric.keyToBytes(
+                        self.Spu, CONSTANTS.PUBLIC)
+                    ebSpu_packet = DataPacket(bSpu)
+                    ebSpr_packet = DataPacket(bSpr)
+                    ebSpu_packet.encrypt(Rpu)
+                    ebSpr_packet.encrypt(Rpu)
+                    data = {
+                        "ebSpu_packet": ebSpu_packet,
+                        "ebSpr_packet": ebSpr_packet}
+                else:
+                    # the public key comes from the private
+                    # key, so only the private key is sent
+                    data = {"ebSpr": self.suite.encryptBytes(bSpr, Rpu)}
                 self.step = -1
                 n_event = connections.ebsocket_event(
                     "E2E_HANDSHAKE",
                     handshake_id=self.handshake_id,
                     action="FINAL_RECV",
-                    data={
-                        "ebSpu_packet": ebSpu_packet,
-                        "ebSpr_packet": ebSpr_packet}
+                    data=data
                 )
                 process_extra_events.append({
                     "action": "send", 
@@ -73,10 +96,10 @@ class ClientsideHandshake(object):
         elif self.side == CONSTANTS.RECEIVER:
             if self.step == 0:
                 # create Rpu, Rpr keys
-                self.Rpu, self.Rpr = Asymmetric.createKeyPair()
+                self.Rpu, self.Rpr = self.createKeyPair()
                 self.step = 1
             elif self.step == 1:
-                bRpu = Asymmetric.keyToBytes(
+                bRpu = self.suite.keyToBytes(
                     self.Rpu, CONSTANTS.PUBLIC)
                 self.step = 2
                 n_event = connections.ebsocket_event(
@@ -91,16 +114,22 @@ class ClientsideHandshake(object):
                 })
             # sender has steps between these steps
             elif self.step == 2:
-                assert "ebSpu_packet" in kwargs
-                assert "ebSpr_packet" in kwargs
-                ebSpu_packet = kwargs['ebSpu_packet']
-                ebSpr_packet = kwargs['ebSpr_packet']
-                ebSpu_packet.decrypt(self.Rpr)
-                ebSpr_packet.decrypt(self.Rpr)
-                self.shared_key_public = Asymmetric.keyFromBytes(
-                    ebSpu_packet.payload, CONSTANTS.PUBLIC)
-                self.shared_key_private = Asymmetric.keyFromBytes(
-                    ebSpr_packet.payload, CONSTANTS.PRIVATE)
+                if "ebSpr" in kwargs:
+                    bSpr = self.suite.decryptBytes(kwargs['ebSpr'], self.Rpr)
+                    self.shared_key_private = self.suite.keyFromBytes(
+                        bSpr, CONSTANTS.PRIVATE)
+                    self.shared_key_public = self.shared_key_private.public_key()
+                else:
+                    assert "ebSpu_packet" in kwargs
+                    assert "ebSpr_packet" in kwargs
+                    ebSpu_packet = kwargs['ebSpu_packet']
+                    ebSpr_packet = kwargs['ebSpr_packet']
+                    ebSpu_packet.decrypt(self.Rpr)
+                    ebSpr_packet.decrypt(self.Rpr)
+                    self.shared_key_public = Asymmetric.keyFromBytes(
+                        ebSpu_packet.payload, CONSTANTS.PUBLIC)
+                    self.shared_key_private = Asymmetric.keyFromBytes(
+                        ebSpr_packet.payload, CONSTANTS.PRIVATE)
                 self.step = -1
                 self.finished = True
 
@@ -111,6 +140,113 @@ class ClientsideHandshake(object):
 
         return process_extra_events
 
+class LazyKeyStore(collections.abc.MutableMapping):
+    """
+    id: (public, private) key pairs, kept as the bytes
+    they were stored as until first used, so loading
+    the stored keys doesn't parse every key pair.
+    Pairs are stored as DER (raw bytes for X25519),
+    and stores from before then, in PEM, still load
+    """
+    def __init__(self):
+        # id: (key suite, public bytes, private bytes)
+        self.serialized = {}
+        # id: (public, private), for the pairs used so far
+        self.loaded = {}
+
+    def __repr__(self):
+        return f'LazyKeyStore<{len(self.loaded)}/{len(self)}>'
+
+    def addEntry(self, entry:dict):
+        """
+        Add a key pair as stored in the database
+        """
+        encryption_key_id = entry['encryption_key_id']
+        self.loaded.pop(encryption_key_id, None)
+        # keys saved before there were other suites are RSA
+        self.serialized[encryption_key_id] = (
+            entry.get('key_suite', 'rsa'), entry['public'], entry['private'])
+
+    def getEntries(self):
+        """
+        Get every key pair, as entries for the database.
+        Pairs that haven't been used are stored as they were
+        """
+        entries = []
+        for encryption_key_id, (key_suite, key_public_bytes, key_private_bytes) \
+                in self.serialized.items():
+            entries.append({
+                "encryption_key_id": encryption_key_id,
+                "key_suite": key_suite,
+                "public": key_public_bytes,
+                "private": key_private_bytes
+            })
+        for encryption_key_id, (key_public, key_private) in self.loaded.items():
+            if encryption_key_id in self.serialized:
+                continue
+            if key_public == None or key_private == None:
+                # still being handed over in a handshake
+                continue
+            key_suite = crypto.getKeySuite(key_private)
+            entry = {
+                "encryption_key_id": encryption_key_id,
+                "key_suite": key_suite,
+                "public": self._keyToBytes(key_suite, key_public, CONSTANTS.PUBLIC),
+                "private": self._keyToBytes(key_suite, key_private, CONSTANTS.PRIVATE)
+            }
+            # they won't change, so aren't converted again
+            self.serialized[encryption_key_id] = (
+                key_suite, entry['public'], entry['private'])
+            entries.append(entry)
+        return entries
+
+    def _keyToBytes(self, key_suite:str, key, key_type:int):
+        if key_suite == 'rsa':
+            return Asymmetric.keyToBytes(key, key_type, der=True)
+        return crypto.KEY_SUITES[key_suite].keyToBytes(key, key_type)
+
+    def __getitem__(self, encryption_key_id):
+        pair = self.loaded.get(encryption_key_id, None)
+        if pair != None:
+            return pair
+        key_suite, key_public_bytes, key_private_bytes = \
+            self.serialized[encryption_key_id]
+        suite = crypto.KEY_SUITES[key_suite]
+        pair = (
+            suite.keyFromBytes(key_public_bytes, CONSTANTS.PUBLIC),
+            suite.keyFromBytes(key_private_bytes, CONSTANTS.PRIVATE))
+        self.loaded[encryption_key_id] = pair
+        if key_private_bytes.startswith(b'-----'):
+            # stored as PEM, so store it again as DER
+            del self.serialized[encryption_key_id]
+        return pair
+
+    def __setitem__(self, encryption_key_id, pair):
+        self.serialized.pop(encryption_key_id, None)
+        self.loaded[encryption_key_id] = pair
+
+    def __delitem__(self, encryption_key_id):
+        if not encryption_key_id in self:
+            raise KeyError(encryption_key_id)
+        self.serialized.pop(encryption_key_id, None)
+        self.loaded.pop(encryption_key_id, None)
+
+    def __contains__(self, encryption_key_id):
+        # without parsing the pair, unlike the default
+        return encryption_key_id in self.loaded or \
+            encryption_key_id in self.serialized
+
+    def __iter__(self):
+        yield from self.serialized
+        for encryption_key_id in list(self.loaded):
+            if not encryption_key_id in self.serialized:
+                yield encryption_key_id
+
+    def __len__(self):
+        return len(self.serialized)+sum(
+            1 for encryption_key_id in self.loaded
+            if not encryption_key_id in self.serialized)
+
 class ClientsideHandshakeManager(object):
     """
     Manages e2e handshakes with other clients
@@ -118,13 +254,21 @@ class ClientsideHandshakeManager(object):
     should be sent through the process() function of
     an instance of this class.
     """
-    def __init__(self, database):
+    def __init__(self, database, key_pool=None):
         # id: handshake
         self.handshakes = {}
+        # KeyPairPool that new key pairs are taken from
+        self.key_pool = key_pool
         # encryption_keys should be loaded from
         # a local database
-        # id: (public, private)
-        self.encryption_keys = {}
+        # id: (public, private), parsed when first used
+        self.encryption_keys = LazyKeyStore()
+        # id: {epoch: symmetric key}, the epoch keys
+        # messages are sealed with. They reach the
+        # server wrapped with the id's public key,
+        # so only the key pair is handed over in
+        # handshakes, and they're unwrapped once each
+        self.epoch_keys = {}
         self.database = database
     
     def loadEncryptionKeys(self):
@@ -135,19 +279,10 @@ class ClientsideHandshakeManager(object):
         That should be done before this function.
         """
         self.database.loadData()
+        self.encryption_keys = LazyKeyStore()
         for entry in self.database.loaded_data['entries']:
-            encryption_key_id = entry['encryption_key_id']
-            key_public_bytes = entry['public']
-            key_private_bytes = entry['private']
-            key_public = Asymmetric.keyFromBytes(
-                key_public_bytes, CONSTANTS.PUBLIC
-            )
-            key_private = Asymmetric.keyFromBytes(
-                key_private_bytes, CONSTANTS.PRIVATE
-            )
-            self.encryption_keys[encryption_key_id] = (
-                key_public, key_private
-            )
+            self.encryption_keys.addEntry(entry)
+        self.epoch_keys = self.database.loaded_data.get('epoch_keys', {})
         print(f"loaded {len(self.database.loaded_data['entries'])} key pairs")
 
     def saveEncryptionKeys(self):
@@ -157,39 +292,88 @@ class ClientsideHandshakeManager(object):
         database to save its data. That should
         be executed separately.
         """
-        self.database.loaded_data['entries'] = []
-        for encryption_key_id in self.encryption_keys:
-            key_public, key_private = self.encryption_keys[encryption_key_id]
-            key_public_bytes = Asymmetric.keyToBytes(
-                key_public, CONSTANTS.PUBLIC
-            )
-            key_private_bytes = Asymmetric.keyToBytes(
-                key_private, CONSTANTS.PRIVATE
-            )
-            entry = {
-                "encryption_key_id": encryption_key_id,
-                "public": key_public_bytes,
-                "private": key_private_bytes
-            }
-            self.database.loaded_data['entries'].append(entry)
+        self.database.loaded_data['entries'] = self.encryption_keys.getEntries()
+        self.database.loaded_data['epoch_keys'] = self.epoch_keys
         self.database.saveData()
         print(f"saved {len(self.database.loaded_data['entries'])} key pairs")
     
-    def createKeyPair(self, encryption_key_id:str):
+    def takeKeyPair(self, key_suite:str='rsa'):
+        if key_suite == 'rsa' and self.key_pool != None:
+            return self.key_pool.take()
+        return crypto.KEY_SUITES[key_suite].createKeyPair()
+    
+    def createKeyPair(self, encryption_key_id:str, key_suite:str='rsa'):
         if encryption_key_id in self.encryption_keys:
             return False
-        pu, pr = Asymmetric.createKeyPair()
+        pu, pr = self.takeKeyPair(key_suite)
         pair = (pu, pr)
         self.encryption_keys[encryption_key_id] = pair
         del(pu, pr)
         self.saveEncryptionKeys()
         return True
     
+    def getEpochKey(self, encryption_key_id:str, epoch:int, wrapped_keys:list=None):
+        """
+        Get the key of one of a chat's epochs, unwrapping
+        it from wrapped_keys (as sent by the server) with
+        the chat's private key the first time it's needed.
+        Returns None if it isn't available
+        """
+        epoch_keys = self.epoch_keys.setdefault(encryption_key_id, {})
+        if epoch in epoch_keys:
+            return epoch_keys[epoch]
+        if wrapped_keys == None or not 0 <= epoch < len(wrapped_keys):
+            return None
+        if not encryption_key_id in self.encryption_keys:
+            return None
+        k_public, k_private = self.encryption_keys[encryption_key_id]
+        if k_private == None:
+            # the key pair is still being handed over
+            return None
+        suite = crypto.KEY_SUITES[crypto.getKeySuite(k_private)]
+        try:
+            key = suite.decryptBytes(
+                base64.b64decode(wrapped_keys[epoch]), k_private)
+        except Exception as e:
+            logging.warn(f'unwrapping epoch {epoch} key of {encryption_key_id} failed: {e}')
+            return None
+        epoch_keys[epoch] = key
+        self.saveEncryptionKeys()
+        return key
+    
+    def createEpochKey(self, encryption_key_id:str):
+        """
+        Create a new epoch key for a chat, returning it and
+        its wrapped (base64) form to give to the server, or
+        None if the chat's key pair is missing. It isn't kept
+        until the server accepts it (see addEpochKey)
+        """
+        if not encryption_key_id in self.encryption_keys:
+            return None
+        k_public, k_private = self.encryption_keys[encryption_key_id]
+        if k_public == None:
+            # the key pair is still being handed over
+            return None
+        suite = crypto.KEY_SUITES[crypto.getKeySuite(k_public)]
+        key = AEAD.createKey()
+        wrapped_key = base64.b64encode(
+            suite.encryptBytes(key, k_public)).decode()
+        return key, wrapped_key
+    
+    def addEpochKey(self, encryption_key_id:str, epoch:int, key:bytes):
+        self.epoch_keys.setdefault(encryption_key_id, {})[epoch] = key
+        self.saveEncryptionKeys()
+    
     def process(self, event):
         process_extra_events = []
         handshake_id = event.handshake_id
         encryption_key_id = handshake_id.split('+',1)[0]
         action = event.action
+        # chats from before there were other suites are RSA
+        key_suite = event.get_attribute('key_suite') or 'rsa'
+        if not key_suite in crypto.KEY_SUITES:
+            logging.warn(f"unknown key suite {key_suite} for handshake {handshake_id}")
+            return process_extra_events
 
         if action == "INIT_SEND":
             logging.debug(f"init_send event, creating handshake "\
@@ -199,7 +383,7 @@ class ClientsideHandshakeManager(object):
                 # id just yet, so create a new entry and keys
                 logging.warn(f"no existing encryption key found for handshake, "\
                     "so creating new key pair")
-                pu, pr = Asymmetric.createKeyPair()
+                pu, pr = self.takeKeyPair(key_suite)
                 pair = (pu, pr)
                 self.encryption_keys[encryption_key_id] = pair
                 del(pu, pr)
@@ -208,7 +392,9 @@ class ClientsideHandshakeManager(object):
             handshake = ClientsideHandshake(
                 handshake_id,
                 CONSTANTS.SENDER,
-                self.encryption_keys[encryption_key_id]
+                self.encryption_keys[encryption_key_id],
+                key_pool=self.key_pool,
+                key_suite=crypto.getKeySuite(self.encryption_keys[encryption_key_id][1])
             )
             self.handshakes[handshake_id] = handshake
 
@@ -217,7 +403,9 @@ class ClientsideHandshakeManager(object):
                 f"to track process, handshake id {handshake_id}")
             handshake = ClientsideHandshake(
                 handshake_id,
-                CONSTANTS.RECEIVER
+                CONSTANTS.RECEIVER,
+                key_pool=self.key_pool,
+                key_suite=key_suite
             )
             self.handshakes[handshake_id] = handshake
             if encryption_key_id in self.encryption_keys:
@@ -264,10 +452,12 @@ class SingleHandshakeManager(object):
             self,
             conn_sender,
             conn_receiver,
-            handshake_id:str):
+            handshake_id:str,
+            key_suite:str='rsa'):
         self.conn_sender = conn_sender
         self.conn_receiver = conn_receiver
         self.handshake_id = handshake_id
+        self.key_suite = key_suite
         self.initiated = False
     
     def initiate(self):
@@ -281,7 +471,8 @@ class SingleHandshakeManager(object):
         n_event = connections.ebsocket_event(
             "E2E_HANDSHAKE",
             handshake_id=self.handshake_id,
-            action="INIT_RECV")
+            action="INIT_RECV",
+            key_suite=self.key_suite)
         process_extra_events.append({
             "action": "send",
             "event": n_event,
@@ -291,7 +482,8 @@ class SingleHandshakeManager(object):
         n_event = connections.ebsocket_event(
             "E2E_HANDSHAKE",
             handshake_id=self.handshake_id,
-            action="INIT_SEND")
+            action="INIT_SEND",
+            key_suite=self.key_suite)
         process_extra_events.append({
             "action": "send",
             "event": n_event,
@@ -355,10 +547,12 @@ class HandshakeManager(object):
             self,
             conn_sender,
             conn_receiver,
-            handshake_id:str=''):
+            handshake_id:str='',
+            key_suite:str='rsa'):
         """
         Create a new handshake between
-        two connections (users)
+        two connections (users), for keys
+        of the given suite
 
         if handshake_id is not provided,
         handshake_id will be a random uuid4+tag.
@@ -390,7 +584,7 @@ class HandshakeManager(object):
         # also "mark" this instance as one
         # that requires initialisation
         handshake = SingleHandshakeManager(
-            conn_sender, conn_receiver, handshake_id)
+            conn_sender, conn_receiver, handshake_id, key_suite)
         self.handshakes[handshake_id] = handshake
         self.waiting_for_init.append(handshake_id)
         return True
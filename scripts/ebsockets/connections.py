@@ -52,6 +52,11 @@ class EBException(Exception):
 
 class constants:
     header_size = 16
+    # how long to wait for the rest of a frame
+    # that has only partly arrived
+    frame_timeout = 5.0
+    # chunks sent for each stream on every pump
+    stream_chunks_per_pump = 4
 
 
 class ebsocket_base(object):
@@ -87,7 +92,31 @@ class ebsocket_base(object):
         '''sends data with a header'''
         use_socket = self.is_valid_socket(send_socket)
         byte_data = utility.get_header(data, constants.header_size)+data
-        use_socket.send(byte_data)
+        use_socket.sendall(byte_data)
+
+    def recv_exactly(self, use_socket: socket.socket, n_bytes: int) -> bytes:
+        '''receives exactly n_bytes, waiting for the rest of a frame
+        if it has only partly arrived, even on a non-blocking socket'''
+        chunks = []
+        remaining = n_bytes
+        while remaining > 0:
+            try:
+                chunk = use_socket.recv(remaining)
+            except BlockingIOError:
+                readable, _, _ = select.select(
+                    [use_socket], [], [], constants.frame_timeout)
+                if not readable:
+                    raise EBException(
+                        "timed out waiting for the rest of a frame",
+                        critical=True)
+                continue
+            if not chunk:
+                raise EBException(
+                    "connection closed in the middle of a frame",
+                    critical=True)
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
 
     def recv_with_header(self, recv_socket: socket.socket = None):
         '''receives data with a header'''
@@ -97,8 +126,12 @@ class ebsocket_base(object):
             raise EBException(
                 "header received was empty in recv_with_header() call",
                 critical=True)
+        if len(header_recv) < constants.header_size:
+            header_recv += self.recv_exactly(
+                use_socket, constants.header_size-len(header_recv))
         total_bytes = int(header_recv.decode())
-        data_recv = use_socket.recv(total_bytes)
+        # large frames arrive over several recv calls
+        data_recv = self.recv_exactly(use_socket, total_bytes)
         return data_recv
 
     def send_event(self, event: ebsocket_event = None, send_socket: socket.socket = None):
@@ -193,6 +226,45 @@ class ebsocket_client(ebsocket_base):
         return new_events, True
 
 
+class ebsocket_stream(object):
+    '''a response sent as a series of chunk events rather than one
+    frame. producer is a generator yielding each chunk's data, which
+    is only run as chunks are sent, so the whole response is never
+    held in memory. every chunk event has the stream_id, the chunk's
+    stream_index and its data, and the last one has stream_end set
+    (with data None), marking the end of the stream'''
+
+    def __init__(self, stream_id: int, connection: socket.socket,
+            event_type: str, producer, **kwargs) -> None:
+        self.stream_id = stream_id
+        self.connection = connection
+        self.event_type = event_type
+        self.producer = producer
+        self.kwargs = kwargs
+        self.index = 0
+        self.ended = False
+
+    def __repr__(self):
+        return f'ebsocket_stream<{self.stream_id},{self.event_type},{self.index}>'
+
+    def next_event(self):
+        '''get the event for the next chunk, the end marker after
+        the last chunk, then None once the stream is over'''
+        if self.ended:
+            return None
+        data = next(self.producer, None)
+        if data is None:
+            self.ended = True
+        event = ebsocket_event(self.event_type,
+            stream_id=self.stream_id,
+            stream_index=self.index,
+            stream_end=self.ended,
+            data=data,
+            **self.kwargs)
+        self.index += 1
+        return event
+
+
 class ebsocket_system(object):
     '''a whole server-client system network'''
 
@@ -202,6 +274,9 @@ class ebsocket_system(object):
         self.connections_list = [self.server.connection]
         self.clients = {}
         self.timeout = 0.5
+        # streams still being sent, in the order they were started
+        self.streams = []
+        self.next_stream_id = 0
 
     def pump(self) -> Tuple[List[Tuple], List[ebsocket_event], List[Tuple]]:
         '''runs the main system
@@ -214,8 +289,12 @@ class ebsocket_system(object):
          - disconnected_clients:list'''
         
         conn_list = self.connections_list
+        timeout = self.timeout
+        if len(self.streams) > 0:
+            # don't hold up the streams waiting for events
+            timeout = 0
         read_connections, _, exception_connections = select.select(
-            conn_list, [], conn_list, self.timeout)
+            conn_list, [], conn_list, timeout)
 
         new_clients = []
         new_events = []
@@ -245,20 +324,50 @@ class ebsocket_system(object):
                     new_events.append(event)
 
         for notified_connection in exception_connections:
+            if not notified_connection in self.clients:
+                continue
             disconnected_clients.append(
                 (notified_connection, self.clients[notified_connection]))
             self.remove_client(notified_connection)
 
+        self.pump_streams()
+
         return new_clients, new_events, disconnected_clients
 
     def remove_client(self, client_connection):
         '''removes a client from the server'''
         self.connections_list.remove(client_connection)
         del self.clients[client_connection]
+        self.streams = [stream for stream in self.streams
+            if stream.connection != client_connection]
+
+    def send_stream_to(self, connection: socket.socket, event_type: str,
+            producer, **kwargs) -> int:
+        '''starts sending a stream of chunks to a client (see
+        ebsocket_stream), a few chunks on each pump, and
+        returns the stream's id'''
+        stream = ebsocket_stream(
+            self.next_stream_id, connection, event_type, producer, **kwargs)
+        self.next_stream_id += 1
+        self.streams.append(stream)
+        return stream.stream_id
+
+    def pump_streams(self):
+        '''sends the next few chunks of every stream, taking turns
+        so one large stream doesn't hold up the others'''
+        for stream in list(self.streams):
+            for _ in range(constants.stream_chunks_per_pump):
+                event = stream.next_event()
+                if event is None or \
+                        self.send_event_to(stream.connection, event) == False:
+                    stream.ended = True
+                if stream.ended:
+                    self.streams.remove(stream)
+                    break
 
     def send_raw_to(self, connection: socket.socket, data: bytes):
         '''sends byte data to a client'''
-        connection.send(data)
+        connection.sendall(data)
 
     def send_event_to(self, connection: socket.socket, event: ebsocket_event):
         '''sends an event to a client'''
@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import threading
+import time
+
+class Journal(object):
+    """
+    Append-only log of database mutations.
+
+    Instead of rewriting the whole database file
+    on every save, each mutation is appended as a
+    single JSON record. Loading the database means
+    loading the last snapshot, then replaying the
+    journal on top of it. Once the journal grows
+    long enough, a new snapshot is written in a
+    background thread and the journal is emptied.
+    """
+    # fsync after every sync() call
+    FSYNC_ALWAYS = 'always'
+    # fsync at most once every fsync_interval seconds
+    FSYNC_INTERVAL = 'interval'
+    # never fsync, leave it to the operating system
+    FSYNC_NEVER = 'never'
+
+    def __init__(
+            self,
+            filename:str,
+            fsync_policy:str=FSYNC_ALWAYS,
+            fsync_interval:float=1.0,
+            compact_after:int=10000):
+        assert fsync_policy in (
+            self.FSYNC_ALWAYS,
+            self.FSYNC_INTERVAL,
+            self.FSYNC_NEVER), f"unknown fsync policy {fsync_policy}"
+        self.filename = filename
+        # while a snapshot is being written, the records
+        # it covers are kept in this file in case of a crash
+        self.compacting_filename = filename+'.old'
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+
+        # sequence number of the last record written
+        self.seq = 0
+        # number of records in the journal file
+        self.n_records = 0
+        self.file = None
+        self.last_fsync = 0
+        self.compaction_thread = None
+
+    def __repr__(self):
+        return f'Journal<{self.filename},{self.seq}>'
+
+    # ------------------------- reading
+    def _readRecordsFromFile(self, filename:str):
+        """
+        Read every record from a journal file.
+        A torn record at the end of the file
+        (from a crash mid-write) is truncated
+        """
+        records = []
+        if not os.path.exists(filename):
+            return records
+        good_length = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records.append(record)
+                good_length += len(line)
+            torn = f.tell() != good_length
+        if torn:
+            logging.warning(
+                f'truncating torn record at the end '\
+                f'of journal {filename}')
+            with open(filename, 'r+b') as f:
+                f.truncate(good_length)
+        return records
+
+    def readRecords(self, snapshot_seq:int):
+        """
+        Get every record newer than the snapshot,
+        in the order they were written
+        """
+        records = []
+        for filename in (self.compacting_filename, self.filename):
+            for record in self._readRecordsFromFile(filename):
+                if record['seq'] > snapshot_seq:
+                    records.append(record)
+        self.n_records = len(records)
+        self.seq = snapshot_seq
+        if len(records) > 0:
+            self.seq = records[-1]['seq']
+        return records
+
+    def needsRecovery(self):
+        """
+        Whether a compaction was interrupted,
+        meaning a new snapshot should be written
+        """
+        return os.path.exists(self.compacting_filename)
+
+    # ------------------------- writing
+    def write(self, record:dict):
+        """
+        Append a record to the journal. The record
+        is not guaranteed to be on disk until the
+        next call to sync()
+        """
+        if self.file == None:
+            self.file = open(self.filename, 'ab')
+        self.seq += 1
+        record['seq'] = self.seq
+        self.file.write(json.dumps(record).encode()+b'\n')
+        self.n_records += 1
+
+    def sync(self):
+        """
+        Flush written records to the operating
+        system, and fsync according to the policy
+        """
+        if self.file == None:
+            return
+        self.file.flush()
+        if self.fsync_policy == self.FSYNC_NEVER:
+            return
+        now = time.time()
+        if self.fsync_policy == self.FSYNC_INTERVAL and \
+                now-self.last_fsync < self.fsync_interval:
+            return
+        os.fsync(self.file.fileno())
+        self.last_fsync = now
+
+    def close(self):
+        if self.file != None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    # ------------------------- compaction
+    def isCompacting(self):
+        return self.compaction_thread != None and \
+            self.compaction_thread.is_alive()
+
+    def shouldCompact(self):
+        return self.n_records >= self.compact_after and \
+            not self.isCompacting()
+
+    def compact(self, snapshot_filename:str, snapshot_text:str, background:bool=True):
+        """
+        Replace the snapshot file with snapshot_text,
+        which must include every record written so far,
+        then discard those records from the journal.
+        New records can be written while this happens
+        """
+        self.waitForCompaction()
+        self.close()
+        if os.path.exists(self.filename):
+            if os.path.exists(self.compacting_filename):
+                # an earlier compaction didn't finish,
+                # so keep its records alongside these
+                with open(self.filename, 'rb') as f_new, \
+                        open(self.compacting_filename, 'ab') as f_old:
+                    f_old.write(f_new.read())
+                os.remove(self.filename)
+            else:
+                os.replace(self.filename, self.compacting_filename)
+        self.n_records = 0
+        if background:
+            self.compaction_thread = threading.Thread(
+                target=self._writeSnapshot,
+                args=(snapshot_filename, snapshot_text),
+                daemon=True)
+            self.compaction_thread.start()
+        else:
+            self._writeSnapshot(snapshot_filename, snapshot_text)
+
+    def waitForCompaction(self):
+        if self.compaction_thread != None:
+            self.compaction_thread.join()
+
+    def _writeSnapshot(self, snapshot_filename:str, snapshot_text:str):
+        temp_filename = snapshot_filename+'.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(snapshot_text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, snapshot_filename)
+        # the snapshot now holds everything in the
+        # old journal, so it can be thrown away
+        if os.path.exists(self.compacting_filename):
+            os.remove(self.compacting_filename)
+        logging.debug(f'compacted journal into {snapshot_filename}')
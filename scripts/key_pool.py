@@ -0,0 +1,101 @@
+import collections
+import logging
+import threading
+from scripts.crypto import Asymmetric
+
+class KeyPairPool(object):
+    """
+    RSA key pairs generated ahead of time by a
+    background thread, since generating one takes
+    long enough to freeze the client's event loop.
+
+    take() hands out a ready pair straight away, and
+    the thread refills the pool up to depth pairs.
+    If the pool has run dry, a pair is generated on
+    the spot instead (a miss). The thread is started
+    by the first miss, unless start() is called
+    first, so no keys are made until any are needed.
+    Key generation releases the GIL, so the thread
+    doesn't hold up the caller while it works.
+    """
+    def __init__(self, depth:int=4, create_key_pair=Asymmetric.createKeyPair):
+        self.depth = depth
+        self.create_key_pair = create_key_pair
+        # (public, private) pairs ready to be taken
+        self.pairs = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def __repr__(self):
+        return f'KeyPairPool<{len(self.pairs)}/{self.depth}>'
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def start(self):
+        """
+        Start filling the pool in the background
+        """
+        if self.thread != None or self.depth <= 0:
+            return
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self._fillLoop, name='key-pair-pool', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def _fillLoop(self):
+        while True:
+            with self.condition:
+                while not self.stopped and len(self.pairs) >= self.depth:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            # generated outside the lock, so take() never waits on it
+            try:
+                pair = self.create_key_pair()
+            except Exception as e:
+                logging.warn(f'{self} failed to generate a key pair: {e}')
+                return
+            with self.condition:
+                self.pairs.append(pair)
+                self.generated += 1
+
+    def take(self):
+        """
+        Get a (public, private) key pair, which
+        is never handed out more than once
+        """
+        with self.condition:
+            if len(self.pairs) > 0:
+                self.hits += 1
+                pair = self.pairs.popleft()
+                self.condition.notify()
+                return pair
+            self.misses += 1
+            self.condition.notify()
+        if not self.stopped:
+            self.start()
+        logging.debug(f'{self} is empty, generating a key pair now')
+        return self.create_key_pair()
+
+    def getStats(self):
+        return {
+            'ready': len(self.pairs),
+            'depth': self.depth,
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated
+        }
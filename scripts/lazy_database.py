@@ -0,0 +1,709 @@
+import array
+import collections
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import time
+import tracemalloc
+import uuid
+
+from scripts import database
+from scripts import search_index
+
+class OffsetIndex(object):
+    """
+    Read-only, memory mapped index over a
+    LazyDatabase's data file.
+
+    layout:
+        prefix: magic, header position, header length
+        sections of little endian uint64s:
+            offsets: where each entry's newest line
+                starts in the data file, by entry id
+            one per indexed field: (key hash, entry id)
+                pairs, sorted, for binary searching
+        header (JSON): valid_fields, entry and line
+            counts, how much of the data file the
+            index covers and where the sections are
+    """
+    MAGIC = b'EBDBIDX1'
+    PREFIX = struct.Struct('<8sQQ')
+    OFFSET = struct.Struct('<Q')
+    RECORD = struct.Struct('<QQ')
+    # records read at a time when iterating a section
+    CHUNK_SIZE = 4096
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.file = None
+        self.map = None
+        self.header = self.getEmptyHeader()
+
+    def __repr__(self):
+        return f'OffsetIndex<{self.filename},{self.header["n_entries"]}>'
+
+    @staticmethod
+    def getEmptyHeader():
+        return {
+            'generation': None,
+            'valid_fields': [],
+            'n_entries': 0,
+            'n_lines': 0,
+            'data_length': 0,
+            'sections': {}
+        }
+
+    @staticmethod
+    def hashKey(key):
+        """
+        Hash of an index key that stays the same
+        between runs, unlike the builtin hash()
+        """
+        digest = hashlib.blake2b(json.dumps(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    # ------------------------- reading
+    def open(self):
+        """
+        Map the index file into memory. Only the
+        header is actually read. Returns False if
+        there is no index file
+        """
+        self.close()
+        self.header = self.getEmptyHeader()
+        if not os.path.exists(self.filename):
+            return False
+        self.file = open(self.filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_position, header_length = self.PREFIX.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f'{self.filename} is not a database index')
+        self.header = json.loads(
+            self.map[header_position:header_position+header_length])
+        return True
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    def getOffset(self, id:int):
+        section = self.header['sections'].get('offsets', None)
+        if section == None or id >= section[1]:
+            return None
+        return self.OFFSET.unpack_from(self.map, section[0]+id*self.OFFSET.size)[0]
+
+    def findIds(self, field:str, key_hash:int):
+        """
+        Get the ids of every entry indexed
+        under the hash, using a binary search
+        """
+        section = self.header['sections'].get(field, None)
+        if section == None:
+            return []
+        start, count = section
+        size = self.RECORD.size
+        low, high = 0, count
+        while low < high:
+            middle = (low+high)//2
+            if self.RECORD.unpack_from(self.map, start+middle*size)[0] < key_hash:
+                low = middle+1
+            else:
+                high = middle
+        ids = []
+        while low < count:
+            record_hash, id = self.RECORD.unpack_from(self.map, start+low*size)
+            if record_hash != key_hash:
+                break
+            ids.append(id)
+            low += 1
+        return ids
+
+    def _iterateSection(self, name:str, item_struct):
+        section = self.header['sections'].get(name, None)
+        if section == None:
+            return
+        start, count = section
+        chunk_length = self.CHUNK_SIZE*item_struct.size
+        end = start+count*item_struct.size
+        for position in range(start, end, chunk_length):
+            chunk = self.map[position:min(position+chunk_length, end)]
+            yield from item_struct.iter_unpack(chunk)
+
+    def iterateOffsets(self):
+        for offset, in self._iterateSection('offsets', self.OFFSET):
+            yield offset
+
+    def iterateRecords(self, field:str):
+        return self._iterateSection(field, self.RECORD)
+
+    # ------------------------- writing
+    @classmethod
+    def write(cls, filename:str, header:dict, offsets, records_by_field:dict):
+        """
+        Write a new index file. offsets and each
+        field's (already sorted) records can be
+        iterators, so they needn't fit in memory
+        """
+        header = dict(header)
+        sections = {}
+        temp_filename = filename+'.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(bytes(cls.PREFIX.size))
+            def writeSection(name, items, item_struct):
+                start = f.tell()
+                count = 0
+                chunk = []
+                for item in items:
+                    chunk.append(item_struct.pack(*item))
+                    count += 1
+                    if len(chunk) >= cls.CHUNK_SIZE:
+                        f.write(b''.join(chunk))
+                        chunk = []
+                f.write(b''.join(chunk))
+                sections[name] = (start, count)
+            writeSection('offsets', ((offset,) for offset in offsets), cls.OFFSET)
+            for field, records in records_by_field.items():
+                writeSection(field, records, cls.RECORD)
+            header['sections'] = sections
+            header_text = json.dumps(header).encode()
+            header_position = f.tell()
+            f.write(header_text)
+            f.seek(0)
+            f.write(cls.PREFIX.pack(cls.MAGIC, header_position, len(header_text)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+
+class LazyDatabase(database.Database):
+    """
+    Database whose entries stay on disk until
+    they're looked up, so that starting up takes
+    about the same time however many there are.
+
+    Entries are stored as JSON lines in an append
+    only data file (filename.entries). Changing an
+    entry appends a new version of it. An OffsetIndex
+    (filename.index), which is memory mapped rather
+    than read, finds each entry's newest line and
+    the entries for each indexed field's values.
+
+    Lines written since the index was last rewritten
+    are indexed in memory, and read again from the
+    end of the data file on startup. Once there are
+    reindex_after of them, the index is rewritten
+    while saving. Once most lines in the data file
+    are old versions, the data file is compacted too.
+
+    A JSON database at filename is imported the first
+    time it's opened. Entries returned are copies, so
+    all changes must go through the mutation functions
+    """
+    def __init__(self, *args, **kwargs):
+        assert not kwargs.pop('journal', False), \
+            "lazy databases are append only already, they don't need a journal"
+        self.reindex_after = kwargs.pop('reindex_after', 10000)
+        self.cache_size = kwargs.pop('cache_size', 4096)
+        self.data_file = None
+        self.offset_index = None
+        super().__init__(*args, **kwargs)
+
+    def __repr__(self):
+        return f'LazyDatabase<{self.filename},{len(self)}>'
+
+    def __len__(self):
+        return self.n_entries
+
+    def _getDataFilename(self):
+        return self.filename+'.entries'
+
+    def _getIndexFilename(self):
+        return self.filename+'.index'
+
+    # ------------------------- loading
+    def _resetState(self, header:dict):
+        self.generation = header['generation']
+        self.valid_fields = list(header['valid_fields'])
+        self.n_entries = header['n_entries']
+        self.n_lines = header['n_lines']
+        self.data_length = header['data_length']
+        self.indexed_length = header['data_length']
+        # id: offset, for lines not in the offset index
+        self.offset_overrides = {}
+        # field: {key: set of ids}, for lines not in the offset index
+        self.recent_indexes = {field: {} for field in self.indexed_fields}
+        # id: entry, most recently used last
+        self.cache = collections.OrderedDict()
+
+    def loadData(self):
+        """
+        Open the data file and map the offset
+        index. Only the lines written since the
+        index was last rewritten are read
+        """
+        assert self.filename != None, "lazy databases require a filename"
+        assert self.primary_key != None, \
+            "lazy databases require a unique, case sensitive indexed field"
+        self.close()
+        self.loaded_data = None
+        if not os.path.exists(self._getDataFilename()):
+            self._createDataFile()
+        self.data_file = open(self._getDataFilename(), 'a+b')
+        self.data_file.seek(0)
+        generation = json.loads(self.data_file.readline())['generation']
+
+        self.offset_index = OffsetIndex(self._getIndexFilename())
+        self.offset_index.open()
+        if self.offset_index.header['generation'] != generation:
+            if self.offset_index.header['generation'] != None:
+                # the data file was compacted, but the
+                # index wasn't replaced before a crash
+                logging.warning(f'ignoring out of date index for {self.filename}')
+            self.offset_index.close()
+            self.offset_index.header = OffsetIndex.getEmptyHeader()
+        self._resetState(self.offset_index.header)
+        self.generation = generation
+        if self.offset_index.header['generation'] == None:
+            # nothing is indexed, so read every line
+            self.data_length = self.data_file.tell()
+            self.indexed_length = self.data_length
+        self._readUnindexedLines()
+        if len(self.offset_overrides) >= self.reindex_after:
+            # e.g. just imported, so don't read them all again next time
+            self._writeIndex()
+        return True
+
+    def _createDataFile(self):
+        entries = []
+        if os.path.exists(self.filename):
+            logging.info(f'importing {self.filename} into a lazy database')
+            # include any changes still in the JSON database's journal
+            json_database = database.Database(
+                self.filename,
+                entry_structure=self.entry_structure,
+                journal=os.path.exists(self.filename+'.journal'))
+            entries = json_database.loaded_data['entries']
+        temp_filename = self._getDataFilename()+'.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(json.dumps({'generation': 1}).encode()+b'\n')
+            for id, entry in enumerate(entries):
+                f.write(json.dumps([id, entry]).encode()+b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self._getDataFilename())
+
+    def _readUnindexedLines(self):
+        self.data_file.seek(self.indexed_length)
+        offset = self.indexed_length
+        n_lines = 0
+        for line in self.data_file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                id, entry = json.loads(line)
+            except ValueError:
+                break
+            self._addLine(id, entry, offset, len(line))
+            offset += len(line)
+            n_lines += 1
+        self.data_file.seek(0, os.SEEK_END)
+        if self.data_file.tell() != offset:
+            logging.warning(
+                f'truncating torn line at the end of '\
+                f'{self._getDataFilename()}')
+            self.data_file.truncate(offset)
+        logging.debug(f'read {n_lines} unindexed lines from {self.filename}')
+
+    def _addLine(self, id:int, entry, offset:int, length:int):
+        self.offset_overrides[id] = offset
+        self.n_entries = max(self.n_entries, id+1)
+        self.n_lines += 1
+        self.data_length = offset+length
+        for field in entry:
+            if not field in self.valid_fields:
+                self.valid_fields.append(field)
+        for field, s_value in self.indexed_fields.items():
+            if field in entry:
+                index = self.recent_indexes[field]
+                for key in s_value.getKeys(entry[field]):
+                    index.setdefault(key, set()).add(id)
+
+    # ------------------------- entries on disk
+    def _getOffset(self, id:int):
+        offset = self.offset_overrides.get(id, None)
+        if offset == None:
+            offset = self.offset_index.getOffset(id)
+        return offset
+
+    def _readLine(self, id:int):
+        self.data_file.seek(self._getOffset(id))
+        return self.data_file.readline()
+
+    def _readEntry(self, id:int, cache:bool=True):
+        entry = self.cache.get(id, None)
+        if entry != None:
+            self.cache.move_to_end(id)
+            return entry
+        line_id, entry = json.loads(self._readLine(id))
+        if line_id != id:
+            raise ValueError(f'entry {id} of {self.filename} is at the wrong offset')
+        if cache:
+            self._cacheEntry(id, entry)
+        return entry
+
+    @staticmethod
+    def _copyEntry(entry):
+        # the cached entry must only change through
+        # the mutation functions, so lists are copied too
+        return {field: list(value) if isinstance(value, list) else value
+            for field, value in entry.items()}
+
+    def _cacheEntry(self, id:int, entry):
+        self.cache[id] = entry
+        self.cache.move_to_end(id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _writeEntry(self, id:int, entry):
+        line = json.dumps([id, entry]).encode()+b'\n'
+        self.data_file.write(line)
+        self._addLine(id, entry, self.data_length, len(line))
+        self._cacheEntry(id, entry)
+        self.markModified()
+
+    def iterateEntries(self):
+        """
+        Iterate over every entry, without
+        loading them all into memory at once
+        """
+        for id in range(self.n_entries):
+            yield self._copyEntry(self._readEntry(id, cache=False))
+
+    # ------------------------- saving
+    def saveData(self):
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+        if self.n_lines > 2*self.n_entries and self.n_lines > self.reindex_after:
+            # most lines are old versions of entries
+            self.compact()
+        elif len(self.offset_overrides) >= self.reindex_after:
+            self._writeIndex()
+        self.modified = False
+        return True
+
+    def close(self):
+        if self.data_file != None:
+            self.data_file.flush()
+            self.data_file.close()
+            self.data_file = None
+        if self.offset_index != None:
+            self.offset_index.close()
+
+    def _iterateRecords(self, field:str):
+        # both iterators are sorted, so merging
+        # them keeps the new section sorted too
+        recent = sorted(
+            (OffsetIndex.hashKey(key), id)
+            for key, ids in self.recent_indexes[field].items()
+            for id in ids)
+        previous = None
+        for record in heapq.merge(self.offset_index.iterateRecords(field), recent):
+            if record != previous:
+                yield record
+            previous = record
+
+    def _iterateOffsets(self):
+        id = 0
+        for offset in self.offset_index.iterateOffsets():
+            yield self.offset_overrides.get(id, offset)
+            id += 1
+        for id in range(id, self.n_entries):
+            yield self.offset_overrides[id]
+
+    def _getHeader(self):
+        return {
+            'generation': self.generation,
+            'valid_fields': self.valid_fields,
+            'n_entries': self.n_entries,
+            'n_lines': self.n_lines,
+            'data_length': self.data_length
+        }
+
+    def _writeIndex(self, offsets=None):
+        if offsets == None:
+            offsets = self._iterateOffsets()
+        OffsetIndex.write(
+            self._getIndexFilename(),
+            self._getHeader(),
+            offsets,
+            {field: self._iterateRecords(field) for field in self.indexed_fields})
+        self.offset_index.open()
+        self._resetState(self.offset_index.header)
+
+    def compact(self):
+        """
+        Rewrite the data file with only the newest
+        version of each entry, then the index
+        """
+        logging.debug(f'compacting {self.filename}')
+        self.data_file.flush()
+        generation = self.generation+1
+        offsets = array.array('Q')
+        temp_filename = self._getDataFilename()+'.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(json.dumps({'generation': generation}).encode()+b'\n')
+            for id in range(self.n_entries):
+                offsets.append(f.tell())
+                f.write(self._readLine(id))
+            data_length = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        # if there's a crash before the index is replaced
+        # too, the generations won't match, and the whole
+        # data file will be read on the next start up
+        self.data_file.close()
+        os.replace(temp_filename, self._getDataFilename())
+        self.data_file = open(self._getDataFilename(), 'a+b')
+        self.generation = generation
+        self.n_lines = self.n_entries
+        self.data_length = data_length
+        self._writeIndex(offsets)
+
+    # ------------------------- adding entries
+    def append(self, entry):
+        """appends a new entry to the database"""
+        is_valid = database.DatabaseUtil.matchEntryToStructure(
+            entry, self.entry_structure)
+        if not is_valid:
+            return False
+        for field, s_value in self.indexed_fields.items():
+            if not s_value.unique or not field in entry:
+                continue
+            for key in s_value.getKeys(entry[field]):
+                if len(self._findIds(field, key)) > 0:
+                    return False
+        self._writeEntry(self.n_entries, self._copyEntry(entry))
+        return True
+
+    # ------------------------- entry mutation
+    def _getId(self, entry):
+        ids = self._findIds(self.primary_key, entry[self.primary_key])
+        if len(ids) == 0:
+            raise KeyError(f'entry {entry[self.primary_key]} is not in {self}')
+        return ids[0]
+
+    def _updateEntry(self, entry, update):
+        id = self._getId(entry)
+        stored = self._readEntry(id)
+        update(stored)
+        if not stored is entry:
+            update(entry)
+        self._writeEntry(id, stored)
+
+    def setEntryField(self, entry, field, value):
+        """
+        Set the value of one of an entry's fields
+        """
+        def update(e):
+            e[field] = value
+        self._updateEntry(entry, update)
+
+    def appendToEntryField(self, entry, field, item):
+        """
+        Append an item to one of an entry's list fields
+        """
+        self._updateEntry(entry, lambda e: e[field].append(item))
+
+    def removeFromEntryField(self, entry, field, item):
+        """
+        Remove an item from one of an entry's list fields
+        """
+        self._updateEntry(entry, lambda e: e[field].remove(item))
+
+    # ------------------------- searching
+    def _findIds(self, field, key):
+        """
+        Get the ids of the entries whose indexed
+        field currently has the key
+        """
+        s_value = self.indexed_fields[field]
+        ids = set(self.recent_indexes[field].get(key, ()))
+        ids.update(self.offset_index.findIds(field, OffsetIndex.hashKey(key)))
+        found = []
+        for id in sorted(ids):
+            # the index can be out of date for entries that changed,
+            # and different keys can share a hash, so check each entry
+            entry = self._readEntry(id)
+            if field in entry and key in s_value.getKeys(entry[field]):
+                found.append(id)
+        return found
+
+    def _findEntries(self, field, value, match_case, limit=None):
+        if self._canUseIndex(field, match_case):
+            s_value = self.indexed_fields[field]
+            ids = self._findIds(field, s_value.getKey(value))
+            entries = [self._readEntry(id) for id in ids]
+            if match_case and not s_value.match_case:
+                # the index ignores case, so only keep exact matches
+                if s_value.multi_valued:
+                    entries = [entry for entry in entries if value in entry[field]]
+                else:
+                    entries = [entry for entry in entries if entry[field] == value]
+            return [self._copyEntry(entry) for entry in entries[:limit]]
+        entries = []
+        if not match_case:
+            value = value.lower()
+        for entry in self.iterateEntries():
+            entry_value = entry.get(field, None)
+            if entry_value == None:
+                continue
+            if not match_case:
+                entry_value = entry_value.lower()
+            if entry_value == value:
+                entries.append(entry)
+                if limit != None and len(entries) >= limit:
+                    break
+        return entries
+
+    def findEntriesByField(self, field, value, validate_field=False, match_case=True):
+        """
+        Find every entry with a field matching value.
+        For list fields, finds every entry whose
+        list contains value
+        """
+        if validate_field and (not field in self.valid_fields):
+            return []
+        return self._findEntries(field, value, match_case)
+
+    def findEntryByField(self, field, value, validate_field=False, match_case=True):
+        if validate_field and (not field in self.valid_fields):
+            return None
+        found = self._findEntries(field, value, match_case, limit=1)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+
+class LazyUserDatabase(LazyDatabase, database.UserDatabase):
+    """
+    UserDatabase stored as a LazyDatabase. The
+    username search index is only built the first
+    time someone searches, so it doesn't slow
+    down starting up
+    """
+    def loadData(self):
+        self.username_index = None
+        return super().loadData()
+
+    def append(self, entry):
+        if not super().append(entry):
+            return False
+        if self.username_index != None:
+            self.username_index.add(entry['username'], self.n_entries-1)
+        return True
+
+    def setEntryField(self, entry, field, value):
+        if field == 'username' and self.username_index != None:
+            id = self._getId(entry)
+            self.username_index.remove(self._readEntry(id)['username'])
+            self.username_index.add(value, id)
+        super().setEntryField(entry, field, value)
+
+    def searchByUsername(self, query:str, get_max:int):
+        if self.username_index == None:
+            self.username_index = search_index.UsernameIndex()
+            self.username_index.addMany(
+                (entry['username'], id) for id, entry in enumerate(self.iterateEntries()))
+        return [self._copyEntry(self._readEntry(id))
+            for id in self.username_index.search(query, get_max)]
+
+
+class LazyChatDatabase(LazyDatabase, database.ChatDatabase):
+    """
+    ChatDatabase stored as a LazyDatabase. The newest
+    chat version is kept in the index's header, so it
+    can be found without reading every chat
+    """
+    def _resetState(self, header:dict):
+        super()._resetState(header)
+        # None if the index is from before it was kept,
+        # otherwise every line after the index is read anyway
+        self.highest_version = header.get('highest_version',
+            0 if header['generation'] == None else None)
+
+    def _addLine(self, id:int, entry, offset:int, length:int):
+        super()._addLine(id, entry, offset, length)
+        if self.highest_version != None:
+            self.highest_version = max(
+                self.highest_version, entry.get('version', None) or 0)
+
+    def _getHeader(self):
+        header = super()._getHeader()
+        header['highest_version'] = self.getHighestVersion()
+        return header
+
+    def getHighestVersion(self):
+        if self.highest_version == None:
+            # kept from now on, and saved with the next index
+            self.highest_version = super().getHighestVersion()
+        return self.highest_version
+
+
+def mainBenchmark(sizes=(100000, 1000000), directory:str='./lazy_benchmark'):
+    """
+    Compare the start up time and peak memory
+    of UserDatabase and LazyUserDatabase
+    """
+    random.seed(0)
+    os.makedirs(directory, exist_ok=True)
+    def measure(name, open_database, n_users):
+        tracemalloc.start()
+        t = time.perf_counter()
+        user_database = open_database()
+        t = time.perf_counter()-t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name:>5}: started in {t*1000:9.1f}ms, peak {peak/2**10:9.0f}KiB')
+        return user_database
+
+    for n_users in sizes:
+        print(f'{n_users} users')
+        filename = os.path.join(directory, f'users_{n_users}.db')
+        paths = (filename, filename+'.entries', filename+'.index')
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        with open(filename, 'w') as f:
+            json.dump({'entries': [{
+                'username': f'user{i}',
+                'password_hash': random.getrandbits(256).to_bytes(32, 'big').hex(),
+                'uuid': str(uuid.UUID(int=random.getrandbits(128), version=4))
+            } for i in range(n_users)]}, f)
+        user_database = measure('json', lambda: database.UserDatabase(filename), n_users)
+        del user_database
+        # the first time, the JSON file is imported
+        LazyUserDatabase(filename).close()
+        user_database = measure('lazy', lambda: LazyUserDatabase(filename), n_users)
+        t = time.perf_counter()
+        for i in range(0, n_users, max(1, n_users//1000)):
+            assert user_database.findEntryByUsername(f'USER{i}')['username'] == f'user{i}'
+        t = (time.perf_counter()-t)/len(range(0, n_users, max(1, n_users//1000)))
+        print(f'       lookup by username: {t*1e6:.1f}us')
+        user_database.close()
+        for path in paths:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    import sys
+    sizes = [int(arg) for arg in sys.argv[1:]]
+    mainBenchmark(sizes or (100000, 1000000))
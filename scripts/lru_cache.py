@@ -0,0 +1,127 @@
+import collections
+import logging
+
+class LRUCache(object):
+    """
+    Least recently used cache with a budget in
+    bytes rather than a number of items.
+
+    get_size(value) gives the size of each item.
+    Items for which is_pinned(key) is True are
+    never evicted, and on_evict(key, value) is
+    called before an item is dropped, so that
+    unsaved changes can be written back first.
+    If every remaining item is pinned, the cache
+    is allowed to go over its budget.
+    max_items optionally limits the number of
+    items as well, e.g. when each holds open files.
+    """
+    def __init__(
+            self,
+            budget:int,
+            get_size,
+            is_pinned=None,
+            on_evict=None,
+            max_items:int=None):
+        self.budget = budget
+        self.max_items = max_items
+        self.get_size = get_size
+        self.is_pinned = is_pinned
+        self.on_evict = on_evict
+        # key: value, least recently used first
+        self.items = collections.OrderedDict()
+        # key: size when last measured
+        self.sizes = {}
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'LRUCache<{len(self.items)},{self.size}/{self.budget}>'
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        value = self.items.get(key, None)
+        if value == None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= self.sizes[key]
+        self.items[key] = value
+        self.items.move_to_end(key)
+        self.sizes[key] = self.get_size(value)
+        self.size += self.sizes[key]
+        self.evict()
+
+    def resize(self, key):
+        """
+        Measure an item again, after it changed
+        """
+        if not key in self.items:
+            return
+        size = self.get_size(self.items[key])
+        self.size += size-self.sizes[key]
+        self.sizes[key] = size
+        self.evict()
+
+    def pop(self, key, default=None):
+        if not key in self.items:
+            return default
+        self.size -= self.sizes.pop(key)
+        return self.items.pop(key)
+
+    def isOverBudget(self):
+        if self.max_items != None and len(self.items) > self.max_items:
+            return True
+        return self.size > self.budget
+
+    def evict(self):
+        """
+        Drop least recently used items until
+        the cache fits in its budget
+        """
+        n_pinned = 0
+        while self.isOverBudget() and n_pinned < len(self.items):
+            key, value = next(iter(self.items.items()))
+            if self.is_pinned != None and self.is_pinned(key):
+                # keep it, and don't check it again straight away
+                self.items.move_to_end(key)
+                n_pinned += 1
+                continue
+            if self.on_evict != None:
+                self.on_evict(key, value)
+            self.pop(key)
+            self.evictions += 1
+        if self.isOverBudget():
+            logging.debug(f'{self} is over budget, every item is pinned')
+
+    def clear(self):
+        """
+        Evict every item, pinned or not
+        """
+        for key, value in list(self.items.items()):
+            if self.on_evict != None:
+                self.on_evict(key, value)
+            self.pop(key)
+
+    def getStats(self):
+        return {
+            'items': len(self.items),
+            'size': self.size,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -12,6 +12,9 @@ class BackendFake():
     client:None
 
 class Worker:
+    # seconds between the client's idle callbacks
+    IDLE_INTERVAL = 1.0
+
     def __init__(self, callback_queue):
         self.backend = BackendFake()
         self.callback_queue = callback_queue
@@ -21,7 +24,13 @@ class Worker:
     
     def run(self):
         self.client = self.backend.client
+        last_idle_time = time.time()
         while 1:
             events, connected = self.client.eb_client.pump()
             for event in events:
-                self.sendCallback( (self.backend.processServerEvent, [event]) )
\ No newline at end of file
+                self.sendCallback( (self.backend.processServerEvent, [event]) )
+            # the client runs on the callback thread too,
+            # so its idle work is queued like the events
+            if len(events) == 0 and time.time()-last_idle_time >= self.IDLE_INTERVAL:
+                last_idle_time = time.time()
+                self.sendCallback( (self.client.onIdle, []) )
\ No newline at end of file
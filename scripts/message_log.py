@@ -0,0 +1,477 @@
+import bisect
+import io
+import logging
+import os
+import struct
+import zlib
+
+class MessageLog(object):
+    """
+    Append-only log of records (e.g. pickled
+    chat messages), split into segment files.
+
+    Each record is stored as its length and crc32,
+    followed by its bytes, so adding a record only
+    writes that record. Segments are named after
+    the index of their first record, and a new one
+    is started once the current one reaches
+    segment_size bytes. Only the last segment is
+    ever written to, and a torn record at its end
+    (from a crash mid-write) is truncated when
+    the log is opened.
+
+    The offsets file holds where each record starts
+    within its segment, so any record, or range of
+    records, can be read without reading the ones
+    before it. The files grow with every record, so
+    they're read with positional reads (os.pread,
+    or seek and read where there's none, like on
+    Windows) rather than memory mapped.
+
+    Segments of chats nobody reads any more can be
+    compressed with zlib (see compress). Compressed
+    segments are read transparently, and the last
+    one is decompressed again if a record is added.
+    """
+    HEADER = struct.Struct('<II')
+    OFFSET = struct.Struct('<Q')
+    SEGMENT_EXTENSION = '.seg'
+    # a compressed segment holds its uncompressed
+    # length, followed by the zlib stream
+    COMPRESSED_EXTENSION = '.seg.z'
+    COMPRESSED_HEADER = struct.Struct('<Q')
+    OFFSETS_FILENAME = 'offsets'
+
+    def __init__(self, directory:str, segment_size:int=4*2**20):
+        self.directory = directory
+        self.segment_size = segment_size
+        # index of the first record in each segment
+        self.segments = []
+        # first indexes of the segments that are compressed
+        self.compressed = set()
+        self.n_records = 0
+        self.last_segment_length = 0
+        # the last segment, open for appending
+        self.file = None
+        # the offsets file, open for reading and appending
+        self.offsets_file = None
+        # whether records were added since the last sync()
+        self.unsynced = False
+
+    def __repr__(self):
+        return f'MessageLog<{self.directory},{self.n_records}>'
+
+    def __len__(self):
+        return self.n_records
+
+    def _getOffsetsFilename(self):
+        return os.path.join(self.directory, self.OFFSETS_FILENAME)
+
+    def _getSegmentFilename(self, first_index:int):
+        return os.path.join(
+            self.directory, f'{first_index:012d}{self.SEGMENT_EXTENSION}')
+    
+    def _getCompressedFilename(self, first_index:int):
+        return os.path.join(
+            self.directory, f'{first_index:012d}{self.COMPRESSED_EXTENSION}')
+
+    def exists(self):
+        return os.path.isdir(self.directory)
+
+    def create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.open()
+
+    def open(self):
+        """
+        Find the log's segments, and check the end
+        of the last one. Returns False if there
+        is no log in the directory
+        """
+        self.close()
+        if not self.exists():
+            return False
+        names = os.listdir(self.directory)
+        segments = set(
+            int(name[:-len(self.SEGMENT_EXTENSION)])
+            for name in names if name.endswith(self.SEGMENT_EXTENSION))
+        self.compressed = set()
+        for name in names:
+            if not name.endswith(self.COMPRESSED_EXTENSION):
+                continue
+            first_index = int(name[:-len(self.COMPRESSED_EXTENSION)])
+            if first_index in segments:
+                # (de)compressing was interrupted, and the
+                # uncompressed segment is always complete
+                os.remove(os.path.join(self.directory, name))
+                continue
+            segments.add(first_index)
+            self.compressed.add(first_index)
+        self.segments = sorted(segments)
+        self.n_records = 0
+        self.last_segment_length = 0
+        self.offsets_file = open(self._getOffsetsFilename(), 'a+b')
+        if len(self.segments) == 0:
+            self.offsets_file.truncate(0)
+            return True
+        if self._isCleanlyClosed():
+            return True
+        first_index = self.segments[-1]
+        if first_index in self.compressed:
+            # segments are only compressed once they're on disk,
+            # so only the offsets can be wrong, not the segment
+            offsets = [end-len(record)-self.HEADER.size
+                for record, end in self._iterateSegment(first_index)]
+            self.n_records = first_index+len(offsets)
+            self.last_segment_length = self._getSegmentLength(first_index)
+            self._repairOffsets(offsets)
+            return True
+        filename = self._getSegmentFilename(first_index)
+        offsets = []
+        good_length = 0
+        for record, end in self._iterateSegment(first_index, check_tail=True):
+            offsets.append(end-len(record)-self.HEADER.size)
+            good_length = end
+        if os.path.getsize(filename) != good_length:
+            logging.warning(f'truncating torn record at the end of {filename}')
+            with open(filename, 'r+b') as f:
+                f.truncate(good_length)
+        self.n_records = first_index+len(offsets)
+        self.last_segment_length = good_length
+        self._repairOffsets(offsets)
+        return True
+
+    def _isCleanlyClosed(self):
+        """
+        Check whether the last offset points to an intact
+        record ending exactly at the end of the last segment,
+        in which case the segment doesn't need to be scanned
+        """
+        first_index = self.segments[-1]
+        offsets_length = os.fstat(self.offsets_file.fileno()).st_size
+        n_offsets = offsets_length//self.OFFSET.size
+        if offsets_length%self.OFFSET.size != 0 or n_offsets < first_index:
+            return False
+        if first_index in self.compressed:
+            # the segment can't be torn, but the offsets might
+            # not have reached the disk before a crash
+            segment_length = self._getSegmentLength(first_index)
+            if n_offsets > first_index:
+                offset = self._readOffsets(n_offsets-1, n_offsets)[0]
+                if offset+self.HEADER.size > segment_length:
+                    return False
+                data = self._readCompressedSegment(
+                    first_index, offset+self.HEADER.size)
+                length, _ = self.HEADER.unpack_from(data, offset)
+                if offset+self.HEADER.size+length != segment_length:
+                    return False
+            elif segment_length != 0:
+                return False
+            self.n_records = n_offsets
+            self.last_segment_length = segment_length
+            return True
+        with open(self._getSegmentFilename(first_index), 'rb') as f:
+            segment_length = os.fstat(f.fileno()).st_size
+            if n_offsets == first_index:
+                clean = segment_length == 0
+            else:
+                offset = self._readOffsets(n_offsets-1, n_offsets)[0]
+                header = self._readAt(f, self.HEADER.size, offset)
+                if len(header) != self.HEADER.size:
+                    return False
+                length, checksum = self.HEADER.unpack(header)
+                record = self._readAt(f, length, offset+self.HEADER.size)
+                clean = offset+self.HEADER.size+length == segment_length and \
+                    len(record) == length and zlib.crc32(record) == checksum
+        if clean:
+            self.n_records = n_offsets
+            self.last_segment_length = segment_length
+        return clean
+
+    def _repairOffsets(self, last_segment_offsets:list):
+        """
+        Make the offsets file match the segments. A crash
+        can only have left the last segment's offsets
+        wrong, which were just read, unless the offsets
+        file is missing, in which case it's rebuilt
+        """
+        first_index = self.segments[-1]
+        n_offsets = os.fstat(self.offsets_file.fileno()).st_size//self.OFFSET.size
+        if n_offsets < first_index:
+            logging.warning(f'rebuilding the offsets file of {self}')
+            self.offsets_file.truncate(0)
+            for segment_first_index in self.segments[:-1]:
+                self._writeOffsets(
+                    end-len(record)-self.HEADER.size
+                    for record, end in self._iterateSegment(segment_first_index))
+        else:
+            self.offsets_file.truncate(first_index*self.OFFSET.size)
+        self._writeOffsets(last_segment_offsets)
+        self.offsets_file.flush()
+
+    def _writeOffsets(self, offsets):
+        self.offsets_file.write(b''.join(
+            self.OFFSET.pack(offset) for offset in offsets))
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        if self.offsets_file != None:
+            self.offsets_file.close()
+            self.offsets_file = None
+
+    # ------------------------- reading
+    def _iterateSegment(self, first_index:int, check_tail:bool=False):
+        """
+        Yield (record, end offset) for each record
+        in a segment. With check_tail, reading stops
+        quietly at a torn or corrupt record, which
+        can only happen at the end of the last segment
+        """
+        filename = self._getSegmentFilename(first_index)
+        if first_index in self.compressed:
+            filename = self._getCompressedFilename(first_index)
+            f = io.BytesIO(self._readCompressedSegment(first_index))
+        else:
+            if self.file != None and first_index == self.segments[-1]:
+                self.file.flush()
+            f = open(filename, 'rb')
+        with f:
+            offset = 0
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) == 0:
+                    return
+                record = None
+                if len(header) == self.HEADER.size:
+                    length, checksum = self.HEADER.unpack(header)
+                    record = f.read(length)
+                    if len(record) != length or zlib.crc32(record) != checksum:
+                        record = None
+                if record == None:
+                    if check_tail:
+                        return
+                    raise ValueError(f'corrupt record at {offset} in {filename}')
+                offset += self.HEADER.size+len(record)
+                yield record, offset
+
+    @staticmethod
+    def _readAt(f, length:int, offset:int):
+        """
+        Read up to length bytes of a file from offset
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(f.fileno(), length, offset)
+        # os.pread doesn't exist on Windows
+        f.seek(offset)
+        return f.read(length)
+
+    def _readOffsets(self, start:int, stop:int):
+        data = self._readAt(
+            self.offsets_file,
+            (stop-start)*self.OFFSET.size,
+            start*self.OFFSET.size)
+        return [offset for offset, in self.OFFSET.iter_unpack(data)]
+
+    def readRange(self, start:int, stop:int):
+        """
+        Get the records from index start up to
+        (not including) stop, only reading those
+        records from disk
+        """
+        start = max(0, start)
+        stop = min(stop, self.n_records)
+        if start >= stop:
+            return []
+        if self.file != None:
+            self.file.flush()
+        offsets = self._readOffsets(start, stop)
+        records = []
+        index = start
+        while index < stop:
+            # read every wanted record in this segment at once
+            segment = bisect.bisect_right(self.segments, index)-1
+            next_first_index = self.n_records
+            if segment+1 < len(self.segments):
+                next_first_index = self.segments[segment+1]
+            segment_stop = min(stop, next_first_index)
+            first_index = self.segments[segment]
+            filename = self._getSegmentFilename(first_index)
+            begin = offsets[index-start]
+            end = None
+            if segment_stop < next_first_index:
+                end = self._readOffsets(segment_stop, segment_stop+1)[0]
+            if first_index in self.compressed:
+                filename = self._getCompressedFilename(first_index)
+                # the records before the range still have to be
+                # decompressed, but none of those after it
+                data = self._readCompressedSegment(first_index, end)[begin:]
+            else:
+                with open(filename, 'rb') as f:
+                    if end == None:
+                        end = os.fstat(f.fileno()).st_size
+                    data = self._readAt(f, end-begin, begin)
+            position = 0
+            for index in range(index, segment_stop):
+                length, checksum = self.HEADER.unpack_from(data, position)
+                position += self.HEADER.size
+                record = data[position:position+length]
+                if len(record) != length or zlib.crc32(record) != checksum:
+                    raise ValueError(f'corrupt record {index} in {filename}')
+                records.append(record)
+                position += length
+            index = segment_stop
+        return records
+
+    def getRecord(self, index:int):
+        if index < 0:
+            index += self.n_records
+        if index < 0 or index >= self.n_records:
+            raise IndexError(index)
+        return self.readRange(index, index+1)[0]
+
+    def iterateRecords(self, start:int=0):
+        """
+        Yield every record from index start
+        onwards, in the order they were added
+        """
+        for i, first_index in enumerate(self.segments):
+            if i+1 < len(self.segments) and self.segments[i+1] <= start:
+                continue
+            index = first_index
+            for record, end in self._iterateSegment(first_index):
+                if index >= start:
+                    yield record
+                index += 1
+
+    # ------------------------- compression
+    def _getSegmentLength(self, first_index:int):
+        """
+        Get the uncompressed length of a segment
+        """
+        if first_index in self.compressed:
+            with open(self._getCompressedFilename(first_index), 'rb') as f:
+                return self.COMPRESSED_HEADER.unpack(
+                    f.read(self.COMPRESSED_HEADER.size))[0]
+        return os.path.getsize(self._getSegmentFilename(first_index))
+    
+    def _readCompressedSegment(self, first_index:int, max_length:int=None):
+        """
+        Decompress a segment, or only its first
+        max_length bytes
+        """
+        with open(self._getCompressedFilename(first_index), 'rb') as f:
+            length, = self.COMPRESSED_HEADER.unpack(
+                f.read(self.COMPRESSED_HEADER.size))
+            if max_length == None:
+                max_length = length
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(f.read(), max_length)
+        if len(data) != min(length, max_length):
+            raise ValueError(f'corrupt compressed segment {first_index} of {self}')
+        return data
+    
+    def _writeSegmentFile(self, filename:str, data:bytes):
+        # write beside the real file then rename, so it's
+        # either complete or not there at all
+        temp_filename = filename+'.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    
+    def compressSegment(self, first_index:int, level:int=9):
+        """
+        Compress one segment, returning its size
+        before and after being compressed
+        """
+        if first_index in self.compressed:
+            size = os.path.getsize(self._getCompressedFilename(first_index))
+            return size, size
+        if self.file != None and first_index == self.segments[-1]:
+            self.sync()
+            self.file.close()
+            self.file = None
+        filename = self._getSegmentFilename(first_index)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        compressed_data = self.COMPRESSED_HEADER.pack(len(data))+\
+            zlib.compress(data, level)
+        self._writeSegmentFile(
+            self._getCompressedFilename(first_index), compressed_data)
+        self.compressed.add(first_index)
+        os.remove(filename)
+        return len(data), len(compressed_data)
+    
+    def compress(self, level:int=9):
+        """
+        Compress every segment, returning the log's
+        segments' size before and after
+        """
+        size = 0
+        compressed_size = 0
+        for first_index in self.segments:
+            before, after = self.compressSegment(first_index, level)
+            size += before
+            compressed_size += after
+        return size, compressed_size
+    
+    def _decompressSegment(self, first_index:int):
+        data = self._readCompressedSegment(first_index)
+        self._writeSegmentFile(self._getSegmentFilename(first_index), data)
+        self.compressed.discard(first_index)
+        os.remove(self._getCompressedFilename(first_index))
+    
+    # ------------------------- writing
+    def _startSegment(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        self.segments.append(self.n_records)
+        self.last_segment_length = 0
+
+    def append(self, record:bytes):
+        """
+        Add a record to the end of
+        the log, returning its index
+        """
+        return self.appendMany((record,))
+
+    def appendMany(self, records):
+        """
+        Add several records, returning
+        the index of the last one
+        """
+        for record in records:
+            if len(self.segments) == 0 or \
+                    self.last_segment_length >= self.segment_size:
+                self._startSegment()
+            if self.file == None:
+                if self.segments[-1] in self.compressed:
+                    self._decompressSegment(self.segments[-1])
+                self.file = open(self._getSegmentFilename(self.segments[-1]), 'ab')
+            offset = self.last_segment_length
+            self.file.write(self.HEADER.pack(len(record), zlib.crc32(record)))
+            self.file.write(record)
+            self.offsets_file.write(self.OFFSET.pack(offset))
+            self.last_segment_length += self.HEADER.size+len(record)
+            self.n_records += 1
+            self.unsynced = True
+        if self.file != None:
+            self.file.flush()
+            self.offsets_file.flush()
+        return self.n_records-1
+
+    def sync(self):
+        """
+        Make sure every record added
+        so far is on disk
+        """
+        if self.file != None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.offsets_file.flush()
+            os.fsync(self.offsets_file.fileno())
+        self.unsynced = False
@@ -0,0 +1,64 @@
+"""
+Import the JSON users.db and chats.db files
+into SQLite databases, for use with the
+server's sqlite storage option.
+
+usage:
+    python -m scripts.migrate_to_sqlite
+        [-users ./server/users.db]
+        [-chats ./server/chats.db]
+
+the SQLite files are written next to the
+JSON files, with a .sqlite extension
+"""
+import logging
+import os
+
+from scripts import database
+from scripts import sqlite_database
+from scripts import sys_args
+
+def getSQLiteFilename(json_filename:str):
+    return os.path.splitext(json_filename)[0]+'.sqlite'
+
+def migrateDatabase(json_database, sqlite_database):
+    """
+    Copy every entry of a JSON database
+    into an SQLite database. Entries that
+    already exist are skipped, so running
+    a migration twice is harmless.
+    Returns the number of entries copied
+    """
+    n_copied = 0
+    for entry in json_database.loaded_data['entries']:
+        if sqlite_database.append(entry):
+            n_copied += 1
+    sqlite_database.saveData()
+    return n_copied
+
+def openJsonDatabase(database_class, filename:str):
+    # include any changes still in the journal
+    journal = os.path.exists(filename+'.journal')
+    return database_class(filename, journal=journal)
+
+def main():
+    filename, kwargs = sys_args.getArgs(['users', 'chats'])
+    users_filename = kwargs.get('users', './server/users.db')
+    chats_filename = kwargs.get('chats', './server/chats.db')
+
+    migrations = (
+        (database.UserDatabase, sqlite_database.SQLiteUserDatabase, users_filename),
+        (database.ChatDatabase, sqlite_database.SQLiteChatDatabase, chats_filename))
+    for json_class, sqlite_class, json_filename in migrations:
+        json_database = openJsonDatabase(json_class, json_filename)
+        sqlite_filename = getSQLiteFilename(json_filename)
+        sqlite_db = sqlite_class(sqlite_filename)
+        n_copied = migrateDatabase(json_database, sqlite_db)
+        n_total = len(json_database.loaded_data['entries'])
+        print(f'{json_filename} -> {sqlite_filename}: '\
+            f'copied {n_copied} of {n_total} entries')
+        sqlite_db.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
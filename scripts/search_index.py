@@ -0,0 +1,431 @@
+import bisect
+import collections
+import difflib
+import heapq
+import random
+import re
+import string
+import time
+
+class UsernameIndex(object):
+    """
+    In-memory trigram and prefix index
+    over usernames, for fuzzy searching.
+
+    Candidates are gathered from the prefix
+    index and the trigrams of the query,
+    grouped by username length so the most
+    promising lengths are checked first, then
+    ranked the same way as get_close_matches.
+    This gives results very close to the old
+    difflib full scan, while only comparing
+    against a bounded number of usernames.
+    """
+    def __init__(
+            self,
+            cutoff:float=0.05,
+            candidates_per_result:int=4,
+            max_postings_scanned:int=5000):
+        # lowercase username of each id
+        self.usernames = []
+        # the value stored with each id
+        self.values = []
+        # lowercase username: id
+        self.ids_by_username = {}
+        # every lowercase username, sorted,
+        # for prefix matching
+        self.sorted_usernames = []
+        # trigram: {username length: list of ids}
+        self.trigrams = {}
+        # bigram: set of trigrams containing it
+        self.trigrams_by_bigram = {}
+
+        self.cutoff = cutoff
+        self.candidates_per_result = candidates_per_result
+        self.max_postings_scanned = max_postings_scanned
+
+    def __len__(self):
+        return len(self.ids_by_username)
+
+    @staticmethod
+    def getTrigrams(text:str):
+        """
+        Get the set of trigrams in some text.
+        The text is padded so that very short
+        queries and prefixes still match
+        """
+        padded = f'  {text} '
+        return {padded[i:i+3] for i in range(len(padded)-2)}
+
+    def _addWithoutSorting(self, username:str, value):
+        username_lower = username.lower()
+        if username_lower in self.ids_by_username:
+            return False
+        id = len(self.usernames)
+        self.usernames.append(username_lower)
+        self.values.append(value)
+        self.ids_by_username[username_lower] = id
+        length = len(username_lower)
+        for trigram in self.getTrigrams(username_lower):
+            postings_by_length = self.trigrams.get(trigram, None)
+            if postings_by_length == None:
+                postings_by_length = {}
+                self.trigrams[trigram] = postings_by_length
+                for bigram in (trigram[:2], trigram[1:]):
+                    self.trigrams_by_bigram.setdefault(bigram, set()).add(trigram)
+            postings = postings_by_length.get(length, None)
+            if postings == None:
+                postings = []
+                postings_by_length[length] = postings
+            postings.append(id)
+        return True
+
+    def add(self, username:str, value):
+        """
+        Add a username to the index, storing
+        value alongside it. Returns False if
+        the username is already indexed
+        """
+        if not self._addWithoutSorting(username, value):
+            return False
+        bisect.insort(self.sorted_usernames, username.lower())
+        return True
+
+    def addMany(self, pairs):
+        """
+        Add many (username, value) pairs to
+        the index at once, sorting only once
+        """
+        for username, value in pairs:
+            self._addWithoutSorting(username, value)
+        self.sorted_usernames = sorted(self.ids_by_username)
+
+    def remove(self, username:str):
+        """
+        Remove a username from the index, e.g. when
+        it's renamed. Its id is only marked as removed
+        rather than taken out of every trigram's postings.
+        Returns False if the username isn't indexed
+        """
+        username_lower = username.lower()
+        id = self.ids_by_username.pop(username_lower, None)
+        if id == None:
+            return False
+        self.usernames[id] = None
+        self.values[id] = None
+        del self.sorted_usernames[
+            bisect.bisect_left(self.sorted_usernames, username_lower)]
+        return True
+
+    def _getPrefixCandidates(self, query:str, limit:int):
+        start = bisect.bisect_left(self.sorted_usernames, query)
+        candidates = []
+        for username in self.sorted_usernames[start:start+limit]:
+            if not username.startswith(query):
+                break
+            candidates.append(self.ids_by_username[username])
+        return candidates
+
+    @staticmethod
+    def getBestPossibleRatio(length_a:int, length_b:int):
+        """
+        The highest difflib ratio two strings
+        of these lengths could possibly have
+        """
+        return 2*min(length_a, length_b)/(length_a+length_b)
+
+    def search(self, query:str, get_max:int):
+        """
+        Get the values of (up to) get_max
+        usernames most similar to the query,
+        best match first
+        """
+        query = query.lower()
+        if get_max <= 0 or len(query) == 0:
+            return []
+        limit = get_max*self.candidates_per_result
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        query_length = len(query)
+        query_letters = set(query)
+        # min-heap of the best (score, username, id) so far,
+        # which ranks exactly like difflib.get_close_matches
+        best = []
+        checked = set()
+        def check(ids):
+            for id in ids:
+                if id in checked:
+                    continue
+                checked.add(id)
+                username = self.usernames[id]
+                if username == None:
+                    # removed
+                    continue
+                # skip usernames that can't make it into the results
+                # before doing the expensive full comparison
+                threshold = self.cutoff
+                if len(best) == get_max:
+                    threshold = max(threshold, best[0][0])
+                # every letter of the username that's in the query
+                # at all, a cheap upper bound of quick_ratio's count
+                n_common = sum(map(query_letters.__contains__, username))
+                if 2.0*min(n_common, query_length)/(len(username)+query_length) \
+                        < threshold:
+                    continue
+                matcher.set_seq1(username)
+                if matcher.quick_ratio() < threshold:
+                    continue
+                score = matcher.ratio()
+                if score < self.cutoff:
+                    continue
+                item = (score, username, id)
+                if len(best) < get_max:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+
+        scanned = 0
+        def scanTrigrams(trigrams):
+            nonlocal scanned
+            postings_by_length = [self.trigrams[trigram]
+                for trigram in trigrams if trigram in self.trigrams]
+            lengths = set()
+            for postings in postings_by_length:
+                lengths.update(postings)
+            # usernames of similar length to the query can score the
+            # highest, so check those first, and stop once no username
+            # of the remaining lengths could beat the current results
+            lengths = sorted(lengths, reverse=True,
+                key=lambda length: self.getBestPossibleRatio(query_length, length))
+            for length in lengths:
+                if len(best) == get_max and \
+                        best[0][0] >= self.getBestPossibleRatio(query_length, length):
+                    break
+                if scanned >= self.max_postings_scanned:
+                    break
+                # within a length, prefer the usernames sharing the most
+                # trigrams, scanning the rarest (most selective) first
+                postings_lists = [postings[length]
+                    for postings in postings_by_length if length in postings]
+                postings_lists.sort(key=len)
+                counts = collections.Counter()
+                for postings in postings_lists:
+                    if len(counts) > 0 and scanned+len(postings) > self.max_postings_scanned:
+                        break
+                    counts.update(postings[:self.max_postings_scanned])
+                    scanned += len(postings)
+                check(id for id, count in counts.most_common(limit))
+
+        check(self._getPrefixCandidates(query, limit))
+        query_trigrams = self.getTrigrams(query)
+        scanTrigrams(query_trigrams)
+        if len(best) < get_max:
+            # not enough usernames share a trigram with the query,
+            # so widen the search to those sharing a pair of letters
+            fallback_trigrams = set()
+            for i in range(query_length-1):
+                fallback_trigrams.update(
+                    self.trigrams_by_bigram.get(query[i:i+2], ()))
+            scanTrigrams(fallback_trigrams-query_trigrams)
+        if len(best) < get_max and len(self.usernames) <= self.max_postings_scanned:
+            # small enough to simply check every username,
+            # catching matches of only a few single letters
+            check(range(len(self.usernames)))
+
+        best.sort(reverse=True)
+        return [self.values[id] for score, username, id in best]
+
+
+class MessageIndex(object):
+    """
+    In-memory inverted index over the text of
+    chat messages, mapping each word to the
+    messages containing it.
+
+    Messages are identified by chat uuid and
+    sequence id, stored together as one int
+    (chat id << 32 | seq) to keep the postings
+    small. The last word of a query also matches
+    as a prefix, so results show while typing.
+    """
+    WORD_PATTERN = re.compile(r'\w+')
+
+    def __init__(self):
+        # chat uuid of each chat id
+        self.chats = []
+        # chat uuid: chat id
+        self.chat_ids = {}
+        # word: set of message keys
+        self.postings = {}
+        # every word, sorted, for prefix matching
+        self.sorted_words = []
+        # every message key indexed so far
+        self.indexed = set()
+
+    def __len__(self):
+        return len(self.indexed)
+
+    @classmethod
+    def getWords(cls, text:str):
+        return set(cls.WORD_PATTERN.findall(text.lower()))
+
+    def _getKey(self, chat_uuid:str, seq:int, add:bool=False):
+        chat_id = self.chat_ids.get(chat_uuid, None)
+        if chat_id == None:
+            if not add:
+                return None
+            chat_id = len(self.chats)
+            self.chats.append(chat_uuid)
+            self.chat_ids[chat_uuid] = chat_id
+        return chat_id << 32 | seq
+
+    def isIndexed(self, chat_uuid:str, seq:int):
+        return self._getKey(chat_uuid, seq) in self.indexed
+
+    def add(self, chat_uuid:str, seq:int, text:str):
+        """
+        Index a message. Returns False if
+        it was already indexed
+        """
+        return self.addWords(chat_uuid, seq, self.getWords(text))
+
+    def addWords(self, chat_uuid:str, seq:int, words):
+        """
+        Index a message by its words (see getWords)
+        """
+        key = self._getKey(chat_uuid, seq, add=True)
+        if key in self.indexed:
+            return False
+        self.indexed.add(key)
+        for word in words:
+            keys = self.postings.get(word, None)
+            if keys == None:
+                keys = set()
+                self.postings[word] = keys
+                bisect.insort(self.sorted_words, word)
+            keys.add(key)
+        return True
+
+    def _getPrefixKeys(self, prefix:str, max_words:int=1000):
+        keys = set()
+        start = bisect.bisect_left(self.sorted_words, prefix)
+        for word in self.sorted_words[start:start+max_words]:
+            if not word.startswith(prefix):
+                break
+            keys.update(self.postings[word])
+        return keys
+
+    def search(self, query:str, get_max:int=50):
+        """
+        Get (chat uuid, seq) of up to get_max messages
+        containing every word of the query, those
+        furthest into their chat first
+        """
+        words = self.WORD_PATTERN.findall(query.lower())
+        if len(words) == 0 or get_max <= 0:
+            return []
+        # the rarest word first, so the intersection stays small
+        keys_lists = [self.postings.get(word, set()) for word in words[:-1]]
+        keys_lists.sort(key=len)
+        keys = None
+        for word_keys in keys_lists:
+            keys = set(word_keys) if keys == None else keys & word_keys
+            if len(keys) == 0:
+                return []
+        prefix_keys = self._getPrefixKeys(words[-1])
+        keys = prefix_keys if keys == None else keys & prefix_keys
+        found = heapq.nlargest(get_max, keys, key=lambda key: (key & 0xffffffff, key))
+        return [(self.chats[key >> 32], key & 0xffffffff) for key in found]
+
+    def getState(self):
+        """
+        Get the index as plain data, to be stored
+        """
+        return {
+            'chats': self.chats,
+            'postings': {word: list(keys) for word, keys in self.postings.items()}
+        }
+
+    @classmethod
+    def fromState(cls, state:dict):
+        index = cls()
+        if state == None:
+            return index
+        index.chats = list(state['chats'])
+        index.chat_ids = {chat_uuid: chat_id
+            for chat_id, chat_uuid in enumerate(index.chats)}
+        for word, keys in state['postings'].items():
+            index.postings[word] = set(keys)
+            index.indexed.update(keys)
+        index.sorted_words = sorted(index.postings)
+        return index
+
+
+def mainBenchmark(n_users:int=1000000, n_queries:int=200, get_max:int=10):
+    """
+    Compare the index against the previous
+    difflib.get_close_matches full scan
+    """
+    random.seed(0)
+    letters = string.ascii_lowercase
+    # pronounceable names, so that usernames
+    # share trigrams like real ones do
+    syllables = [a+b for a in 'bcdfghjklmnprstvwz' for b in 'aeiou']
+    def randomUsername():
+        name = ''.join(random.choice(syllables) for _ in range(random.randint(2, 4)))
+        if random.random() < 0.5:
+            name += str(random.randint(0, 999))
+        return name
+    # sorted, since set order changes between runs with the string hash seed
+    usernames = sorted({randomUsername() for _ in range(n_users)})
+    print(f'{len(usernames)} unique usernames')
+
+    t = time.perf_counter()
+    index = UsernameIndex()
+    index.addMany((username, username) for username in usernames)
+    print(f'index built in {time.perf_counter()-t:.2f}s')
+
+    queries = []
+    for _ in range(n_queries):
+        username = random.choice(usernames)
+        start = random.randint(0, max(0, len(username)-3))
+        query = username[start:start+random.randint(2, 6)]
+        if random.random() < 0.3:
+            query = query.replace(query[0], random.choice(letters), 1)
+        queries.append(query)
+
+    t = time.perf_counter()
+    indexed_results = [index.search(query, get_max) for query in queries]
+    t_index = (time.perf_counter()-t)/len(queries)
+    print(f'index:  {t_index*1000:.3f}ms per query')
+
+    # the full scan is very slow, so only time a few queries
+    n_difflib = min(len(queries), 5)
+    t = time.perf_counter()
+    difflib_results = [
+        difflib.get_close_matches(query, usernames, n=get_max, cutoff=0.05)
+        for query in queries[:n_difflib]]
+    t_difflib = (time.perf_counter()-t)/n_difflib
+    print(f'difflib: {t_difflib*1000:.3f}ms per query')
+
+    # many usernames share a score, so rather than comparing
+    # the exact lists, count how many of the index's results
+    # score at least as well as the worst difflib result
+    def getScore(query, username):
+        return difflib.SequenceMatcher(None, username, query).ratio()
+    equivalent = []
+    for query, indexed, full in zip(queries, indexed_results, difflib_results):
+        if len(full) == 0:
+            continue
+        worst_score = getScore(query, full[-1])
+        n_as_good = len([username for username in indexed
+            if getScore(query, username) >= worst_score])
+        equivalent.append(n_as_good/len(full))
+    if len(equivalent) > 0:
+        print(f'results ranked as well as difflib: '\
+            f'{sum(equivalent)/len(equivalent)*100:.1f}%')
+
+
+if __name__ == '__main__':
+    import sys
+    mainBenchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,411 @@
+import difflib
+import json
+import logging
+import sqlite3
+
+from scripts import database
+from scripts import search_index
+from scripts.database import IndexedField
+
+class SQLiteDatabase(database.Database):
+    """
+    Database stored in an SQLite file, with the
+    same interface as the JSON file Database.
+
+    Entries are only read from the file when they
+    are looked up, so memory use doesn't grow with
+    the number of entries. Indexed fields get
+    SQLite (B-tree) indexes, and list fields are
+    stored as JSON, with indexed list fields also
+    getting a side table of (entry, item) rows.
+
+    Entries returned are copies, so like journal
+    mode, all changes must go through the mutation
+    functions (setEntryField etc.) to be stored.
+    """
+    def __init__(self, *args, **kwargs):
+        self.connection = None
+        super().__init__(*args, **kwargs)
+        assert self.primary_key != None, \
+            "sqlite databases require a unique, case sensitive indexed field"
+
+    def __repr__(self):
+        return f'SQLiteDatabase<{self.filename}>'
+
+    # ------------------------- schema
+    @staticmethod
+    def _quote(name:str):
+        return f'"{name}"'
+
+    def _getFieldType(self, field:str):
+        s_value = self.entry_structure[field]
+        if isinstance(s_value, IndexedField):
+            s_value = s_value.value_type
+        return s_value
+
+    def _isListField(self, field:str):
+        return self._getFieldType(field) == list
+
+    @staticmethod
+    def _getLowerColumn(field:str):
+        # case insensitive fields keep a lowercase copy,
+        # as sqlite's NOCASE only folds ascii letters
+        return f'{field}__lower'
+
+    def _getListTable(self, field:str):
+        return f'entries__{field}'
+
+    def _createSchema(self):
+        columns = ['"rowid_" INTEGER PRIMARY KEY']
+        for field in self.entry_structure:
+            field_type = self._getFieldType(field)
+            sql_type = 'TEXT'
+            if field_type in (int, bool):
+                sql_type = 'INTEGER'
+            elif field_type == float:
+                sql_type = 'REAL'
+            columns.append(f'{self._quote(field)} {sql_type}')
+        for field, s_value in self.indexed_fields.items():
+            if not s_value.match_case and not s_value.multi_valued:
+                columns.append(f'{self._quote(self._getLowerColumn(field))} TEXT')
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS entries ({", ".join(columns)})')
+        # add columns for fields added to the entry
+        # structure since the database was created
+        existing_columns = {row[1] for row in
+            self.connection.execute('PRAGMA table_info(entries)')}
+        for column in columns[1:]:
+            name = column.split('"')[1]
+            if not name in existing_columns:
+                self.connection.execute(f'ALTER TABLE entries ADD COLUMN {column}')
+
+        for field, s_value in self.indexed_fields.items():
+            unique = 'UNIQUE ' if s_value.unique else ''
+            if s_value.multi_valued:
+                table = self._quote(self._getListTable(field))
+                self.connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} ('
+                    f'entry_id INTEGER NOT NULL, item TEXT NOT NULL)')
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS '
+                    f'{self._quote("idx_"+self._getListTable(field))} '
+                    f'ON {table}(item)')
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS '
+                    f'{self._quote("idx_"+self._getListTable(field)+"_entry")} '
+                    f'ON {table}(entry_id)')
+                continue
+            column = field
+            if not s_value.match_case:
+                column = self._getLowerColumn(field)
+            self.connection.execute(
+                f'CREATE {unique}INDEX IF NOT EXISTS {self._quote("idx_"+column)} '
+                f'ON entries({self._quote(column)})')
+
+    def _prepareStatements(self):
+        # the statements are always built from the same
+        # text, so sqlite3 compiles each of them only once
+        # and reuses it from its statement cache
+        fields = list(self.entry_structure)
+        self.select_columns = ', '.join(
+            ['"rowid_"']+[self._quote(field) for field in fields])
+        insert_columns = fields+[
+            self._getLowerColumn(field)
+            for field, s_value in self.indexed_fields.items()
+            if not s_value.match_case and not s_value.multi_valued]
+        self.insert_columns = insert_columns
+        self.sql_insert = (
+            f'INSERT INTO entries ({", ".join(self._quote(c) for c in insert_columns)}) '
+            f'VALUES ({", ".join("?" for c in insert_columns)})')
+        self.sql_rowid_by_key = (
+            f'SELECT "rowid_" FROM entries WHERE {self._quote(self.primary_key)} = ?')
+
+    def loadData(self):
+        """
+        Open (or create) the database file.
+        Nothing is read into memory
+        """
+        if self.connection != None:
+            self.connection.close()
+        self.connection = sqlite3.connect(
+            self.filename or ':memory:', cached_statements=256)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # with WAL, NORMAL is still safe from corruption,
+        # and only fsyncs at checkpoints
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self._createSchema()
+        self._prepareStatements()
+        self.connection.commit()
+        self.valid_fields = list(self.entry_structure)
+        self.loaded_data = None
+        return True
+
+    def saveData(self):
+        self.connection.commit()
+        self.modified = False
+        return True
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    # ------------------------- conversion
+    def _encodeValue(self, field:str, value):
+        if field in self.entry_structure and self._isListField(field):
+            return json.dumps(value)
+        return value
+
+    def _rowToEntry(self, row):
+        entry = {}
+        for field, value in zip(self.entry_structure, row[1:]):
+            if value == None:
+                continue
+            if self._isListField(field):
+                value = json.loads(value)
+            entry[field] = value
+        return entry
+
+    def _getRowId(self, entry):
+        row = self.connection.execute(
+            self.sql_rowid_by_key, (entry[self.primary_key],)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    # ------------------------- adding entries
+    def append(self, entry):
+        """appends a new entry to the database"""
+        is_valid = database.DatabaseUtil.matchEntryToStructure(
+            entry, self.entry_structure)
+        if not is_valid:
+            return False
+        values = []
+        for column in self.insert_columns:
+            if column in self.entry_structure:
+                value = entry.get(column, None)
+                if value != None:
+                    value = self._encodeValue(column, value)
+            else:
+                # lowercase copy of a case insensitive field
+                value = entry.get(column[:-len('__lower')], None)
+                if value != None:
+                    value = value.lower()
+            values.append(value)
+        try:
+            cursor = self.connection.execute(self.sql_insert, values)
+        except sqlite3.IntegrityError:
+            # a unique field's value is already taken
+            return False
+        rowid = cursor.lastrowid
+        for field, s_value in self.indexed_fields.items():
+            if s_value.multi_valued and field in entry:
+                self._insertListItems(field, rowid, entry[field])
+        self.markModified()
+        return True
+
+    def _insertListItems(self, field:str, rowid:int, items):
+        table = self._quote(self._getListTable(field))
+        self.connection.executemany(
+            f'INSERT INTO {table} (entry_id, item) VALUES (?, ?)',
+            [(rowid, item) for item in set(items)])
+
+    # ------------------------- entry mutation
+    def _updateField(self, entry, field:str):
+        rowid = self._getRowId(entry)
+        if rowid == None:
+            logging.warning(
+                f'cannot update missing entry '\
+                f'{entry.get(self.primary_key, None)} in {self.filename}')
+            return
+        value = entry[field]
+        assignments = [f'{self._quote(field)} = ?']
+        values = [self._encodeValue(field, value)]
+        s_value = self.indexed_fields.get(field, None)
+        if s_value != None and not s_value.match_case and not s_value.multi_valued:
+            assignments.append(f'{self._quote(self._getLowerColumn(field))} = ?')
+            values.append(value.lower())
+        self.connection.execute(
+            f'UPDATE entries SET {", ".join(assignments)} WHERE "rowid_" = ?',
+            values+[rowid])
+        if s_value != None and s_value.multi_valued:
+            table = self._quote(self._getListTable(field))
+            self.connection.execute(
+                f'DELETE FROM {table} WHERE entry_id = ?', (rowid,))
+            self._insertListItems(field, rowid, value)
+        self.markModified()
+
+    def setEntryField(self, entry, field, value):
+        """
+        Set the value of one of an entry's fields
+        """
+        if field == self.primary_key:
+            # the row is found by the old key
+            rowid = self._getRowId(entry)
+            entry[field] = value
+            self.connection.execute(
+                f'UPDATE entries SET {self._quote(field)} = ? WHERE "rowid_" = ?',
+                (value, rowid))
+            self.markModified()
+            return
+        entry[field] = value
+        self._updateField(entry, field)
+
+    def appendToEntryField(self, entry, field, item):
+        """
+        Append an item to one of an entry's list fields
+        """
+        entry[field].append(item)
+        self._updateField(entry, field)
+
+    def removeFromEntryField(self, entry, field, item):
+        """
+        Remove an item from one of an entry's list fields
+        """
+        entry[field].remove(item)
+        self._updateField(entry, field)
+
+    # ------------------------- searching
+    def _selectEntries(self, field, value, match_case, limit=None):
+        s_value = self.indexed_fields.get(field, None)
+        if s_value != None and s_value.multi_valued:
+            table = self._quote(self._getListTable(field))
+            sql = (f'SELECT {self.select_columns} FROM entries WHERE "rowid_" IN '
+                f'(SELECT entry_id FROM {table} WHERE item = ?)')
+            params = [value]
+            if not match_case and s_value.match_case:
+                # no case insensitive index, so check every entry
+                sql = f'SELECT {self.select_columns} FROM entries'
+                params = []
+        elif match_case:
+            sql = f'SELECT {self.select_columns} FROM entries WHERE {self._quote(field)} = ?'
+            params = [value]
+        elif s_value != None and not s_value.match_case:
+            sql = (f'SELECT {self.select_columns} FROM entries '
+                f'WHERE {self._quote(self._getLowerColumn(field))} = ?')
+            params = [value.lower()]
+        else:
+            sql = (f'SELECT {self.select_columns} FROM entries '
+                f'WHERE lower({self._quote(field)}) = ?')
+            params = [value.lower()]
+        cursor = self.connection.execute(sql, params)
+        entries = []
+        for row in cursor:
+            entry = self._rowToEntry(row)
+            if s_value != None and s_value.multi_valued and not match_case:
+                value_lower = value.lower()
+                if not value_lower in (item.lower() for item in entry.get(field, [])):
+                    continue
+            entries.append(entry)
+            if limit != None and len(entries) >= limit:
+                break
+        return entries
+
+    def findEntriesByField(self, field, value, validate_field=False, match_case=True):
+        """
+        Find every entry with a field matching value.
+        For list fields, finds every entry whose
+        list contains value
+        """
+        if validate_field and (not field in self.valid_fields):
+            return []
+        return self._selectEntries(field, value, match_case)
+
+    def findEntryByField(self, field, value, validate_field=False, match_case=True):
+        if validate_field and (not field in self.valid_fields):
+            return None
+        found = self._selectEntries(field, value, match_case, limit=1)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def iterateEntries(self):
+        """
+        Iterate over every entry, without
+        loading them all into memory at once
+        """
+        cursor = self.connection.execute(
+            f'SELECT {self.select_columns} FROM entries ORDER BY "rowid_"')
+        for row in cursor:
+            yield self._rowToEntry(row)
+
+
+class SQLiteUserDatabase(SQLiteDatabase, database.UserDatabase):
+    """
+    UserDatabase stored in SQLite. Username search
+    uses a trigram table rather than an in-memory
+    index, so no per-user data is kept in memory
+    """
+    def _createSchema(self):
+        super()._createSchema()
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS username_trigrams ('
+            'trigram TEXT NOT NULL, entry_id INTEGER NOT NULL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_username_trigrams '
+            'ON username_trigrams(trigram)')
+
+    def append(self, entry):
+        if not super().append(entry):
+            return False
+        self._insertTrigrams(self._getRowId(entry), entry['username'])
+        return True
+
+    def _insertTrigrams(self, rowid:int, username:str):
+        self.connection.executemany(
+            'INSERT INTO username_trigrams (trigram, entry_id) VALUES (?, ?)',
+            [(trigram, rowid) for trigram in
+                search_index.UsernameIndex.getTrigrams(username.lower())])
+
+    def setEntryField(self, entry, field, value):
+        super().setEntryField(entry, field, value)
+        if field == 'username':
+            rowid = self._getRowId(entry)
+            self.connection.execute(
+                'DELETE FROM username_trigrams WHERE entry_id = ?', (rowid,))
+            self._insertTrigrams(rowid, value)
+
+    def searchByUsername(self, query:str, get_max:int, candidates_per_result:int=8):
+        """
+        Get (up to) get_max entries with usernames
+        similar to the query, best match first
+        """
+        query = query.lower()
+        if get_max <= 0 or len(query) == 0:
+            return []
+        limit = get_max*candidates_per_result
+        lower_column = self._quote(self._getLowerColumn('username'))
+        # usernames starting with the query
+        rows = self.connection.execute(
+            f'SELECT {self.select_columns} FROM entries '
+            f'WHERE {lower_column} >= ? AND {lower_column} < ? LIMIT ?',
+            (query, query+'\U0010ffff', limit)).fetchall()
+        # usernames sharing the most trigrams with the query
+        trigrams = list(search_index.UsernameIndex.getTrigrams(query))
+        rows += self.connection.execute(
+            f'SELECT {self.select_columns} FROM entries WHERE "rowid_" IN ('
+            f'SELECT entry_id FROM username_trigrams '
+            f'WHERE trigram IN ({", ".join("?" for t in trigrams)}) '
+            f'GROUP BY entry_id ORDER BY COUNT(*) DESC LIMIT ?)',
+            trigrams+[limit]).fetchall()
+        entries_by_username = {}
+        for row in rows:
+            entry = self._rowToEntry(row)
+            entries_by_username.setdefault(entry['username'].lower(), entry)
+        # rank the candidates the same way as UsernameIndex
+        best = difflib.get_close_matches(
+            query, list(entries_by_username), n=get_max, cutoff=0.05)
+        return [entries_by_username[username] for username in best]
+
+
+class SQLiteChatDatabase(SQLiteDatabase, database.ChatDatabase):
+    """
+    ChatDatabase stored in SQLite
+    """
+    def getHighestVersion(self):
+        row = self.connection.execute(
+            'SELECT MAX("version") FROM entries').fetchone()
+        return row[0] or 0
@@ -38,14 +38,24 @@ class Time:
         dtt = d.timetuple()
         return int(time.mktime(dtt))
     @staticmethod
-    def UTCToLocal(utc_ts):
+    def getUTCOffset():
         """
-        Convert a UTC timestamp
-        to a local datetime
+        Get the current offset of local
+        time from UTC, as a timedelta
         """
-        utc_datetime = datetime.fromtimestamp(utc_ts)
         local_ts = time.time()
         local_datetime = datetime.fromtimestamp(local_ts)
         utc_now = datetime.utcfromtimestamp(local_ts)
-        offset = local_datetime - utc_now
+        return local_datetime - utc_now
+    @staticmethod
+    def UTCToLocal(utc_ts, offset=None):
+        """
+        Convert a UTC timestamp
+        to a local datetime. When converting
+        many, get the offset once with
+        getUTCOffset and pass it in
+        """
+        utc_datetime = datetime.fromtimestamp(utc_ts)
+        if offset == None:
+            offset = Time.getUTCOffset()
         return utc_datetime + offset
\ No newline at end of file
@@ -11,27 +11,104 @@ from scripts.ebsockets.connections import (ebsocket_client, ebsocket_event,
 from scripts.ebsockets.connections import utility as ebsockets_utility
 from scripts import passwords
 from server import datatypes
+from scripts import compact_database
 from scripts import database
+from scripts import lazy_database
+from scripts import sqlite_database
+from scripts import sys_args
+from scripts import utilities
 from scripts import e2e_handshakes
-from scripts.crypto import DataPacket
+from scripts.crypto import DataPacket, SealedPacket, KEY_SUITES
 
 local_ip = ebsockets_utility.get_local_ip()
 server_addr = (local_ip, 9365)
 server = ebsocket_server(server_addr)
 system = ebsocket_system(server)
 
-user_manager = datatypes.UserManager(
-    user_database=database.UserDatabase('./server/users.db'))
+# database saves made within 50ms of each
+# other are grouped into a single write
+flush_scheduler = database.FlushScheduler(window=0.05)
+
+_, server_args = sys_args.getArgs(['storage', 'chat_cache_mb', 'cold_after_days'])
+if server_args.get('storage', 'json') == 'sqlite':
+    # run scripts/migrate_to_sqlite.py first to
+    # import the existing json databases
+    user_database = sqlite_database.SQLiteUserDatabase(
+        './server/users.sqlite', flush_scheduler=flush_scheduler)
+    chats_database = sqlite_database.SQLiteChatDatabase(
+        './server/chats.sqlite', flush_scheduler=flush_scheduler)
+elif server_args.get('storage', 'json') == 'lazy':
+    # entries are read from disk when they're needed, so
+    # starting up doesn't get slower as the databases grow.
+    # the json databases are imported the first time
+    user_database = lazy_database.LazyUserDatabase(
+        './server/users.db', flush_scheduler=flush_scheduler)
+    chats_database = lazy_database.LazyChatDatabase(
+        './server/chats.db', flush_scheduler=flush_scheduler)
+else:
+    # the databases append changes to a journal rather
+    # than rewriting the whole file every time they save
+    user_database_class = database.UserDatabase
+    if server_args.get('storage', 'json') == 'compact':
+        # same files, but users are held in far less memory
+        user_database_class = compact_database.CompactUserDatabase
+    user_database = user_database_class(
+        './server/users.db', journal=True, flush_scheduler=flush_scheduler)
+    chats_database = database.ChatDatabase(
+        './server/chats.db', journal=True, flush_scheduler=flush_scheduler)
+user_manager = datatypes.UserManager(user_database=user_database)
 chats_manager = datatypes.ChatManager(
-    chats_database=database.ChatDatabase('./server/chats.db'))
+    chats_database=chats_database,
+    cache_budget=int(server_args.get('chat_cache_mb', 64))*2**20)
+# keep the chats of online users cached
+chats_manager.setOnlineCheck(user_manager.isUserConnected)
+# compress the messages of chats nobody has used in a while
+chats_manager.startTiering(
+    inactive_after=float(server_args.get('cold_after_days', 30))*86400)
 e2e_handshake_manager = e2e_handshakes.HandshakeManager()
 e2e_pending_chats = []
 
 users = []
 
+def getChatsListData(chats:list):
+    # only the chat information that the user needs to know-
+    # Don't send over the participant list unless required,
+    # to save bandwidth
+    return [{
+        'uuid': chat['uuid'],
+        'name': chat['name'],
+        'last_message_ts': chat['last_message_ts'],
+        'epoch': chats_manager.getCurrentEpoch(chat),
+        'epoch_keys': chats_manager.getEpochKeys(chat)}
+        for chat in chats]
+
+def isOptionalInt(value):
+    # sequence ids and counts sent by clients are used in
+    # arithmetic, so anything else would raise in the loop
+    return value == None or type(value) == int
+
+def sendCatchUp(conn, user_instance):
+    """
+    Send the next batches of a user's missed messages,
+    until CATCH_UP_WINDOW batches are waiting to be
+    acknowledged, or every batch has been sent
+    """
+    while user_instance.catch_up != None and \
+            user_instance.catch_up_in_flight < datatypes.CATCH_UP_WINDOW:
+        batch = next(user_instance.catch_up, None)
+        if batch == None:
+            user_instance.catch_up = None
+            user_instance.catch_up_in_flight = 0
+            system.send_event_to(conn, ebsocket_event('CATCH_UP_DONE'))
+            return
+        system.send_event_to(conn, ebsocket_event('CATCH_UP_BATCH', chats=batch))
+        user_instance.catch_up_in_flight += 1
+
 def serverMain():
     process_extra_events = []
 
+    # don't sleep past the next group commit
+    system.timeout = flush_scheduler.getTimeout(0.5)
     n_clients, n_events, d_clients = system.pump()
     process_extra_events.extend(e2e_handshake_manager.checkForUpdates())
 
@@ -95,27 +172,77 @@ def serverMain():
             continue
         
         if event.event == 'REQUEST_CHATS_LIST':
-            chats = chats_manager.getChatsByParticipant(user_uuid)
-            # create a list that contains only the chat information
-            # that the user needs to know- Don't send over the
-            # participant list unless required, to save bandwidth
-            send_list = []
-            for chat in sorted(chats, key=lambda chat: chat['last_message_ts'], reverse=True):
-                chat_data = {
-                    'uuid': chat['uuid'],
-                    'name': chat['name']}
-                send_list.append(chat_data)
+            # with since_version, only send the chats that
+            # changed since the client last fetched its list
+            since_version = event.get_attribute('since_version')
+            if not isOptionalInt(since_version):
+                logging.warn('ignoring chats list request with invalid version')
+                continue
+            chats, version = chats_manager.getChatsChangedSince(
+                user_uuid, since_version)
             n_event = ebsocket_event(
                 'REQUEST_CHATS_LIST_FILLED',
-                chats=send_list)
+                chats=getChatsListData(chats),
+                version=version,
+                is_delta=since_version != None)
             system.send_event_to(conn, n_event)
         
+        elif event.event == 'REQUEST_CATCH_UP':
+            # a reconnecting client gives the chats list version
+            # and the last message it has of each chat, and gets
+            # the changed chats, then every missed message in
+            # batches, paced by its acknowledgements
+            since_version = event.get_attribute('since_version')
+            positions = event.get_attribute('positions') or {}
+            if not isOptionalInt(since_version) or type(positions) != dict or \
+                    not all(type(chat_uuid) == str and type(seq) == int
+                        for chat_uuid, seq in positions.items()):
+                logging.warn('ignoring catch up request with invalid positions')
+                continue
+            chats, version = chats_manager.getChatsChangedSince(
+                user_uuid, since_version)
+            n_event = ebsocket_event(
+                'REQUEST_CHATS_LIST_FILLED',
+                chats=getChatsListData(chats),
+                version=version,
+                is_delta=since_version != None)
+            system.send_event_to(conn, n_event)
+            user_instance.catch_up = chats_manager.iterateCatchUp(
+                chats, positions, user_manager)
+            user_instance.catch_up_in_flight = 0
+            sendCatchUp(conn, user_instance)
+        
+        elif event.event == 'REQUEST_EXPORT_CHAT':
+            # the whole chat is streamed in chunks, so neither
+            # side ever has to hold all of it at once
+            chat_uuid = event.chat_uuid
+            if not chats_manager.isUserInChat(chat_uuid, user_uuid):
+                continue
+            chat = chats_manager.getChatByUUID(chat_uuid)
+            system.send_stream_to(
+                conn,
+                'EXPORT_CHAT_CHUNK',
+                chats_manager.iterateChatExport(chat, user_manager),
+                chat_uuid=chat_uuid,
+                epoch_keys=chats_manager.getEpochKeys(chat))
+        
+        elif event.event == 'CATCH_UP_ACK':
+            user_instance.catch_up_in_flight = max(
+                0, user_instance.catch_up_in_flight-1)
+            sendCatchUp(conn, user_instance)
+        
         elif event.event == 'REQUEST_CREATE_CHAT':
             chat_name = event.chat_name
             participants = event.participants
             participants.append(user_uuid)
             creator_uuid = user_uuid
-            chat_uuid = chats_manager.createNewChat(creator_uuid, None, chat_name, participants)
+            # the suite of the chat's keys, older clients only know RSA
+            key_suite = event.get_attribute('key_suite') or 'rsa'
+            if not key_suite in KEY_SUITES:
+                logging.warn(f'unknown key suite {key_suite}, using rsa')
+                key_suite = 'rsa'
+            chat_uuid = chats_manager.createNewChat(
+                creator_uuid, None, chat_name, participants, key_suite)
             logging.debug(f'creating chat, uuid {chat_uuid}, creator uuid {creator_uuid}, chat name "{chat_name}"')
             if chat_uuid == False:
                 logging.warn('error creating chat')
@@ -129,18 +256,25 @@ def serverMain():
                 'NEW_CHAT_CREATED',
                 chat_data={
                     'uuid': chat_uuid,
-                    'name': chat_name
+                    'name': chat_name,
+                    'last_message_ts': utilities.Time.getUTCTs(),
+                    'epoch': -1,
+                    'epoch_keys': []
                 }
             )
             for conn_other in user_manager.iterateConnectedUsers(participants):
                 print('send event to', conn_other)
                 system.send_event_to(conn_other, n_event)
             # tell the creator of the chat to create a key pair
-            n_event = ebsocket_event('CREATE_NEW_KEYS', encryption_key_id='c_'+chat_uuid)
+            n_event = ebsocket_event(
+                'CREATE_NEW_KEYS',
+                encryption_key_id='c_'+chat_uuid,
+                key_suite=key_suite)
             system.send_event_to(conn, n_event)
             chat = chats_manager.getChatByUUID(chat_uuid)
-            chat['participants_e2e'].append(user_uuid)
-            chats_manager.database.saveData()
+            chats_manager.database.appendToEntryField(
+                chat, 'participants_e2e', user_uuid)
+            chats_manager.database.requestSave()
         
         elif event.event in (
                 'REQUEST_INITIAL_MESSAGES',
@@ -153,7 +287,8 @@ def serverMain():
                 # TODO in future mark as suspicious activity?
                 continue
             chat = chats_manager.getChatByUUID(chat_uuid)
-            combined_messages = []
+            # (start, stop) sequence id ranges to send
+            ranges = []
             if event.event == 'REQUEST_INITIAL_MESSAGES':
                 last_page_index = chats_manager.getLastPageIndex(chat_uuid)
                 lowest_page_index = last_page_index
@@ -165,41 +300,50 @@ def serverMain():
                     if page_index < lowest_page_index:
                         lowest_page_index = page_index
                     pages_sent += 1
-                    messages = chats_manager.getMessagesPage(
-                        chat_uuid, page_index)
-                    combined_messages.extend(messages)
-            elif event.event == 'REQUEST_GET_MESSAGES':
+                    ranges.append(chats_manager.getPageRange(
+                        chat_uuid, page_index))
+            elif event.get_attribute('messages_page') != None:
                 page_index = event.messages_page
-                messages = chats_manager.getMessagesPage(
-                    chat_uuid, page_index)
-                combined_messages.extend(messages)
+                if not isOptionalInt(page_index) or page_index < 0:
+                    logging.warn('ignoring messages request with an invalid page')
+                    continue
+                ranges.append(chats_manager.getPageRange(
+                    chat_uuid, page_index))
                 lowest_page_index = page_index
+            else:
+                # messages addressed by sequence id, which don't
+                # shift when new messages arrive like pages do
+                limit = event.get_attribute('limit')
+                before_seq = event.get_attribute('before_seq')
+                after_seq = event.get_attribute('after_seq')
+                if not (isOptionalInt(limit) and isOptionalInt(before_seq) \
+                        and isOptionalInt(after_seq)):
+                    logging.warn('ignoring messages request with invalid sequence ids')
+                    continue
+                if limit == None:
+                    limit = datatypes.CHAT_PAGE_SIZE_DEFAULT
+                ranges.append(chats_manager.getSeqRange(
+                    chat_uuid,
+                    before_seq=before_seq,
+                    after_seq=after_seq,
+                    limit=limit))
+                lowest_page_index = None
             
-            sender_names = {}
-            messages = []
-            for message in combined_messages:
-                sender_uuid = message.sender
-                sender_name = sender_names.get(sender_uuid, None)
-                if sender_name == None:
-                    sender_user = user_manager.getUserByUUID(sender_uuid)
-                    if sender_user == None:
-                        sender_name = 'UNKNOWN'
-                    else:
-                        sender_name = sender_user['username']
-                message_json = {
-                    "content": message.content,
-                    "sender_uuid": sender_uuid,
-                    "sender_name": sender_name,
-                    "timestamp": message.timestamp,
-                    "is_own": sender_uuid == user_uuid
-                }
-                messages.append(message_json)
-            chats_manager.processMessageJsonBeforeSend(messages, chat, user_manager)
+            # each range is sent already pickled, and mostly
+            # comes straight from the cache of rendered ranges
+            messages_data = []
+            for start, stop in ranges:
+                data = chats_manager.getRenderedRange(
+                    chat, start, stop, user_manager)
+                if data != None:
+                    messages_data.append(data)
             n_event = ebsocket_event(
                 event.event+'_FILLED',
                 chat_uuid=chat_uuid,
                 loaded_to_page=lowest_page_index,
-                messages=messages)
+                last_seq=chats_manager.getLastSeq(chat_uuid),
+                messages_data=messages_data,
+                epoch_keys=chats_manager.getEpochKeys(chat))
             system.send_event_to(conn, n_event)
         
         elif event.event == 'REQUEST_SEND_MESSAGE':
@@ -207,7 +351,13 @@ def serverMain():
             if not chats_manager.isUserInChat(chat_uuid, user_uuid):
                 continue
             content = event.message_content
-            # content is either a string or a DataPacket instance
+            # content is either a string, a DataPacket instance,
+            # or a SealedPacket sealed with one of the chat's epoch keys
+            if type(content) == SealedPacket:
+                chat = chats_manager.getChatByUUID(chat_uuid)
+                if not 0 <= content.epoch < len(chats_manager.getEpochKeys(chat)):
+                    logging.warn(f'message sealed with unknown epoch {content.epoch}')
+                    continue
             message = chats_manager.addChatMessage(
                 chat_uuid,
                 datatypes.ChatMessage(
@@ -216,31 +366,58 @@ def serverMain():
                 ))
             if not message:
                 continue
-            chats_manager.saveChatMessages(chat_uuid)
             chat = chats_manager.getChatByUUID(chat_uuid)
 
             # forward message to other clients
             participants = chats_manager.getChatParticipants(chat_uuid)
             page_index = chats_manager.getLastPageIndex(chat_uuid)
 
+            # the message is the same for every participant,
+            # who each work out whether it's their own
+            messages, _ = chats_manager.renderMessages([message], chat, user_manager)
+            n_event = ebsocket_event(
+                'REQUEST_SEND_MESSAGE_FILLED',
+                chat_uuid=chat_uuid,
+                loaded_to_page=page_index,
+                last_seq=message.seq,
+                message=messages[0])
             for conn_other in user_manager.iterateConnectedUsers(participants):
-                message_json = {
-                    "content": message.content,
-                    "sender_uuid": message.sender,
-                    "sender_name": user_instance.username,
-                    "timestamp": message.timestamp,
-                    "is_own": conn == conn_other}
-                messages = [message_json]
-                chats_manager.processMessageJsonBeforeSend(messages, chat, user_manager)
-                message_json = messages[0]
-                n_event = ebsocket_event(
-                    'REQUEST_SEND_MESSAGE_FILLED',
-                    chat_uuid=chat_uuid,
-                    loaded_to_page=page_index,
-                    message=message_json)
                 system.send_event_to(conn_other, n_event)
                 print("Forwarding chat event to", conn_other)
         
+        elif event.event == 'REQUEST_ADD_EPOCH_KEY':
+            # a client made a new epoch key for a chat that needed
+            # one, wrapped with the chat's public key. The first
+            # one offered wins, and the others are told to use it
+            chat_uuid = event.chat_uuid
+            if not chats_manager.isUserInChat(chat_uuid, user_uuid):
+                continue
+            success = chats_manager.addEpochKey(
+                chat_uuid,
+                event.get_attribute('epoch'),
+                event.get_attribute('wrapped_key'))
+            chat = chats_manager.getChatByUUID(chat_uuid)
+            epoch = chats_manager.getCurrentEpoch(chat)
+            epoch_keys = chats_manager.getEpochKeys(chat)
+            n_event = ebsocket_event(
+                'REQUEST_ADD_EPOCH_KEY_FILLED',
+                chat_uuid=chat_uuid,
+                success=success,
+                epoch=epoch,
+                epoch_keys=epoch_keys)
+            system.send_event_to(conn, n_event)
+            if not success:
+                continue
+            n_event = ebsocket_event(
+                'EPOCH_KEY_ADDED',
+                chat_uuid=chat_uuid,
+                epoch=epoch,
+                epoch_keys=epoch_keys)
+            participants = chats_manager.getChatParticipants(chat_uuid)
+            for conn_other in user_manager.iterateConnectedUsers(participants):
+                if conn_other != conn:
+                    system.send_event_to(conn_other, n_event)
+        
         elif event.event == 'REQUEST_SEARCH_FOR_USERS':
             query = event.query
             get_max = event.get_max
@@ -264,7 +441,9 @@ def serverMain():
                 continue
             participants_e2e = chat['participants_e2e']
             if user_uuid in participants_e2e:
-                participants_e2e.remove(user_uuid)
+                chats_manager.database.removeFromEntryField(
+                    chat, 'participants_e2e', user_uuid)
+                chats_manager.database.requestSave()
             process_extra_events.append({
                 'action': 'check_e2e',
                 'chat_uuid': chat_uuid
@@ -344,17 +523,16 @@ def serverMain():
                 logging.debug('adding chat uuid to pending list.')
                 e2e_pending_chats.append(chat_uuid)
                 continue
-            conns_requiring_key = []
-            for uuid in participants_requiring_key:
-                conn_other = user_manager.getConnByUUID(uuid)
-                if conn_other == None:
-                    continue
-                conns_requiring_key.append(conn_other)
+            # every device a participant is logged in on
+            # needs its own copy of the keys
+            conns_requiring_key = list(
+                user_manager.iterateConnectedUsers(participants_requiring_key))
             for conn_receiver in conns_requiring_key:
                 e2e_handshake_manager.createHandshake(
                     conn_sender,
                     conn_receiver,
-                    encryption_key_id)
+                    encryption_key_id,
+                    chats_manager.getKeySuite(chat))
                 print('created handshake between', conn_sender, 'and', conn_receiver, 'id:', encryption_key_id)
         
         elif action == 'handshake_complete':
@@ -381,7 +559,9 @@ def serverMain():
             for uuid in process_uuids:
                 if not uuid in chat['participants_e2e']:
                     logging.debug(f'added {uuid} to participants_e2e')
-                    chat['participants_e2e'].append(uuid)
+                    chats_manager.database.appendToEntryField(
+                        chat, 'participants_e2e', uuid)
+                    chats_manager.database.requestSave()
             if chat_uuid in e2e_pending_chats:
                 logging.debug(f'this chat is marked as pending. Checking if reasonable...')
                 participants_requiring_key = chats_manager.getParticipantsWithoutE2E(chat_uuid)
@@ -391,6 +571,9 @@ def serverMain():
                 else:
                     logging.debug("reasonable. Leaving chat marked as pending e2e.")
 
+    # write any databases whose group commit window has passed
+    flush_scheduler.pump()
+
 print("Server running!")
 print(server_addr)
 while True:
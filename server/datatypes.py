@@ -2,10 +2,18 @@ import logging
 import uuid
 import pickle
 import os
+import io
+import collections
 import math
+import shutil
+import threading
+import hashlib
+import base64
+import binascii
 from scripts import database
+from scripts import lru_cache
+from scripts import message_log
 from scripts import utilities
-import difflib
 import time
 
 class CONST:
@@ -17,6 +25,16 @@ class CONST:
         NOT_SETUP = 0
 
 CHAT_PAGE_SIZE_DEFAULT = 8
+# most messages sent for one sequence id based request
+CHAT_SEQ_LIMIT_MAX = 200
+# messages per batch when catching up after a reconnect,
+# and how many batches can be sent before the client
+# acknowledges any
+CATCH_UP_BATCH_SIZE = 256
+CATCH_UP_WINDOW = 4
+# longest wrapped epoch key accepted (base64), enough
+# for a key wrapped with RSA-4096
+EPOCH_KEY_LENGTH_MAX = 1024
 
 class User:
     def __init__(self):
@@ -26,6 +44,13 @@ class User:
         self.logged_in = False
         # user's username
         self.username = None
+        # the connection this user is using
+        self.conn = None
+        # batches of missed messages still to be sent
+        # (see ChatManager.iterateCatchUp), and how many
+        # have been sent without being acknowledged
+        self.catch_up = None
+        self.catch_up_in_flight = 0
     
     def setUuid(self, provided_uuid=None):
         self.uuid = provided_uuid or uuid.uuid4()
@@ -37,7 +62,11 @@ class User:
 class UserManager:
     def __init__(self, user_database):
         self.database = user_database
+        # conn: User
         self.connected_users = {}
+        # uuid: set of conns, one for each
+        # device the user is logged in on
+        self.conns_by_uuid = {}
 
         self.getUserByUUID = self.database.findEntryByUUID
     
@@ -51,6 +80,7 @@ class UserManager:
         Returns the newly added user
         '''
         new_user = User()
+        new_user.conn = conn
         self.connected_users[conn] = new_user
         return new_user
     
@@ -60,24 +90,67 @@ class UserManager:
         '''
         return self.connected_users.get(conn, None)
     
+    def _indexUserConn(self, user):
+        '''
+        Add a logged in user's connection to
+        the uuid -> connections index
+        '''
+        if user.conn == None:
+            return
+        conns = self.conns_by_uuid.get(user.uuid, None)
+        if conns == None:
+            conns = set()
+            self.conns_by_uuid[user.uuid] = conns
+        conns.add(user.conn)
+    
+    def _unindexUserConn(self, user):
+        '''
+        Remove a user's connection from
+        the uuid -> connections index
+        '''
+        conns = self.conns_by_uuid.get(user.uuid, None)
+        if conns == None:
+            return
+        conns.discard(user.conn)
+        if len(conns) == 0:
+            del self.conns_by_uuid[user.uuid]
+    
+    def getConnsByUUID(self, uuid:str):
+        """
+        Get every connection (device) the
+        user with this uuid is logged in on.
+        Returns an empty set if the user
+        is not connected
+        """
+        return self.conns_by_uuid.get(uuid, set())
+    
     def getConnByUUID(self, uuid:str):
-        for conn, user in self.connected_users.items():
-            if user.uuid == uuid:
-                return conn
+        """
+        Get any one of the connections the
+        user is logged in on, or None
+        """
+        for conn in self.conns_by_uuid.get(uuid, ()):
+            return conn
         return None
     
+    def isUserConnected(self, uuid:str):
+        return uuid in self.conns_by_uuid
+    
     def iterateConnectedUsers(self, uuids:list):
         """
-        Iterate over all users in the uuids list
-        as long as they are currently connected
-        to the server
+        Iterate over the connections of all users
+        in the uuids list, as long as they are
+        currently connected to the server.
+        A user logged in on several devices
+        yields each of their connections
         """
+        seen = set()
         for uuid in uuids:
-            print('iter', uuid)
-            conn = self.getConnByUUID(uuid)
-            if conn == None:
+            if uuid in seen:
                 continue
-            yield conn
+            seen.add(uuid)
+            for conn in self.conns_by_uuid.get(uuid, ()):
+                yield conn
     
 
     def searchUsersByUsername(self, query:str, get_max:int):
@@ -85,12 +158,7 @@ class UserManager:
         Searches the user database for users
         with usernames similar to the query
         '''
-        query = query.lower()
-        all_users = self.database.loaded_data['entries']
-        users_by_usernames = {user['username'].lower():user for user in all_users}
-        all_usernames = list(users_by_usernames.keys())
-        resulting_usernames = difflib.get_close_matches(query, all_usernames, n=get_max, cutoff=0.05)
-        resulting_users = [users_by_usernames[username] for username in resulting_usernames]
+        resulting_users = self.database.searchByUsername(query, get_max)
         result = [
             {'uuid': user['uuid'], 'username': user['username']}\
             for user in resulting_users
@@ -105,7 +173,10 @@ class UserManager:
         '''
         if not conn in self.connected_users:
             return None
-        return self.connected_users.pop(conn)
+        user = self.connected_users.pop(conn)
+        if user.logged_in:
+            self._unindexUserConn(user)
+        return user
     
     def attemptLogin(self, user, data):
         username = data.username
@@ -117,9 +188,14 @@ class UserManager:
         # now we can compare password hashes
         if reference_account['password_hash'] == password_hash:
             # login successful
+            if user.logged_in:
+                # this connection was logged in to
+                # an account already, so unlink it
+                self._unindexUserConn(user)
             user.logged_in = True
             user.username = username
             user.uuid = reference_account['uuid']
+            self._indexUserConn(user)
             return (True, user.uuid)
         else:
             return (False, None)
@@ -139,11 +215,16 @@ class UserManager:
             # possibly modified client?
             # TODO ban user
             return (False, None)
-        self.database.addUser(username, password_hash)
-        reference_account = self.database.findEntryByUsername(username)
+        reference_account = self.database.addUser(username, password_hash)
+        if reference_account == None:
+            return (False, None)
+        # the account has to be on disk before
+        # the client is told it exists
+        self.database.saveNow()
         user.logged_in = True
         user.username = username
         user.uuid = reference_account['uuid']
+        self._indexUserConn(user)
         return (True, user.uuid)
 
 
@@ -159,18 +240,221 @@ class ChatMessage(object):
         self.timestamp = timestamp
         if self.timestamp == -1:
             self.timestamp = utilities.Time.getUTCTs()
+        # per-chat sequence id, the message's index in
+        # the chat's log. Set when the message is added
+        # or read, since older messages were stored without
+        self.seq = None
         
     def toJson(self):
         return {
             'content': self.content,
             'sender': self.sender,
-            'timestamp': self.timestamp
+            'timestamp': self.timestamp,
+            'seq': self.seq
         }
 
+class ChatHistory(object):
+    """
+    A chat's message log, and its full list of
+    messages if they've been loaded, as kept
+    in the ChatManager's cache
+    """
+    # roughly what an open log costs,
+    # mostly its two files' buffers
+    BASE_SIZE = 2*io.DEFAULT_BUFFER_SIZE
+
+    def __init__(self, log):
+        self.log = log
+        self.messages = None
+        # size of the loaded messages' records
+        self.messages_size = 0
+    
+    def __repr__(self):
+        return f'ChatHistory<{self.log.directory},{self.getSize()}>'
+    
+    def getSize(self):
+        return self.BASE_SIZE+self.messages_size
+    
+    def isDirty(self):
+        return self.log.unsynced
+
 class ChatManager(object):
-    def __init__(self, chats_database):
+    CHATS_DIRECTORY = './server/chats'
+
+    def __init__(
+            self,
+            chats_database,
+            cache_budget:int=64*2**20,
+            cache_max_chats:int=256,
+            render_cache_budget:int=16*2**20,
+            index_budget:int=2**20):
         self.database = chats_database
-        self.chat_messages = {}
+        # chat uuid: ChatHistory, for the most recently used
+        # chats, up to cache_budget bytes. Each cached chat
+        # keeps its log's files open, so the number of
+        # chats is limited too
+        self.histories = lru_cache.LRUCache(
+            cache_budget,
+            ChatHistory.getSize,
+            is_pinned=self.isChatPinned,
+            on_evict=self._onHistoryEvicted,
+            max_items=cache_max_chats)
+        self.n_write_backs = 0
+        # (chat uuid, start, stop): the messages in that
+        # range, rendered and pickled (see getRenderedRange)
+        self.rendered_ranges = lru_cache.LRUCache(
+            render_cache_budget,
+            len,
+            on_evict=self._onRenderedRangeEvicted)
+        # range key: uuids of the users named in it, and
+        # user uuid: keys of the ranges they're named in
+        self.rendered_ranges_users = {}
+        self.rendered_ranges_by_user = {}
+        # user uuid: OrderedDict of the uuids of the chats they're
+        # in, least recently active first. Built the first time
+        # the user's chats are needed, then kept in order as
+        # messages are sent, so listing them needs no sort
+        self.participant_chats = lru_cache.LRUCache(
+            index_budget, self.getIndexSize)
+        # chat uuid: set of participant uuids, for membership checks.
+        # Both hold up to index_budget uuids, those of the least
+        # recently used users and chats are dropped, and read
+        # from the database again when needed
+        self.chat_participants = lru_cache.LRUCache(
+            index_budget, self.getIndexSize)
+        # the last chat version given out. Seeded from the
+        # stored chats, so versions keep increasing even
+        # if the clock is behind where it was last run
+        self.last_version = self.database.getHighestVersion()
+        # the background job compressing inactive chats, and
+        # the chat it's compressing, which can't be opened
+        # until it's done
+        self.tiering_thread = None
+        self.tiering_stop = threading.Event()
+        self.tiering_condition = threading.Condition()
+        self.tiering_chat = None
+        # function(user uuid) -> whether they're online,
+        # the chats of online users are kept in the cache
+        self.is_user_online = None
+    
+    def setOnlineCheck(self, is_user_online):
+        self.is_user_online = is_user_online
+    
+    def isChatPinned(self, chat_uuid:str):
+        if self.is_user_online == None:
+            return False
+        participants = self.getParticipantSet(chat_uuid)
+        if participants == None:
+            return False
+        for participant_uuid in participants:
+            if self.is_user_online(participant_uuid):
+                return True
+        return False
+    
+    def _onHistoryEvicted(self, chat_uuid:str, history:ChatHistory):
+        # write the chat's new messages back to disk before
+        # its log is closed, rather than leaving it to the os
+        if history.isDirty():
+            history.log.sync()
+            self.n_write_backs += 1
+        history.log.close()
+        self._markChatAccessed(chat_uuid)
+    
+    @staticmethod
+    def getIndexSize(uuids):
+        return len(uuids)+1
+    
+    def getCacheStats(self):
+        stats = self.histories.getStats()
+        stats['write_backs'] = self.n_write_backs
+        return stats
+    
+    def close(self):
+        """
+        Write back and close every cached chat
+        """
+        self.stopTiering()
+        self.histories.clear()
+    
+    # ------------------------- cold storage
+    def _markChatAccessed(self, chat_uuid:str):
+        # the directory's modification time doubles as
+        # when the chat was last used, for the tiering job
+        try:
+            os.utime(self.getChatMessagesDirectory(chat_uuid))
+        except OSError:
+            pass
+    
+    def compressInactiveChats(self, inactive_after:float):
+        """
+        Compress the logs of chats that haven't been
+        used for inactive_after seconds. Returns the
+        chats' size before and after
+        """
+        size = 0
+        compressed_size = 0
+        now = time.time()
+        # on a fresh server no chat has been written yet
+        os.makedirs(self.CHATS_DIRECTORY, exist_ok=True)
+        for chat_uuid in os.listdir(self.CHATS_DIRECTORY):
+            directory = self.getChatMessagesDirectory(chat_uuid)
+            if not os.path.isdir(directory) or chat_uuid.endswith('.tmp'):
+                continue
+            if now-os.path.getmtime(directory) < inactive_after:
+                continue
+            with self.tiering_condition:
+                if chat_uuid in self.histories:
+                    continue
+                # keep the chat from being opened meanwhile
+                self.tiering_chat = chat_uuid
+            try:
+                log = message_log.MessageLog(directory)
+                if log.open() and len(log.compressed) < len(log.segments):
+                    before, after = log.compress()
+                    size += before
+                    compressed_size += after
+                log.close()
+            except Exception:
+                logging.exception(f'error compressing chat {chat_uuid}')
+            finally:
+                with self.tiering_condition:
+                    self.tiering_chat = None
+                    self.tiering_condition.notify_all()
+        if size > 0:
+            logging.debug(
+                f'compressed inactive chats from {size} '\
+                f'to {compressed_size} bytes')
+        return size, compressed_size
+    
+    def startTiering(self, inactive_after:float=30*86400, interval:float=3600):
+        """
+        Start compressing inactive chats
+        every interval seconds, in the background
+        """
+        self.tiering_stop.clear()
+        self.tiering_thread = threading.Thread(
+            target=self._tieringLoop,
+            args=(inactive_after, interval),
+            name='chat-tiering',
+            daemon=True)
+        self.tiering_thread.start()
+    
+    def _tieringLoop(self, inactive_after:float, interval:float):
+        while True:
+            # one failed pass shouldn't stop the ones after it
+            try:
+                self.compressInactiveChats(inactive_after)
+            except Exception:
+                logging.exception('error compressing inactive chats')
+            if self.tiering_stop.wait(interval):
+                return
+    
+    def stopTiering(self):
+        if self.tiering_thread == None:
+            return
+        self.tiering_stop.set()
+        self.tiering_thread.join()
+        self.tiering_thread = None
     
     def processMessageJsonBeforeSend(self, messages, chat, user_manager):
         for message in messages:
@@ -180,7 +464,7 @@ class ChatManager(object):
                 # process any required text replacements
                 if '%[creator]%' in message['content']:
                     creator_uuid = chat['creator_uuid']
-                    creator = user_manager.database.findUserByUUID(creator_uuid)
+                    creator = user_manager.getUserByUUID(creator_uuid)
                     creator_name = 'Deleted User'
                     if creator != None: 
                         creator_name = creator['username']
@@ -192,15 +476,14 @@ class ChatManager(object):
             creator_uuid:str,
             chat_uuid:str,
             chat_name:str,
-            participants:list):
+            participants:list,
+            key_suite:str='rsa'):
         
         if chat_uuid == None:
             chat_uuid = str(uuid.uuid4())
         
-        messages = self.loadChatMessages(chat_uuid)
-        if messages == None:
-            messages = []
-        self.chat_messages[chat_uuid] = messages
+        if self.getMessageLog(chat_uuid) == None:
+            self.createMessageLog(chat_uuid)
 
         existing_chat = self.database.getChatByUUID(chat_uuid)
         exists = True
@@ -211,20 +494,98 @@ class ChatManager(object):
                 "name": chat_name,
                 "participants": participants,
                 "participants_e2e": [],
-                "last_message_ts": utilities.Time.getUTCTs()})
+                "last_message_ts": utilities.Time.getUTCTs(),
+                "version": self.nextVersion(),
+                "epoch_keys": [],
+                "key_suite": key_suite})
             if not result:
                 exists = False
-            self.database.modified = True
+            else:
+                self.chat_participants.put(chat_uuid, set(participants))
+                for participant_uuid in participants:
+                    self._touchParticipantChat(participant_uuid, chat_uuid)
         
-        self.saveChatMessages(chat_uuid)
-        self.database.saveData()
+        self.database.requestSave()
         
         if not exists:
             return False
         return chat_uuid
     
     def getChatMessagesFilepath(self, chat_uuid:str):
-        return f'./server/chats/{chat_uuid}.msgs'
+        # where messages were stored before message logs,
+        # as a single pickled list
+        return f'{self.CHATS_DIRECTORY}/{chat_uuid}.msgs'
+    
+    def getChatMessagesDirectory(self, chat_uuid:str):
+        return f'{self.CHATS_DIRECTORY}/{chat_uuid}'
+    
+    def createMessageLog(self, chat_uuid:str):
+        log = message_log.MessageLog(self.getChatMessagesDirectory(chat_uuid))
+        log.create()
+        with self.tiering_condition:
+            self.histories.put(chat_uuid, ChatHistory(log))
+        return log
+    
+    def getChatHistory(self, chat_uuid:str):
+        """
+        Get a chat's history from the cache, opening
+        its log if it isn't cached. Returns None if
+        the chat has no messages stored
+        """
+        history = self.histories.get(chat_uuid)
+        if history != None:
+            return history
+        with self.tiering_condition:
+            while self.tiering_chat == chat_uuid:
+                self.tiering_condition.wait()
+            log = message_log.MessageLog(self.getChatMessagesDirectory(chat_uuid))
+            if not log.open():
+                log = self._migrateChatMessages(chat_uuid)
+                if log == None:
+                    return None
+            history = ChatHistory(log)
+            self.histories.put(chat_uuid, history)
+        self._markChatAccessed(chat_uuid)
+        return history
+    
+    def getMessageLog(self, chat_uuid:str):
+        """
+        Get the log a chat's messages are stored in,
+        or None if the chat has no messages stored
+        """
+        history = self.getChatHistory(chat_uuid)
+        if history == None:
+            return None
+        return history.log
+    
+    def _migrateChatMessages(self, chat_uuid:str):
+        """
+        Move a chat's messages from its old pickled
+        list file into a message log
+        """
+        messages_filepath = self.getChatMessagesFilepath(chat_uuid)
+        if not os.path.exists(messages_filepath):
+            return None
+        with open(messages_filepath, 'rb') as f:
+            messages = pickle.load(f)
+        logging.debug(
+            f'moving {len(messages)} messages of chat '\
+            f'{chat_uuid} into a message log')
+        # build the log beside the real one, so it's
+        # either complete or not there at all
+        directory = self.getChatMessagesDirectory(chat_uuid)
+        temp_directory = directory+'.tmp'
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        log = message_log.MessageLog(temp_directory)
+        log.create()
+        log.appendMany(pickle.dumps(message) for message in messages)
+        log.sync()
+        log.close()
+        os.replace(temp_directory, directory)
+        os.remove(messages_filepath)
+        log = message_log.MessageLog(directory)
+        log.open()
+        return log
     
     def loadChatMessages(self, chat_uuid:str):
         """
@@ -233,17 +594,21 @@ class ChatManager(object):
         logging.debug(
             f'load chat messages from file, '\
             f'chat uuid {chat_uuid}')
-        messages_filepath = self.getChatMessagesFilepath(chat_uuid)
-        if os.path.exists(messages_filepath):
-            with open(messages_filepath, 'rb') as f:
-                messages = pickle.load(f)
-        else:
+        history = self.getChatHistory(chat_uuid)
+        if history == None:
             logging.warn(
-                f'error loading chat messages, no file '\
-                f'found at {messages_filepath}')
+                f'error loading chat messages, no log '\
+                f'found at {self.getChatMessagesDirectory(chat_uuid)}')
             return None
-        self.chat_messages[chat_uuid] = messages
-        return self.chat_messages[chat_uuid]
+        history.messages = []
+        history.messages_size = 0
+        for seq, record in enumerate(history.log.iterateRecords()):
+            message = pickle.loads(record)
+            message.seq = seq
+            history.messages.append(message)
+            history.messages_size += len(record)
+        self.histories.resize(chat_uuid)
+        return history.messages
     
     def getChatMessages(self, chat_uuid:str):
         """
@@ -253,35 +618,104 @@ class ChatManager(object):
         If the chat does not exist, this
         function will return None
         """
-        if chat_uuid in self.chat_messages:
-            return self.chat_messages[chat_uuid]
-        else:
-            messages = self.loadChatMessages(chat_uuid)
-            if messages == False:
-                return None
-            return messages
+        history = self.getChatHistory(chat_uuid)
+        if history == None:
+            return None
+        if history.messages != None:
+            return history.messages
+        return self.loadChatMessages(chat_uuid)
     
     def saveChatMessages(self, chat_uuid:str):
-        messages_filepath = self.getChatMessagesFilepath(chat_uuid)
-        messages = self.getChatMessages(chat_uuid)
-        if messages == None:
+        """
+        Messages are appended to the chat's log as
+        they're added, so this only makes sure
+        they've all reached the disk
+        """
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
             return False
-        messages_bytes = pickle.dumps(messages)
-        with open(messages_filepath, 'wb') as f:
-            f.write(messages_bytes)
-        self.database.saveIfModified()
+        log.sync()
+        return True
     
     def addChatMessage(self, chat_uuid:str, message):
-        messages = self.getChatMessages(chat_uuid)
-        if messages == None:
+        history = self.getChatHistory(chat_uuid)
+        if history == None:
             return False
-        messages.append(message)
+        message.seq = len(history.log)
+        record = pickle.dumps(message)
+        history.log.append(record)
+        if history.messages != None:
+            history.messages.append(message)
+            history.messages_size += len(record)
+            self.histories.resize(chat_uuid)
         chat = self.database.getChatByUUID(chat_uuid)
-        chat['last_message_ts'] = utilities.Time.getUTCTs()
-        self.database.modified = True
-        self.saveChatMessages(chat_uuid)
+        self.database.setEntryField(
+            chat, 'last_message_ts', utilities.Time.getUTCTs())
+        # the chat moved to the top of its participants' lists
+        self.database.setEntryField(chat, 'version', self.nextVersion())
+        self.database.requestSave()
+        for participant_uuid in chat['participants']:
+            self._touchParticipantChat(participant_uuid, chat_uuid)
         return message
     
+    def getPageRange(
+            self,
+            chat_uuid:str,
+            page_index:int,
+            page_size:int=CHAT_PAGE_SIZE_DEFAULT):
+        """
+        Get the (start, stop) sequence ids
+        of a page of a chat's messages
+        """
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
+            return 0, 0
+        if page_index < 0:
+            # count back from the last page
+            page_index += math.ceil(len(log)/page_size)
+            if page_index < 0:
+                return 0, 0
+        start = page_index*page_size
+        return self._clampRange(log, start, start+page_size)
+    
+    def getSeqRange(
+            self,
+            chat_uuid:str,
+            before_seq:int=None,
+            after_seq:int=None,
+            limit:int=CHAT_PAGE_SIZE_DEFAULT):
+        """
+        Get the (start, stop) sequence ids of up to
+        limit messages just after after_seq, or just
+        before before_seq, or of the latest messages
+        if neither is given. Messages keep their
+        sequence id however many are added, so unlike
+        pages, these ranges don't shift while the
+        client is reading
+        """
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
+            return 0, 0
+        limit = max(0, min(limit, CHAT_SEQ_LIMIT_MAX))
+        if after_seq != None:
+            start = after_seq+1
+            stop = start+limit
+            if before_seq != None:
+                stop = min(stop, before_seq)
+        else:
+            stop = len(log)
+            if before_seq != None:
+                stop = min(stop, before_seq)
+            start = stop-limit
+        return self._clampRange(log, start, stop)
+    
+    def _clampRange(self, log, start:int, stop:int):
+        start = max(0, start)
+        stop = min(stop, len(log))
+        if start >= stop:
+            return 0, 0
+        return start, stop
+    
     def getMessagesPage(
             self,
             chat_uuid:str,
@@ -292,20 +726,214 @@ class ChatManager(object):
         optional argument page_size
         determines how many messages
         are in each page.
+        Only the page's messages are
+        read from the chat's log
         """
-        messages = self.getChatMessages(chat_uuid)
-        paginated = utilities.splitIterableIntoChunks(messages, page_size)
-        try:
-            return paginated[page_index]
-        except IndexError:
+        start, stop = self.getPageRange(chat_uuid, page_index, page_size)
+        return self.getMessagesRange(chat_uuid, start, stop)
+    
+    def getMessagesBySeq(
+            self,
+            chat_uuid:str,
+            before_seq:int=None,
+            after_seq:int=None,
+            limit:int=CHAT_PAGE_SIZE_DEFAULT):
+        """
+        Get the messages in the range
+        given by getSeqRange
+        """
+        start, stop = self.getSeqRange(chat_uuid, before_seq, after_seq, limit)
+        return self.getMessagesRange(chat_uuid, start, stop)
+    
+    def getMessagesRange(self, chat_uuid:str, start:int, stop:int):
+        """
+        Get the messages with sequence ids from
+        start up to (not including) stop
+        """
+        if start >= stop:
+            return []
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
             return []
+        messages = []
+        for seq, record in enumerate(log.readRange(start, stop), start):
+            message = pickle.loads(record)
+            message.seq = seq
+            messages.append(message)
+        return messages
+    
+    def renderMessages(self, messages:list, chat, user_manager):
+        """
+        Build the json sent to clients for each message.
+        Returns the jsons, and the uuids of the users
+        whose names went into them
+        """
+        sender_names = {}
+        messages_json = []
+        for message in messages:
+            sender_uuid = message.sender
+            sender_name = sender_names.get(sender_uuid, None)
+            if sender_name == None:
+                sender_user = user_manager.getUserByUUID(sender_uuid)
+                if sender_user == None:
+                    sender_name = 'UNKNOWN'
+                else:
+                    sender_name = sender_user['username']
+                sender_names[sender_uuid] = sender_name
+            # whether the message is the user's own
+            # is left to the client, so the json is
+            # the same whoever it's sent to
+            messages_json.append({
+                "content": message.content,
+                "sender_uuid": sender_uuid,
+                "sender_name": sender_name,
+                "timestamp": message.timestamp,
+                "seq": message.seq
+            })
+        self.processMessageJsonBeforeSend(messages_json, chat, user_manager)
+        user_uuids = set(sender_names)
+        user_uuids.add(chat['creator_uuid'])
+        return messages_json, user_uuids
+    
+    def getRenderedRange(
+            self,
+            chat,
+            start:int,
+            stop:int,
+            user_manager,
+            cache:bool=True):
+        """
+        Get the messages from start up to stop, rendered and
+        pickled, ready to send. Stored messages never change,
+        so the result is cached until the name of a user
+        in it changes
+        """
+        if start >= stop:
+            return None
+        key = (chat['uuid'], start, stop)
+        data = self.rendered_ranges.get(key)
+        if data != None:
+            return data
+        messages = self.getMessagesRange(chat['uuid'], start, stop)
+        messages_json, user_uuids = self.renderMessages(messages, chat, user_manager)
+        data = pickle.dumps(messages_json)
+        if not cache:
+            return data
+        self.rendered_ranges.put(key, data)
+        if key in self.rendered_ranges:
+            self.rendered_ranges_users[key] = user_uuids
+            for user_uuid in user_uuids:
+                keys = self.rendered_ranges_by_user.get(user_uuid, None)
+                if keys == None:
+                    keys = set()
+                    self.rendered_ranges_by_user[user_uuid] = keys
+                keys.add(key)
+        return data
+    
+    def _onRenderedRangeEvicted(self, key, data):
+        for user_uuid in self.rendered_ranges_users.pop(key, ()):
+            keys = self.rendered_ranges_by_user[user_uuid]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.rendered_ranges_by_user[user_uuid]
+    
+    def onUsernameChanged(self, user_uuid:str):
+        """
+        Drop the cached messages that
+        include a user's old name
+        """
+        for key in list(self.rendered_ranges_by_user.get(user_uuid, ())):
+            data = self.rendered_ranges.pop(key)
+            self._onRenderedRangeEvicted(key, data)
+    
+    def iterateCatchUp(
+            self,
+            chats:list,
+            positions:dict,
+            user_manager,
+            batch_size:int=CATCH_UP_BATCH_SIZE):
+        """
+        Yield batches of the messages a client missed in
+        the given chats, each a list of
+        {chat_uuid, last_seq, messages_data, epoch_keys}.
+        positions holds the last seq the client has of each
+        chat, chats it has no position for get their latest
+        page. Batches are only built as they're taken,
+        so they're read and rendered at the pace the
+        client acknowledges them
+        """
+        batch = []
+        n_messages = 0
+        for chat in chats:
+            chat_uuid = chat['uuid']
+            last_seq = self.getLastSeq(chat_uuid)
+            position = positions.get(chat_uuid, None)
+            if position == None:
+                start, stop = self.getSeqRange(chat_uuid)
+            else:
+                start = position+1
+                stop = last_seq+1
+            while start < stop:
+                # split at page boundaries, so the pieces are
+                # the same ranges page requests render and cache
+                piece_stop = min(
+                    stop, (start//CHAT_PAGE_SIZE_DEFAULT+1)*CHAT_PAGE_SIZE_DEFAULT)
+                piece_stop = min(piece_stop, start+batch_size-n_messages)
+                data = self.getRenderedRange(chat, start, piece_stop, user_manager)
+                if len(batch) > 0 and batch[-1]['chat_uuid'] == chat_uuid:
+                    batch[-1]['messages_data'].append(data)
+                else:
+                    batch.append({
+                        'chat_uuid': chat_uuid,
+                        'last_seq': last_seq,
+                        'messages_data': [data],
+                        'epoch_keys': self.getEpochKeys(chat)})
+                n_messages += piece_stop-start
+                start = piece_stop
+                if n_messages >= batch_size:
+                    yield batch
+                    batch = []
+                    n_messages = 0
+        if len(batch) > 0:
+            yield batch
+    
+    def iterateChatExport(
+            self,
+            chat,
+            user_manager,
+            chunk_size:int=CATCH_UP_BATCH_SIZE):
+        """
+        Yield every message of a chat, oldest first, as
+        pickled lists of up to chunk_size rendered
+        messages, for streaming to a client. Only one
+        chunk is read into memory at a time, and the
+        chunks aren't cached, since an export would
+        otherwise push everything else out of the cache
+        """
+        stop = self.getLastSeq(chat['uuid'])+1
+        for start in range(0, stop, chunk_size):
+            yield self.getRenderedRange(
+                chat, start, min(start+chunk_size, stop),
+                user_manager, cache=False)
+    
+    def getLastSeq(self, chat_uuid:str):
+        """
+        Get the sequence id of a chat's latest
+        message, -1 if it has no messages
+        """
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
+            return -1
+        return len(log)-1
     
     def getLastPageIndex(
             self,
             chat_uuid:str,
             page_size:int=CHAT_PAGE_SIZE_DEFAULT):
-        messages = self.getChatMessages(chat_uuid)
-        return int((len(messages)-1) / page_size)
+        log = self.getMessageLog(chat_uuid)
+        if log == None:
+            return 0
+        return int((len(log)-1) / page_size)
     
     def addParticipantToChat(self, chat_uuid:str, participant_uuid:str):
         """
@@ -314,26 +942,180 @@ class ChatManager(object):
         chat = self.database.getChatByUUID(chat_uuid)
         if chat == None:
             return False
-        participants = chat['participants']
-        if not participant_uuid in participants:
-            participants.append(participant_uuid)
-            self.database.modified = True
+        if not participant_uuid in chat['participants']:
+            self.database.appendToEntryField(
+                chat, 'participants', participant_uuid)
+            self.database.setEntryField(chat, 'version', self.nextVersion())
+            self.database.requestSave()
+            participants = self.chat_participants.get(chat_uuid, None)
+            if participants != None:
+                participants.add(participant_uuid)
+                self.chat_participants.resize(chat_uuid)
+            self._insertParticipantChat(participant_uuid, chat)
         return True
+    
+    def getKeySuite(self, chat):
+        return chat.get('key_suite', None) or 'rsa'
+    
+    def getMembersHash(self, chat):
+        participants = ','.join(sorted(chat['participants']))
+        return hashlib.sha256(participants.encode()).hexdigest()[:16]
+    
+    def getEpochKeys(self, chat):
+        """
+        Get a chat's wrapped epoch keys (base64), oldest first
+        """
+        return [epoch_key['wrapped_key'] for epoch_key in chat.get('epoch_keys', None) or []]
+    
+    def getCurrentEpoch(self, chat):
+        """
+        Get the epoch that new messages in a chat should be
+        sealed with, or -1 if a new epoch key is needed:
+        when the chat has none yet, or its participants
+        changed since the latest one was made
+        """
+        epoch_keys = chat.get('epoch_keys', None) or []
+        if len(epoch_keys) == 0:
+            return -1
+        if epoch_keys[-1]['members'] != self.getMembersHash(chat):
+            return -1
+        return len(epoch_keys)-1
+    
+    def addEpochKey(self, chat_uuid:str, epoch:int, wrapped_key:str):
+        """
+        Store a new epoch key made by a client. Only the
+        first key offered for an epoch is kept, and only
+        if one is needed, so that clients racing to rotate
+        end up agreeing on one key
+        """
+        # it goes into the database as it is, so anything
+        # that isn't base64 text is turned away here
+        if type(epoch) != int or type(wrapped_key) != str:
+            return False
+        if len(wrapped_key) > EPOCH_KEY_LENGTH_MAX:
+            return False
+        try:
+            base64.b64decode(wrapped_key, validate=True)
+        except (binascii.Error, ValueError):
+            return False
+        chat = self.database.getChatByUUID(chat_uuid)
+        if chat == None:
+            return False
+        if self.getCurrentEpoch(chat) != -1:
+            return False
+        epoch_keys = chat.get('epoch_keys', None) or []
+        if epoch != len(epoch_keys):
+            return False
+        self.database.setEntryField(chat, 'epoch_keys', epoch_keys+[{
+            'wrapped_key': wrapped_key,
+            'members': self.getMembersHash(chat)}])
+        self.database.setEntryField(chat, 'version', self.nextVersion())
+        self.database.requestSave()
+        return True
+    
+    def nextVersion(self):
+        """
+        Get a new chat version. Versions are microsecond
+        timestamps, bumped when needed so they always
+        increase, which keeps them increasing across
+        restarts without storing a counter
+        """
+        self.last_version = max(self.last_version+1, time.time_ns()//1000)
+        return self.last_version
+    
+    def getChatsChangedSince(self, participant_uuid:str, since_version:int=None):
+        """
+        Get the chats of a participant that changed after
+        since_version (all of them if it's None), most
+        recently active first, and the participant's
+        current version: the newest of their chats' versions
+        """
+        changed = []
+        version = 0
+        for chat in self.getChatsByParticipant(participant_uuid):
+            chat_version = chat.get('version', 0)
+            version = max(version, chat_version)
+            if since_version == None or chat_version > since_version:
+                changed.append(chat)
+        return changed, version
+    
+    def _getParticipantChats(self, participant_uuid:str):
+        chat_uuids = self.participant_chats.get(participant_uuid, None)
+        if chat_uuids == None:
+            chats = self.database.findEntriesByField(
+                'participants', participant_uuid)
+            chats.sort(key=lambda chat: chat['last_message_ts'])
+            chat_uuids = collections.OrderedDict(
+                (chat['uuid'], None) for chat in chats)
+            self.participant_chats.put(participant_uuid, chat_uuids)
+        return chat_uuids
+    
+    def _touchParticipantChat(self, participant_uuid:str, chat_uuid:str):
+        """
+        Move a chat to the front of a participant's
+        chats, if their chats have been ordered yet
+        """
+        chat_uuids = self.participant_chats.get(participant_uuid, None)
+        if chat_uuids == None:
+            return
+        chat_uuids[chat_uuid] = None
+        chat_uuids.move_to_end(chat_uuid)
+        self.participant_chats.resize(participant_uuid)
+    
+    def _insertParticipantChat(self, participant_uuid:str, chat):
+        """
+        Add a chat a participant joined to their chats,
+        if they've been ordered yet, in its place by
+        when it was last active
+        """
+        chat_uuids = self.participant_chats.get(participant_uuid, None)
+        if chat_uuids == None:
+            return
+        last_message_ts = chat['last_message_ts']
+        # the chats active since then go back after it. It
+        # was usually active recently, so there are few
+        newer = []
+        for chat_uuid in reversed(chat_uuids):
+            other = self.database.getChatByUUID(chat_uuid)
+            if other != None and other['last_message_ts'] <= last_message_ts:
+                break
+            newer.append(chat_uuid)
+        chat_uuids[chat['uuid']] = None
+        chat_uuids.move_to_end(chat['uuid'])
+        for chat_uuid in reversed(newer):
+            chat_uuids.move_to_end(chat_uuid)
+        self.participant_chats.resize(participant_uuid)
         
     def getChatsByParticipant(self, participant_uuid:str):
         """
-        Get a list of chats that have
-        a specified participant in them
+        Get a list of chats that have a specified
+        participant in them, most recently active first
         """
-        matching = [chat for chat in self.database.loaded_data['entries']
-            if participant_uuid in chat['participants']]
-        return matching
+        chats = []
+        for chat_uuid in reversed(self._getParticipantChats(participant_uuid)):
+            chat = self.database.getChatByUUID(chat_uuid)
+            if chat != None:
+                chats.append(chat)
+        return chats
+    
+    def getParticipantSet(self, chat_uuid:str):
+        """
+        Get the set of a chat's participants,
+        or None if the chat doesn't exist
+        """
+        participants = self.chat_participants.get(chat_uuid, None)
+        if participants == None:
+            chat = self.database.getChatByUUID(chat_uuid)
+            if chat == None:
+                return None
+            participants = set(chat['participants'])
+            self.chat_participants.put(chat_uuid, participants)
+        return participants
     
     def isUserInChat(self, chat_uuid:str, participant_uuid:str):
-        chat = self.database.getChatByUUID(chat_uuid)
-        if chat == None:
+        participants = self.getParticipantSet(chat_uuid)
+        if participants == None:
             return False
-        participants = chat['participants']
         return participant_uuid in participants
     
     def getChatByUUID(self, chat_uuid:str):